@@ -19,25 +19,122 @@ def create_app():
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'kiselgram-mobile-optimized-' + secrets.token_hex(16))
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///kiselgram.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # SQLite connection tuning, see app/utils/database.py: 'production' (WAL, busy timeout, ...) or 'default'
+    app.config['DB_PROFILE'] = os.getenv('DB_PROFILE', 'production')
 
     # File upload config
     app.config['UPLOAD_FOLDER'] = 'uploads'
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+    # Larger files go through the chunked /api/uploads protocol, one request per chunk
+    app.config['MAX_UPLOAD_SIZE'] = int(os.getenv('MAX_UPLOAD_SIZE', 2 * 1024 * 1024 * 1024))
+    app.config['UPLOAD_CHUNK_SIZE'] = 4 * 1024 * 1024
+    app.config['UPLOAD_EXPIRY_HOURS'] = 24
+    # Let a fronting proxy send upload bodies: 'x-accel' (nginx internal location) or 'x-sendfile'
+    app.config['UPLOAD_OFFLOAD'] = os.getenv('UPLOAD_OFFLOAD')
+    app.config['UPLOAD_ACCEL_PREFIX'] = os.getenv('UPLOAD_ACCEL_PREFIX', '/protected_uploads/')
+    app.config['USE_X_SENDFILE'] = app.config['UPLOAD_OFFLOAD'] == 'x-sendfile'
     app.config['ALLOWED_EXTENSIONS'] = {
         'images': {'jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp'},
         'documents': {'pdf', 'doc', 'docx', 'txt', 'rtf'},
         'archives': {'zip', 'rar', '7z'},
         'media': {'mp3', 'mp4', 'm4a', 'wav', 'ogg', 'avi', 'mov', 'mkv'}
     }
+    # Background thumbnail processes and how many jobs they hold before the rest wait in the DB
+    app.config['MEDIA_WORKERS'] = int(os.getenv('MEDIA_WORKERS', 2))
+    app.config['MEDIA_QUEUE_SIZE'] = int(os.getenv('MEDIA_QUEUE_SIZE', 32))
+
+    # Most messages one bot worker answers per transaction
+    app.config['BOT_BATCH_SIZE'] = int(os.getenv('BOT_BATCH_SIZE', 20))
+
+    # Telegram bridge; off unless a bot token is set. TELEGRAM_API_URL overrides api.telegram.org
+    app.config['TELEGRAM_BOT_TOKEN'] = os.getenv('TELEGRAM_BOT_TOKEN')
+    app.config['TELEGRAM_API_URL'] = os.getenv('TELEGRAM_API_URL')
+    app.config['TELEGRAM_QUEUE_SIZE'] = int(os.getenv('TELEGRAM_QUEUE_SIZE', 1000))
+    app.config['TELEGRAM_POLL_TIMEOUT'] = int(os.getenv('TELEGRAM_POLL_TIMEOUT', 20))
+
+    # Password hashing threads, jobs they hold, and hashes one client IP may run at once
+    app.config['PASSWORD_WORKERS'] = int(os.getenv('PASSWORD_WORKERS', 2))
+    app.config['PASSWORD_QUEUE_SIZE'] = int(os.getenv('PASSWORD_QUEUE_SIZE', 16))
+    app.config['PASSWORD_PER_IP'] = int(os.getenv('PASSWORD_PER_IP', 2))
+
+    # Seconds a session read from the table is trusted in memory (logouts in other processes take
+    # effect after it), and how often expired sessions are deleted
+    app.config['SESSION_CACHE_TTL'] = int(os.getenv('SESSION_CACHE_TTL', 30))
+    app.config['SESSION_EXPIRE_INTERVAL'] = int(os.getenv('SESSION_EXPIRE_INTERVAL', 3600))
+
+    # Usernames allowed to read operational endpoints such as /api/cache_stats (comma separated)
+    app.config['ADMIN_USERS'] = {name.strip() for name in os.getenv('ADMIN_USERS', '').split(',') if name.strip()}
+
+    # Cached group/channel memberships per user, and how long one may be trusted without invalidation
+    app.config['MEMBERSHIP_CACHE_SIZE'] = int(os.getenv('MEMBERSHIP_CACHE_SIZE', 10000))
+    app.config['MEMBERSHIP_CACHE_TTL'] = int(os.getenv('MEMBERSHIP_CACHE_TTL', 300))
+
+    # Seconds mark-read calls are collected before being written in one batch
+    app.config['READ_FLUSH_INTERVAL'] = float(os.getenv('READ_FLUSH_INTERVAL', 1.0))
+
+    # Group commit for sends: messages queued within INTERVAL ms (at most BATCH) share one transaction
+    app.config['MESSAGE_WRITER'] = os.getenv('MESSAGE_WRITER', '').lower() in ('1', 'true', 'yes')
+    app.config['MESSAGE_WRITER_INTERVAL'] = float(os.getenv('MESSAGE_WRITER_INTERVAL', 5))
+    app.config['MESSAGE_WRITER_BATCH'] = int(os.getenv('MESSAGE_WRITER_BATCH', 200))
+
+    # Channels whose latest CHANNEL_FEED_SIZE messages are served from memory once read
+    # CHANNEL_HOT_READS times a minute; CHANNEL_FEEDS=0 turns the feeds off
+    app.config['CHANNEL_FEEDS'] = int(os.getenv('CHANNEL_FEEDS', 100))
+    app.config['CHANNEL_FEED_SIZE'] = int(os.getenv('CHANNEL_FEED_SIZE', 200))
+    app.config['CHANNEL_HOT_READS'] = int(os.getenv('CHANNEL_HOT_READS', 30))
+
+    # Latest MESSAGE_CACHE_SIZE messages of recently read chats and groups, within MESSAGE_CACHE_BYTES
+    # of serialized JSON in total; 0 bytes turns the cache off
+    app.config['MESSAGE_CACHE_SIZE'] = int(os.getenv('MESSAGE_CACHE_SIZE', 100))
+    app.config['MESSAGE_CACHE_BYTES'] = int(os.getenv('MESSAGE_CACHE_BYTES', 32 * 1024 * 1024))
+
+    # Messages whose JSON is kept encoded for the fetch routes
+    app.config['MESSAGE_JSON_CACHE_SIZE'] = int(os.getenv('MESSAGE_JSON_CACHE_SIZE', 50000))
 
     # Initialize extensions
+    from app.utils.database import engine_options, apply_profile
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'],
+                                                             app.config['DB_PROFILE'])
     db.init_app(app)
+    with app.app_context():
+        apply_profile(db.engine, app.config['DB_PROFILE'])
+
+    from app.utils.media import media_worker
+    media_worker.init_app(app)
+
+    from app.utils.passwords import password_hasher
+    password_hasher.init_app(app)
+
+    from app.utils.read_state import read_marks
+    read_marks.init_app(app)
+
+    from app.utils.message_writer import message_writer
+    message_writer.init_app(app)
+
+    from app.utils.feeds import channel_feeds, message_cache
+    channel_feeds.init_app(app)
+    message_cache.init_app(app)
+
+    from app.utils.serializers import message_fragments
+    message_fragments.configure(app.config['MESSAGE_JSON_CACHE_SIZE'])
+
+    from app.utils.sessions import ServerSessionInterface, user_contexts
+    app.session_interface = ServerSessionInterface(app.config['SESSION_CACHE_TTL'],
+                                                   app.config['SESSION_EXPIRE_INTERVAL'])
+    user_contexts.configure(app.config['MEMBERSHIP_CACHE_SIZE'], app.config['MEMBERSHIP_CACHE_TTL'])
 
     # Create upload directories
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'images'), exist_ok=True)
     os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'documents'), exist_ok=True)
     os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'media'), exist_ok=True)
+    os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'partial'), exist_ok=True)
+
+    # Directories /uploads/ is served from, resolved once instead of per request
+    app.config['UPLOAD_ROOTS'] = list(dict.fromkeys([
+        os.path.abspath(app.config['UPLOAD_FOLDER']),
+        os.path.join(basedir, 'uploads')
+    ]))
 
     # Import models here to avoid circular imports
     from app import models
@@ -52,6 +149,7 @@ def create_app():
         from app.routes.api import api_bp
         from app.routes.search import search_bp
         from app.routes.status import status_bp  # NEW
+        from app.routes.stream import stream_bp
 
         app.register_blueprint(auth_bp)
         app.register_blueprint(chats_bp)
@@ -61,6 +159,7 @@ def create_app():
         app.register_blueprint(api_bp)
         app.register_blueprint(search_bp)
         app.register_blueprint(status_bp)  # NEW
+        app.register_blueprint(stream_bp)
 
     except ImportError as e:
         print(f"Error importing blueprints: {e}")
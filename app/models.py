@@ -37,6 +37,21 @@ class Message(db.Model):
     file_path = db.Column(db.String(500), nullable=True)
     file_size = db.Column(db.Integer, nullable=True)
     thumbnail_path = db.Column(db.String(500), nullable=True)
+    # Background thumbnail job: pending -> ready/failed, variants as JSON {name: path}
+    thumbnail_status = db.Column(db.String(20), nullable=True)
+    thumbnail_variants = db.Column(db.Text, nullable=True)
+
+    # Existing databases get these through app.utils.migrations. AUTOINCREMENT keeps
+    # SQLite from handing a deleted message's id to the next one, so caches keyed by
+    # id never serve another message's content.
+    __table_args__ = (
+        db.Index('ix_message_receiver_sender_read', 'receiver_id', 'sender_id', 'is_read'),
+        db.Index('ix_message_sender_receiver', 'sender_id', 'receiver_id', 'id'),
+        db.Index('ix_message_group', 'group_id', 'id'),
+        db.Index('ix_message_channel', 'channel_id', 'id'),
+        db.Index('ix_message_file_path', 'file_path'),
+        {'sqlite_autoincrement': True},
+    )
 
 
 class TelegramBot(db.Model):
@@ -90,4 +105,47 @@ class ChannelSubscriber(db.Model):
     channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'), nullable=False)
     subscribed_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    __table_args__ = (db.UniqueConstraint('user_id', 'channel_id', name='unique_channel_subscriber'),)
\ No newline at end of file
+    __table_args__ = (db.UniqueConstraint('user_id', 'channel_id', name='unique_channel_subscriber'),)
+
+
+# Denormalized chat list entry per user, maintained on send and mark-read (see read_state)
+class Conversation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    chat_type = db.Column(db.String(20), nullable=False)  # personal, group or channel
+    peer_id = db.Column(db.Integer, nullable=False)  # user, group or channel id
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True)
+    last_timestamp = db.Column(db.DateTime, nullable=True)
+    unread_count = db.Column(db.Integer, default=0, nullable=False)
+    last_read_message_id = db.Column(db.Integer, nullable=True)  # newest message of the chat the user has read
+
+    last_message = db.relationship('Message', foreign_keys=[last_message_id])
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'chat_type', 'peer_id', name='unique_conversation'),
+        db.Index('ix_conversation_user_activity', 'user_id', 'last_timestamp'),
+        db.Index('ix_conversation_peer', 'chat_type', 'peer_id'),
+    )
+
+
+# In-progress chunked upload; the bytes received so far live in uploads/partial/<id>.part
+class Upload(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    file_name = db.Column(db.String(255), nullable=False)
+    file_size = db.Column(db.BigInteger, nullable=False)
+    received_size = db.Column(db.BigInteger, default=0, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=True)  # expected digest of the whole file, if the client sent one
+    receiver_id = db.Column(db.Integer, nullable=True)
+    group_id = db.Column(db.Integer, nullable=True)
+    channel_id = db.Column(db.Integer, nullable=True)
+    message = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# Server-side login session; the cookie only carries the random id
+class ServerSession(db.Model):
+    id = db.Column(db.String(64), primary_key=True)  # sha256 of the cookie value
+    data = db.Column(db.Text, nullable=False)  # JSON
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
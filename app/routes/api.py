@@ -1,11 +1,89 @@
 from flask import Blueprint, request, jsonify
 from datetime import datetime
+import math
 from app import db
-from app.models import Message, GroupMember, ChannelSubscriber, User, Group, Channel
-from app.utils import get_current_user, get_current_user_id, format_file_size
+from app.models import Message, User, Group, Channel
+from app.utils import get_current_user, get_current_user_id, is_json_id, unrecord_message, load_chat_list, \
+    with_senders, collect_garbage, telegram_bridge, store_message
+from app.utils.serializers import messages_json, messages_json_response
+from app.utils.sessions import is_group_member, is_channel_subscriber
+from app.utils.read_state import read_marks, personal_read_marks
+from app.utils.events import message_bus, dm_key, group_key, channel_key
+from app.utils.feeds import channel_feeds, message_cache, conversation_messages, entries_json, message_removed
 
 api_bp = Blueprint('api', __name__)
 
+# Upper bound for the ?wait= long-poll parameter, in seconds
+MAX_LONG_POLL_WAIT = 30
+
+# Page size for the ?limit= parameter of the message fetch routes
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def page_params():
+    """The ?limit= (clamped) and ?before= parameters of a message fetch"""
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    return limit, request.args.get('before', type=int)
+
+
+def page_messages(query, after_id):
+    """Apply keyset pagination to a conversation's message query.
+
+    ?before=<id> returns the page of messages just older than id, ?after=<id>
+    the ones newer than id and neither the most recent page. Messages come
+    back in ascending id order together with a has_more flag telling whether
+    older messages exist before the page (None when paging forwards).
+    """
+    limit, before_id = page_params()
+
+    if before_id is None and after_id > 0:
+        return query.filter(Message.id > after_id).order_by(Message.id.asc()).limit(limit).all(), None
+
+    if before_id is not None:
+        query = query.filter(Message.id < before_id)
+    messages = query.order_by(Message.id.desc()).limit(limit + 1).all()
+    has_more = len(messages) > limit
+    return messages[:limit][::-1], has_more
+
+
+def fetch_page(store, key, after_id, read_up_to=None):
+    """Page of a conversation as (message ids, JSON of each message, has_more),
+    from its in-memory feed in store when that has it"""
+    current_user_id = get_current_user_id()
+    limit, before_id = page_params()
+    cached = store.page(key, after_id, before_id, limit)
+    if cached is not None:
+        entries, has_more = cached
+        return [entry[0] for entry in entries], entries_json(entries, current_user_id, read_up_to), has_more
+
+    messages, has_more = page_messages(with_senders(conversation_messages(key)), after_id)
+    return [message.id for message in messages], messages_json(messages, current_user_id, read_up_to), has_more
+
+
+def json_body():
+    """The request's JSON object, or {} when the body is missing or not an object"""
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+
+def invalid_message(peer_id, content):
+    """True if a send's conversation id or content has the wrong JSON type"""
+    return not is_json_id(peer_id) or (content is not None and not isinstance(content, str))
+
+
+def wait_for_messages(key, after_id):
+    """Park a long-poll request (?wait=<seconds>) until a message newer than after_id is sent"""
+    wait = request.args.get('wait', 0, type=float)
+    # nan would pass both checks below and never reach the deadline
+    if not math.isfinite(wait) or wait <= 0 or request.args.get('before') is not None:
+        return False
+    wait = min(wait, MAX_LONG_POLL_WAIT)
+
+    # Don't hold a database connection while parked
+    db.session.close()
+    return message_bus.wait_for_message(key, after_id, wait)
+
 
 # Add these routes
 @api_bp.route('/api/user_status/<int:user_id>')
@@ -30,16 +108,12 @@ def api_mark_read(user_id):
     if not get_current_user():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    current_user_id = get_current_user_id()
-
-    # Mark all messages from this user as read
-    Message.query.filter_by(
-        sender_id=user_id,
-        receiver_id=current_user_id,
-        is_read=False
-    ).update({'is_read': True})
-
-    db.session.commit()
+    # Up to the given message, or everything; written with the next batch of read marks
+    data = request.get_json(silent=True) or {}
+    message_id = data.get('message_id') if isinstance(data, dict) else None
+    if message_id is not None and not is_json_id(message_id):
+        return jsonify({'error': 'message_id must be a message id'}), 400
+    read_marks.mark(get_current_user_id(), 'personal', user_id, message_id)
 
     return jsonify({'success': True})
 
@@ -50,110 +124,51 @@ def api_messages(user_id):
 
     current_user_id = get_current_user_id()
     after_id = request.args.get('after', 0, type=int)
+    key = dm_key(current_user_id, user_id)
 
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user_id) & (Message.receiver_id == user_id)) |
-        ((Message.sender_id == user_id) & (Message.receiver_id == current_user_id))
-    ).filter(Message.id > after_id).order_by(Message.timestamp.asc()).all()
-
-    messages_data = []
-    for message in messages:
-        message_data = {
-            'id': message.id,
-            'content': message.content,
-            'sender_name': message.sender.username,
-            'timestamp': message.timestamp.strftime('%H:%M'),
-            'is_read': message.is_read,
-            'is_own': message.sender_id == current_user_id,
-            'has_attachment': message.has_attachment,
-        }
-
-        if message.has_attachment:
-            message_data.update({
-                'file_type': message.file_type,
-                'file_name': message.file_name,
-                'file_size': format_file_size(message.file_size),
-                'file_url': f"/{message.file_path}",
-                'thumbnail_url': f"/{message.thumbnail_path}" if message.thumbnail_path else None
-            })
-
-        messages_data.append(message_data)
-
-    return jsonify({'messages': messages_data})
+    marks = personal_read_marks(current_user_id, user_id)
+    read_up_to = {current_user_id: marks[user_id], user_id: marks[current_user_id]}
+    ids, messages, has_more = fetch_page(message_cache, key, after_id, read_up_to)
+    if not ids and wait_for_messages(key, after_id):
+        ids, messages, has_more = fetch_page(message_cache, key, after_id, read_up_to)
+
+    return messages_json_response(messages, has_more)
 
 @api_bp.route('/api/group_messages/<int:group_id>')
 def api_group_messages(group_id):
     if not get_current_user():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    membership = GroupMember.query.filter_by(user_id=get_current_user_id(), group_id=group_id).first()
-    if not membership:
+    if not is_group_member(group_id):
         return jsonify({'error': 'Not a member'}), 403
 
     after_id = request.args.get('after', 0, type=int)
-    messages = Message.query.filter_by(group_id=group_id).filter(Message.id > after_id).order_by(
-        Message.timestamp.asc()).all()
-
-    messages_data = []
-    for message in messages:
-        message_data = {
-            'id': message.id,
-            'content': message.content,
-            'sender_name': message.sender.username,
-            'timestamp': message.timestamp.strftime('%H:%M'),
-            'is_own': message.sender_id == get_current_user_id(),
-            'has_attachment': message.has_attachment,
-        }
-
-        if message.has_attachment:
-            message_data.update({
-                'file_type': message.file_type,
-                'file_name': message.file_name,
-                'file_size': format_file_size(message.file_size),
-                'file_url': f"/{message.file_path}",
-                'thumbnail_url': f"/{message.thumbnail_path}" if message.thumbnail_path else None
-            })
-
-        messages_data.append(message_data)
-
-    return jsonify({'messages': messages_data})
+    key = group_key(group_id)
+    ids, messages, has_more = fetch_page(message_cache, key, after_id)
+    if not ids and wait_for_messages(key, after_id):
+        ids, messages, has_more = fetch_page(message_cache, key, after_id)
+    if ids:
+        read_marks.mark(get_current_user_id(), 'group', group_id, ids[-1])
+
+    return messages_json_response(messages, has_more)
 
 @api_bp.route('/api/channel_messages/<int:channel_id>')
 def api_channel_messages(channel_id):
     if not get_current_user():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    subscription = ChannelSubscriber.query.filter_by(user_id=get_current_user_id(), channel_id=channel_id).first()
-    if not subscription:
+    if not is_channel_subscriber(channel_id):
         return jsonify({'error': 'Not subscribed'}), 403
 
     after_id = request.args.get('after', 0, type=int)
-    messages = Message.query.filter_by(channel_id=channel_id).filter(Message.id > after_id).order_by(
-        Message.timestamp.asc()).all()
-
-    messages_data = []
-    for message in messages:
-        message_data = {
-            'id': message.id,
-            'content': message.content,
-            'sender_name': message.sender.username,
-            'timestamp': message.timestamp.strftime('%H:%M'),
-            'is_own': message.sender_id == get_current_user_id(),
-            'has_attachment': message.has_attachment,
-        }
-
-        if message.has_attachment:
-            message_data.update({
-                'file_type': message.file_type,
-                'file_name': message.file_name,
-                'file_size': format_file_size(message.file_size),
-                'file_url': f"/{message.file_path}",
-                'thumbnail_url': f"/{message.thumbnail_path}" if message.thumbnail_path else None
-            })
-
-        messages_data.append(message_data)
-
-    return jsonify({'messages': messages_data})
+    key = channel_key(channel_id)
+    ids, messages, has_more = fetch_page(channel_feeds, key, after_id)
+    if not ids and wait_for_messages(key, after_id):
+        ids, messages, has_more = fetch_page(channel_feeds, key, after_id)
+    if ids:
+        read_marks.mark(get_current_user_id(), 'channel', channel_id, ids[-1])
+
+    return messages_json_response(messages, has_more)
 
 @api_bp.route('/api/send_message', methods=['POST'])
 def api_send_message():
@@ -161,27 +176,19 @@ def api_send_message():
         return jsonify({'error': 'Not authenticated'}), 401
 
     current_user_id = get_current_user_id()
-    data = request.get_json()
+    data = json_body()
     receiver_id = data.get('receiver_id')
     content = data.get('content')
 
     if not receiver_id or (not content and not data.get('has_attachment')):
         return jsonify({'error': 'Missing parameters'}), 400
 
-    new_message = Message(content=content, sender_id=current_user_id, receiver_id=receiver_id)
-    db.session.add(new_message)
-    db.session.commit()
+    if invalid_message(receiver_id, content):
+        return jsonify({'error': 'Invalid parameters'}), 400
 
-    message_data = {
-        'id': new_message.id,
-        'content': new_message.content,
-        'sender_name': new_message.sender.username,
-        'timestamp': new_message.timestamp.strftime('%H:%M'),
-        'is_own': True,
-        'has_attachment': False,
-    }
+    message = store_message(content=content, sender_id=current_user_id, receiver_id=receiver_id)
 
-    return jsonify({'success': True, 'message': message_data})
+    return jsonify({'success': True, 'message': message})
 
 @api_bp.route('/api/send_group_message', methods=['POST'])
 def api_send_group_message():
@@ -189,31 +196,23 @@ def api_send_group_message():
         return jsonify({'error': 'Not authenticated'}), 401
 
     current_user_id = get_current_user_id()
-    data = request.get_json()
+    data = json_body()
     group_id = data.get('group_id')
     content = data.get('content')
 
     if not group_id or (not content and not data.get('has_attachment')):
         return jsonify({'error': 'Missing parameters'}), 400
 
-    membership = GroupMember.query.filter_by(user_id=current_user_id, group_id=group_id).first()
-    if not membership:
-        return jsonify({'error': 'Not a member'}), 403
+    if invalid_message(group_id, content):
+        return jsonify({'error': 'Invalid parameters'}), 400
 
-    new_message = Message(content=content, sender_id=current_user_id, receiver_id=current_user_id, group_id=group_id)
-    db.session.add(new_message)
-    db.session.commit()
+    if not is_group_member(group_id):
+        return jsonify({'error': 'Not a member'}), 403
 
-    message_data = {
-        'id': new_message.id,
-        'content': new_message.content,
-        'sender_name': new_message.sender.username,
-        'timestamp': new_message.timestamp.strftime('%H:%M'),
-        'is_own': True,
-        'has_attachment': False,
-    }
+    message = store_message(content=content, sender_id=current_user_id, receiver_id=current_user_id,
+                            group_id=group_id)
 
-    return jsonify({'success': True, 'message': message_data})
+    return jsonify({'success': True, 'message': message})
 
 @api_bp.route('/api/send_channel_message', methods=['POST'])
 def api_send_channel_message():
@@ -221,70 +220,95 @@ def api_send_channel_message():
         return jsonify({'error': 'Not authenticated'}), 401
 
     current_user_id = get_current_user_id()
-    data = request.get_json()
+    data = json_body()
     channel_id = data.get('channel_id')
     content = data.get('content')
 
     if not channel_id or (not content and not data.get('has_attachment')):
         return jsonify({'error': 'Missing parameters'}), 400
 
+    if invalid_message(channel_id, content):
+        return jsonify({'error': 'Invalid parameters'}), 400
+
     channel = Channel.query.get(channel_id)
     if not channel or channel.owner_id != current_user_id:
         return jsonify({'error': 'Not authorized'}), 403
 
-    new_message = Message(content=content, sender_id=current_user_id, receiver_id=current_user_id,
-                          channel_id=channel_id)
-    db.session.add(new_message)
-    db.session.commit()
+    message = store_message(content=content, sender_id=current_user_id, receiver_id=current_user_id,
+                            channel_id=channel_id)
 
-    message_data = {
-        'id': new_message.id,
-        'content': new_message.content,
-        'sender_name': new_message.sender.username,
-        'timestamp': new_message.timestamp.strftime('%H:%M'),
-        'is_own': True,
-        'has_attachment': False,
-    }
+    return jsonify({'success': True, 'message': message})
 
-    return jsonify({'success': True, 'message': message_data})
+@api_bp.route('/api/delete_message/<int:message_id>', methods=['DELETE'])
+def api_delete_message(message_id):
+    if not get_current_user():
+        return jsonify({'error': 'Not authenticated'}), 401
 
-@api_bp.route('/api/chat_list')
-def api_chat_list():
+    message = Message.query.get_or_404(message_id)
+
+    if message.sender_id != get_current_user_id():
+        return jsonify({'error': 'Not authorized'}), 403
+
+    try:
+        unrecord_message(message)
+        db.session.delete(message)
+        db.session.commit()
+        message_removed(message)
+
+        # The attachment is shared with every other message of the same content
+        collect_garbage([message.file_path])
+
+        return jsonify({'success': True})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@api_bp.route('/api/telegram_link', methods=['POST', 'DELETE'])
+def api_telegram_link():
+    """Get a code to link a Telegram chat (POST) or unlink it (DELETE)"""
     if not get_current_user():
         return jsonify({'error': 'Not authenticated'}), 401
 
     current_user_id = get_current_user_id()
-    sent_chats = db.session.query(Message.receiver_id).filter_by(sender_id=current_user_id).distinct()
-    received_chats = db.session.query(Message.sender_id).filter_by(receiver_id=current_user_id).distinct()
-    chat_user_ids = set([id[0] for id in sent_chats] + [id[0] for id in received_chats])
+    if request.method == 'DELETE':
+        User.query.filter_by(id=current_user_id).update({'telegram_chat_id': None})
+        db.session.commit()
+        telegram_bridge.unlink(current_user_id)
+        return jsonify({'success': True})
+
+    if not telegram_bridge.enabled:
+        return jsonify({'error': 'Telegram bridge is not configured'}), 503
+
+    code = telegram_bridge.link_code(current_user_id)
+    return jsonify({'success': True, 'code': code, 'command': f'/start {code}'})
+
+@api_bp.route('/api/chat_list')
+def api_chat_list():
+    if not get_current_user():
+        return jsonify({'error': 'Not authenticated'}), 401
 
+    read_marks.flush_user(get_current_user_id())
     chats_data = []
-    for user_id in chat_user_ids:
-        user = User.query.get(user_id)
-        if user and user.id != current_user_id:
-            last_message = Message.query.filter(
-                ((Message.sender_id == current_user_id) & (Message.receiver_id == user_id)) |
-                ((Message.sender_id == user_id) & (Message.receiver_id == current_user_id))
-            ).order_by(Message.timestamp.desc()).first()
-
-            unread_count = Message.query.filter_by(sender_id=user_id, receiver_id=current_user_id,
-                                                   is_read=False).count()
-
-            if last_message:
-                time_diff = datetime.utcnow() - last_message.timestamp
-                timestamp = last_message.timestamp.strftime(
-                    '%H:%M') if time_diff.days == 0 else 'Yesterday' if time_diff.days == 1 else last_message.timestamp.strftime(
-                    '%d.%m.%Y')
-            else:
-                timestamp = ''
-
-            chats_data.append({
-                'type': 'personal',
-                'id': user.id,
-                'name': user.username,
-                'last_message': last_message.content if last_message else '',
-                'unread_count': unread_count,
-                'timestamp': timestamp,
-            })
-
-    return jsonify({'chats': chats_data})
\ No newline at end of file
+    for conversation, name in load_chat_list(get_current_user_id(), chat_type='personal'):
+        if name is None:
+            continue
+
+        last_message = conversation.last_message
+        if last_message:
+            time_diff = datetime.utcnow() - last_message.timestamp
+            timestamp = last_message.timestamp.strftime(
+                '%H:%M') if time_diff.days == 0 else 'Yesterday' if time_diff.days == 1 else last_message.timestamp.strftime(
+                '%d.%m.%Y')
+        else:
+            timestamp = ''
+
+        chats_data.append({
+            'type': conversation.chat_type,
+            'id': conversation.peer_id,
+            'name': name,
+            'last_message': last_message.content if last_message else '',
+            'unread_count': conversation.unread_count,
+            'timestamp': timestamp,
+        })
+
+    return jsonify({'chats': chats_data})
@@ -1,7 +1,8 @@
 from flask import Blueprint, render_template, request, redirect, url_for, session
 from app import db
 from app.models import User
-from app.utils.helpers import hash_password, get_current_user, get_current_user_id
+from app.utils.helpers import get_current_user, get_current_user_id
+from app.utils.passwords import password_hasher, needs_rehash, PasswordHasherBusy
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -18,27 +19,39 @@ def login():
         if not username or not password:
             return render_template('login.html', error="Username and password are required", login=True)
 
-        password_hash = hash_password(password)
-        user = User.query.filter_by(username=username).first()
+        client = request.remote_addr
+        # Only the columns needed to check the password
+        user = db.session.query(User.id, User.password_hash).filter_by(username=username).first()
+        # Don't keep the read transaction open while the password is hashed
+        db.session.rollback()
 
-        if user:
-            if user.password_hash == password_hash:
-                session['username'] = username
-                session['user_id'] = user.id
-                return redirect('/chat_list')
+        try:
+            if user:
+                if password_hasher.verify(password, user.password_hash, client):
+                    if needs_rehash(user.password_hash):
+                        password_hasher.upgrade(user.id, password, user.password_hash)
+                    session.regenerate()
+                    session['username'] = username
+                    session['user_id'] = user.id
+                    return redirect('/chat_list')
+                else:
+                    return render_template('login.html', error="Invalid password", login=True)
             else:
-                return render_template('login.html', error="Invalid password", login=True)
-        else:
-            try:
-                new_user = User(username=username, password_hash=password_hash)
-                db.session.add(new_user)
-                db.session.commit()
-                session['username'] = username
-                session['user_id'] = new_user.id
-                return redirect('/chat_list')
-            except:
-                db.session.rollback()
-                return render_template('login.html', error="Username already exists", login=True)
+                password_hash = password_hasher.hash(password, client)
+                try:
+                    new_user = User(username=username, password_hash=password_hash)
+                    db.session.add(new_user)
+                    db.session.commit()
+                    session.regenerate()
+                    session['username'] = username
+                    session['user_id'] = new_user.id
+                    return redirect('/chat_list')
+                except:
+                    db.session.rollback()
+                    return render_template('login.html', error="Username already exists", login=True)
+        except PasswordHasherBusy:
+            return render_template('login.html', error="Too many login attempts, please try again in a moment",
+                                   login=True), 429
 
     return render_template('login.html', login=True)
 
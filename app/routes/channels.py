@@ -1,7 +1,10 @@
-from flask import Blueprint, render_template, request, redirect, url_for, jsonify
+from flask import Blueprint, render_template, request, redirect
 from app import db
-from app.models import Channel, ChannelSubscriber, Message
+from app.models import Channel, ChannelSubscriber
 from app.utils.helpers import get_current_user, get_current_user_id, generate_invite_link
+from app.utils.conversations import add_conversation, remove_conversation
+from app.utils.read_state import read_marks
+from app.utils.sessions import invalidate_user_context, is_channel_subscriber
 
 channels_bp = Blueprint('channels', __name__)
 
@@ -36,7 +39,9 @@ def create_channel():
                 channel_id=new_channel.id
             )
             db.session.add(subscription)
+            add_conversation(get_current_user_id(), 'channel', new_channel.id)
             db.session.commit()
+            invalidate_user_context(get_current_user_id())
 
             return redirect(f'/channel/{new_channel.id}')
         except Exception as e:
@@ -51,10 +56,10 @@ def channel_view(channel_id):
         return redirect('/')
 
     channel = Channel.query.get_or_404(channel_id)
-    subscription = ChannelSubscriber.query.filter_by(user_id=get_current_user_id(), channel_id=channel_id).first()
-    if not subscription:
+    if not is_channel_subscriber(channel_id):
         return redirect('/join_channel/' + channel.invite_link)
 
+    read_marks.mark(get_current_user_id(), 'channel', channel_id)
     return render_template('channel.html', current_user=get_current_user(), channel=channel)
 
 @channels_bp.route('/join_channel/<invite_link>')
@@ -64,9 +69,7 @@ def join_channel(invite_link):
 
     channel = Channel.query.filter_by(invite_link=invite_link).first_or_404()
 
-    existing_subscriber = ChannelSubscriber.query.filter_by(user_id=get_current_user_id(),
-                                                            channel_id=channel.id).first()
-    if existing_subscriber:
+    if is_channel_subscriber(channel.id):
         return redirect(f'/channel/{channel.id}')
 
     try:
@@ -75,10 +78,14 @@ def join_channel(invite_link):
             channel_id=channel.id
         )
         db.session.add(subscription)
+        add_conversation(get_current_user_id(), 'channel', channel.id)
         db.session.commit()
+        invalidate_user_context(get_current_user_id())
         return redirect(f'/channel/{channel.id}')
     except:
         db.session.rollback()
+        # e.g. already a member through a write the cached context hasn't seen
+        invalidate_user_context(get_current_user_id())
         return redirect('/chat_list')
 
 @channels_bp.route('/channel_info/<int:channel_id>')
@@ -87,8 +94,7 @@ def channel_info(channel_id):
         return redirect('/')
 
     channel = Channel.query.get_or_404(channel_id)
-    subscription = ChannelSubscriber.query.filter_by(user_id=get_current_user_id(), channel_id=channel_id).first()
-    if not subscription:
+    if not is_channel_subscriber(channel_id):
         return redirect('/join_channel/' + channel.invite_link)
 
     subscribers = ChannelSubscriber.query.filter_by(channel_id=channel_id).all()
@@ -102,7 +108,9 @@ def leave_channel(channel_id):
 
     subscription = ChannelSubscriber.query.filter_by(user_id=get_current_user_id(), channel_id=channel_id).first()
     if subscription:
+        remove_conversation('channel', channel_id, user_id=get_current_user_id())
         db.session.delete(subscription)
         db.session.commit()
+        invalidate_user_context(get_current_user_id())
 
     return redirect('/chat_list')
\ No newline at end of file
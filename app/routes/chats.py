@@ -1,122 +1,45 @@
-from flask import Blueprint, render_template, request, jsonify, session, redirect
+from flask import Blueprint, render_template, redirect
 
 from datetime import datetime
-from app import db
-from app.models import User, Message, TelegramBot, GroupMember, ChannelSubscriber, Group, Channel
+from app.models import User, TelegramBot
 from app.utils.helpers import get_current_user, get_current_user_id
+from app.utils.conversations import load_chat_list
+from app.utils.read_state import read_marks
 
 chats_bp = Blueprint('chats', __name__)
 
+def format_chat_time(timestamp):
+    time_diff = datetime.utcnow() - timestamp
+    if time_diff.days == 0:
+        return timestamp.strftime('%H:%M')
+    elif time_diff.days == 1:
+        return 'Yesterday'
+    elif time_diff.days < 7:
+        return timestamp.strftime('%A')
+    return timestamp.strftime('%d.%m.%Y')
+
 @chats_bp.route('/chat_list')
 def chat_list():
     if not get_current_user():
         return redirect('/')
 
-    current_user_id = get_current_user_id()
-
-    # Get personal chats
-    sent_chats = db.session.query(Message.receiver_id).filter_by(sender_id=current_user_id).distinct()
-    received_chats = db.session.query(Message.sender_id).filter_by(receiver_id=current_user_id).distinct()
-    chat_user_ids = set([id[0] for id in sent_chats] + [id[0] for id in received_chats])
-
+    # Personal chats, groups and channels come from the Conversation summaries in one query
+    read_marks.flush_user(get_current_user_id())
     chats_data = []
-    for user_id in chat_user_ids:
-        user = User.query.get(user_id)
-        if user and user.id != current_user_id:
-            last_message = Message.query.filter(
-                ((Message.sender_id == current_user_id) & (Message.receiver_id == user_id)) |
-                ((Message.sender_id == user_id) & (Message.receiver_id == current_user_id))
-            ).order_by(Message.timestamp.desc()).first()
-
-            unread_count = Message.query.filter_by(sender_id=user_id, receiver_id=current_user_id,
-                                                   is_read=False).count()
-
-            if last_message:
-                time_diff = datetime.utcnow() - last_message.timestamp
-                if time_diff.days == 0:
-                    timestamp = last_message.timestamp.strftime('%H:%M')
-                elif time_diff.days == 1:
-                    timestamp = 'Yesterday'
-                elif time_diff.days < 7:
-                    timestamp = last_message.timestamp.strftime('%A')
-                else:
-                    timestamp = last_message.timestamp.strftime('%d.%m.%Y')
-            else:
-                timestamp = ''
-
-            chats_data.append({
-                'type': 'personal',
-                'id': user.id,
-                'name': user.username,
-                'user': user,
-                'last_message': last_message,
-                'unread_count': unread_count,
-                'timestamp': timestamp
-            })
-
-    # Get groups the user is member of
-    user_groups = GroupMember.query.filter_by(user_id=current_user_id).all()
-    for membership in user_groups:
-        group = membership.group
-        last_message = Message.query.filter_by(group_id=group.id).order_by(Message.timestamp.desc()).first()
-
-        if last_message:
-            time_diff = datetime.utcnow() - last_message.timestamp
-            if time_diff.days == 0:
-                timestamp = last_message.timestamp.strftime('%H:%M')
-            elif time_diff.days == 1:
-                timestamp = 'Yesterday'
-            elif time_diff.days < 7:
-                timestamp = last_message.timestamp.strftime('%A')
-            else:
-                timestamp = last_message.timestamp.strftime('%d.%m.%Y')
-        else:
-            timestamp = ''
-
-        unread_count = 0
-
-        chats_data.append({
-            'type': 'group',
-            'id': group.id,
-            'name': group.name,
-            'group': group,
-            'last_message': last_message,
-            'unread_count': unread_count,
-            'timestamp': timestamp
-        })
-
-    # Get channels the user is subscribed to
-    user_channels = ChannelSubscriber.query.filter_by(user_id=current_user_id).all()
-    for subscription in user_channels:
-        channel = subscription.channel
-        last_message = Message.query.filter_by(channel_id=channel.id).order_by(Message.timestamp.desc()).first()
-
-        if last_message:
-            time_diff = datetime.utcnow() - last_message.timestamp
-            if time_diff.days == 0:
-                timestamp = last_message.timestamp.strftime('%H:%M')
-            elif time_diff.days == 1:
-                timestamp = 'Yesterday'
-            elif time_diff.days < 7:
-                timestamp = last_message.timestamp.strftime('%A')
-            else:
-                timestamp = last_message.timestamp.strftime('%d.%m.%Y')
-        else:
-            timestamp = ''
-
-        unread_count = 0
+    for conversation, name in load_chat_list(get_current_user_id()):
+        if name is None:
+            continue
 
+        last_message = conversation.last_message
         chats_data.append({
-            'type': 'channel',
-            'id': channel.id,
-            'name': channel.name,
-            'channel': channel,
+            'type': conversation.chat_type,
+            'id': conversation.peer_id,
+            'name': name,
             'last_message': last_message,
-            'unread_count': unread_count,
-            'timestamp': timestamp
+            'unread_count': conversation.unread_count,
+            'timestamp': format_chat_time(last_message.timestamp) if last_message else ''
         })
 
-    chats_data.sort(key=lambda x: x['last_message'].timestamp if x['last_message'] else datetime.min, reverse=True)
     bots = TelegramBot.query.filter_by(is_active=True).all()
 
     return render_template('chat_list.html', current_user=get_current_user(), chats=chats_data, bots=bots)
@@ -127,9 +50,7 @@ def chat(user_id):
         return redirect('/')
 
     receiver = User.query.get_or_404(user_id)
-    Message.query.filter_by(sender_id=user_id, receiver_id=get_current_user_id(), is_read=False).update(
-        {'is_read': True})
-    db.session.commit()
+    read_marks.mark(get_current_user_id(), 'personal', user_id)
 
     return render_template('chat.html', current_user=get_current_user(), receiver=receiver)
 
@@ -1,10 +1,19 @@
 from flask import Blueprint, request, jsonify, send_file, current_app
+from werkzeug.security import safe_join
+from datetime import datetime, timedelta
+import hashlib
 import os
+import re
+import threading
 import uuid
 import mimetypes
 from app import db
-from app.models import Message
-from app.utils import get_current_user, get_current_user_id, get_file_type, create_thumbnail, format_file_size
+from app.models import Message, Channel, Upload
+from app.utils import get_current_user, get_current_user_id, is_json_int, \
+    publish_message, record_message, serialize_message, media_worker
+from app.utils.media import STATUS_PENDING
+from app.utils.blobs import blob_lock, save_stream, store_blob, shared_thumbnails
+from app.utils.sessions import is_group_member
 
 files_bp = Blueprint('files', __name__)
 
@@ -27,30 +36,145 @@ def allowed_file(filename):
     return ext in allowed_extensions
 
 
+# Content-addressed blobs, their thumbnails and uuid-named legacy uploads never change once written
+IMMUTABLE_NAME = re.compile(r'^(thumb_)?([0-9a-f]{64}|[0-9a-f]{32})(_[a-z_]+)?\.\w+$')
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+mimetypes.add_type('video/x-matroska', '.mkv')
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('audio/mp4', '.m4a')
+
+# filename -> absolute path, filled on first request for each file
+_resolved_uploads = {}
+MAX_RESOLVED_UPLOADS = 10000
+
+
+def resolve_upload(filename):
+    """Absolute path of an uploaded file inside one of the upload roots, or None"""
+    path = _resolved_uploads.get(filename)
+    if path is not None:
+        return path
+
+    for root in current_app.config['UPLOAD_ROOTS']:
+        candidate = safe_join(root, filename)
+        if candidate and os.path.isfile(candidate):
+            if len(_resolved_uploads) >= MAX_RESOLVED_UPLOADS:
+                _resolved_uploads.clear()
+            _resolved_uploads[filename] = candidate
+            return candidate
+    return None
+
+
+def offload_response(filename, path):
+    """Empty response telling nginx to send the file from its internal location"""
+    response = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    response.headers['X-Accel-Redirect'] = current_app.config['UPLOAD_ACCEL_PREFIX'].rstrip('/') + '/' + filename
+    response.last_modified = os.stat(path).st_mtime
+    return response
+
+
 @files_bp.route('/uploads/<path:filename>')
 def serve_file(filename):
-    """Serve uploaded files - SIMPLIFIED VERSION"""
-    try:
-        # Try multiple possible locations
-        possible_paths = [
-            os.path.join('uploads', filename),
-            os.path.join(os.getcwd(), 'uploads', filename),
-            os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'uploads', filename)
-        ]
-
-        for file_path in possible_paths:
-            file_path = os.path.normpath(file_path)
-            if os.path.exists(file_path):
-                return send_file(file_path)
+    """Serve uploaded files with validators, Range support and long-lived caching for blobs"""
+    if os.path.normpath(filename).split(os.sep)[0] == 'partial':
+        return "File not found", 404
 
+    path = resolve_upload(filename)
+    if path is None:
         return "File not found", 404
-    except Exception as e:
-        return str(e), 500
+
+    immutable = IMMUTABLE_NAME.match(os.path.basename(filename)) is not None
+    try:
+        if current_app.config['UPLOAD_OFFLOAD'] == 'x-accel':
+            response = offload_response(filename, path)
+        else:
+            # conditional=True answers If-None-Match/If-Modified-Since with 304 and Range with 206/416;
+            # USE_X_SENDFILE (UPLOAD_OFFLOAD='x-sendfile') makes it emit X-Sendfile instead of the body
+            response = send_file(
+                path,
+                conditional=True,
+                etag=os.path.splitext(os.path.basename(filename))[0] if immutable else True,
+                max_age=None
+            )
+    except FileNotFoundError:
+        # Removed by garbage collection since it was resolved
+        _resolved_uploads.pop(filename, None)
+        return "File not found", 404
+
+    if immutable:
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def check_destination(current_user_id, receiver_id, group_id, channel_id):
+    """Return an error response if the user may not post an attachment there, else None"""
+    if not receiver_id and not group_id and not channel_id:
+        return jsonify({'error': 'No destination specified'}), 400
+
+    if group_id and not is_group_member(group_id, current_user_id):
+        return jsonify({'error': 'Not a member'}), 403
+
+    if channel_id:
+        channel = Channel.query.get(channel_id)
+        if not channel or channel.owner_id != current_user_id:
+            return jsonify({'error': 'Not authorized'}), 403
+
+    return None
+
+
+def attachment_message(current_user_id, file_path, file_name, file_type, message_text,
+                       receiver_id, group_id, channel_id):
+    """Create, record and publish the attachment message for a stored blob; returns the response data"""
+    new_message = Message(
+        content=message_text,
+        sender_id=current_user_id,
+        receiver_id=receiver_id or current_user_id,
+        group_id=group_id,
+        channel_id=channel_id,
+        has_attachment=True,
+        file_type=file_type,
+        file_name=file_name,
+        file_path=file_path,
+        file_size=os.path.getsize(file_path),
+        thumbnail_status=STATUS_PENDING if file_type == 'image' else None
+    )
+
+    # Same content uploaded before: reuse its thumbnails instead of rendering them again. If they
+    # are still pending, media_worker.submit() below joins the blob's job rather than starting one
+    if file_type == 'image':
+        existing = shared_thumbnails(file_path)
+        if existing:
+            new_message.thumbnail_path = existing.thumbnail_path
+            new_message.thumbnail_variants = existing.thumbnail_variants
+            new_message.thumbnail_status = existing.thumbnail_status
+
+    db.session.add(new_message)
+    db.session.flush()
+    record_message(new_message)
+    db.session.commit()
+    publish_message(new_message)
+
+    if new_message.thumbnail_status == STATUS_PENDING:
+        try:
+            media_worker.submit(new_message.id, new_message.file_path)
+        except Exception as e:
+            # The upload is stored; the job stays pending until the worker resumes it
+            print(f"Could not queue thumbnails for message {new_message.id}: {e}")
+
+    return {
+        'success': True,
+        'filename': os.path.basename(file_path),
+        'url': f'/{file_path}',
+        'message': serialize_message(new_message, current_user_id)
+    }
 
 
 @files_bp.route('/upload_file', methods=['POST'])
 def upload_file():
-    """Handle file uploads - SIMPLIFIED VERSION"""
+    """Handle file uploads and create the attachment message"""
     if not get_current_user():
         return jsonify({'error': 'Not authenticated'}), 401
 
@@ -64,36 +188,255 @@ def upload_file():
     if not allowed_file(file.filename):
         return jsonify({'error': 'File type not allowed'}), 400
 
-    try:
-        # Generate unique filename
-        file_ext = file.filename.rsplit('.', 1)[1].lower()
-        unique_filename = f"{uuid.uuid4().hex}.{file_ext}"
-        file_type = get_file_type(file.filename)
-
-        # Determine upload directory
-        if file_type == 'image':
-            upload_dir = 'images'
-        elif file_type in ['audio', 'video']:
-            upload_dir = 'media'
-        else:
-            upload_dir = 'documents'
+    current_user_id = get_current_user_id()
+    receiver_id = request.form.get('receiver_id', type=int)
+    group_id = request.form.get('group_id', type=int)
+    channel_id = request.form.get('channel_id', type=int)
+    message_text = request.form.get('message', '')
 
-        # Save file
-        upload_path = os.path.join('uploads', upload_dir, unique_filename)
-        os.makedirs(os.path.dirname(upload_path), exist_ok=True)
-        file.save(upload_path)
+    error = check_destination(current_user_id, receiver_id, group_id, channel_id)
+    if error:
+        return error
 
-        # Create message (simplified)
-        return jsonify({
-            'success': True,
-            'filename': unique_filename,
-            'url': f'/uploads/{upload_dir}/{unique_filename}'
-        })
+    try:
+        staging_path = os.path.join('uploads', 'partial', f'{uuid.uuid4().hex}.upload')
+        digest = save_stream(file.stream, staging_path)
+
+        with blob_lock:
+            file_type, file_path = store_blob(staging_path, file.filename, digest)
+            return jsonify(attachment_message(current_user_id, file_path, file.filename, file_type,
+                                              message_text, receiver_id, group_id, channel_id))
 
     except Exception as e:
+        db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 
+# Chunked uploads: POST /api/uploads, then PUT /api/uploads/<id>?offset=N per chunk,
+# then POST /api/uploads/<id>/finalize. GET /api/uploads/<id> tells a client
+# where to resume after a dropped connection.
+
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# upload id -> (sha256 object, offset it has hashed up to)
+_upload_hashes = {}
+_upload_locks = {}
+_upload_locks_guard = threading.Lock()
+
+
+def partial_path(upload_id):
+    return os.path.join('uploads', 'partial', f'{upload_id}.part')
+
+
+def upload_lock(upload_id):
+    with _upload_locks_guard:
+        return _upload_locks.setdefault(upload_id, threading.Lock())
+
+
+def upload_hash(upload):
+    """Running sha256 of the bytes received so far, re-read from disk if this process lost track"""
+    hasher, offset = _upload_hashes.get(upload.id, (None, None))
+    if offset != upload.received_size:
+        hasher = hashlib.sha256()
+        with open(partial_path(upload.id), 'rb') as f:
+            for block in iter(lambda: f.read(STREAM_BLOCK_SIZE), b''):
+                hasher.update(block)
+        _upload_hashes[upload.id] = (hasher, upload.received_size)
+    return hasher
+
+
+def discard_upload(upload):
+    _upload_hashes.pop(upload.id, None)
+    with _upload_locks_guard:
+        _upload_locks.pop(upload.id, None)
+    if os.path.exists(partial_path(upload.id)):
+        os.remove(partial_path(upload.id))
+    db.session.delete(upload)
+
+
+def expire_uploads():
+    """Drop chunked uploads nobody has touched for UPLOAD_EXPIRY_HOURS"""
+    cutoff = datetime.utcnow() - timedelta(hours=current_app.config['UPLOAD_EXPIRY_HOURS'])
+    for upload in Upload.query.filter(Upload.updated_at < cutoff).all():
+        discard_upload(upload)
+    db.session.commit()
+
+
+def upload_status(upload):
+    return {
+        'upload_id': upload.id,
+        'file_name': upload.file_name,
+        'file_size': upload.file_size,
+        'offset': upload.received_size,
+        'chunk_size': current_app.config['UPLOAD_CHUNK_SIZE']
+    }
+
+
+def get_own_upload(upload_id):
+    return Upload.query.filter_by(id=upload_id, user_id=get_current_user_id()).first()
+
+
+@files_bp.route('/api/uploads', methods=['POST'])
+def init_upload():
+    """Start a chunked upload"""
+    if not get_current_user():
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    current_user_id = get_current_user_id()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Missing parameters'}), 400
+    file_name = data.get('file_name') or ''
+    file_size = data.get('file_size')
+
+    if not file_name or not is_json_int(file_size) or file_size <= 0:
+        return jsonify({'error': 'Missing parameters'}), 400
+
+    receiver_id = data.get('receiver_id')
+    group_id = data.get('group_id')
+    channel_id = data.get('channel_id')
+    sha256 = data.get('sha256') or None
+    message_text = data.get('message') or ''
+    if not isinstance(file_name, str) or not isinstance(message_text, str) or \
+            not all(value is None or is_json_int(value) for value in (receiver_id, group_id, channel_id)) or \
+            not (sha256 is None or isinstance(sha256, str) and re.fullmatch(r'[0-9a-fA-F]{64}', sha256)):
+        return jsonify({'error': 'Invalid parameters'}), 400
+
+    if not allowed_file(file_name):
+        return jsonify({'error': 'File type not allowed'}), 400
+
+    if file_size > current_app.config['MAX_UPLOAD_SIZE']:
+        return jsonify({'error': 'File too large'}), 413
+
+    error = check_destination(current_user_id, receiver_id, group_id, channel_id)
+    if error:
+        return error
+
+    expire_uploads()
+
+    upload = Upload(
+        id=uuid.uuid4().hex,
+        user_id=current_user_id,
+        file_name=file_name,
+        file_size=file_size,
+        sha256=sha256.lower() if sha256 else None,
+        receiver_id=receiver_id,
+        group_id=group_id,
+        channel_id=channel_id,
+        message=message_text
+    )
+    open(partial_path(upload.id), 'wb').close()
+    _upload_hashes[upload.id] = (hashlib.sha256(), 0)
+    db.session.add(upload)
+    db.session.commit()
+
+    return jsonify(upload_status(upload)), 201
+
+
+@files_bp.route('/api/uploads/<upload_id>')
+def get_upload(upload_id):
+    """Where to resume a chunked upload"""
+    if not get_current_user():
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    upload = get_own_upload(upload_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    return jsonify(upload_status(upload))
+
+
+@files_bp.route('/api/uploads/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    """Append one chunk, streamed straight to the partial file"""
+    if not get_current_user():
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    with upload_lock(upload_id):
+        upload = get_own_upload(upload_id)
+        if not upload:
+            return jsonify({'error': 'Upload not found'}), 404
+
+        offset = request.args.get('offset', type=int)
+        if offset != upload.received_size:
+            # Client is out of sync (e.g. the previous response was lost); tell it where to continue
+            return jsonify({'error': 'Offset mismatch', **upload_status(upload)}), 409
+
+        expected_chunk_hash = request.headers.get('X-Chunk-SHA256', '').lower()
+        hasher = upload_hash(upload).copy()
+        chunk_hasher = hashlib.sha256()
+        received = 0
+
+        with open(partial_path(upload.id), 'r+b') as f:
+            f.seek(offset)
+            f.truncate()
+            while True:
+                block = request.stream.read(STREAM_BLOCK_SIZE)
+                if not block:
+                    break
+                received += len(block)
+                if offset + received > upload.file_size:
+                    f.truncate(offset)
+                    return jsonify({'error': 'Chunk exceeds declared file size', **upload_status(upload)}), 400
+                f.write(block)
+                hasher.update(block)
+                chunk_hasher.update(block)
+
+            if not received or (expected_chunk_hash and chunk_hasher.hexdigest() != expected_chunk_hash):
+                f.truncate(offset)
+                return jsonify({'error': 'Chunk corrupted or empty', **upload_status(upload)}), 400
+
+        upload.received_size = offset + received
+        upload.updated_at = datetime.utcnow()
+        db.session.commit()
+        _upload_hashes[upload.id] = (hasher, upload.received_size)
+
+        return jsonify(upload_status(upload))
+
+
+@files_bp.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """Verify a complete chunked upload and post it as an attachment message"""
+    if not get_current_user():
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    current_user_id = get_current_user_id()
+    with upload_lock(upload_id):
+        upload = get_own_upload(upload_id)
+        if not upload:
+            return jsonify({'error': 'Upload not found'}), 404
+
+        if upload.received_size != upload.file_size:
+            return jsonify({'error': 'Upload incomplete', **upload_status(upload)}), 409
+
+        digest = upload_hash(upload).hexdigest()
+        if upload.sha256 and digest != upload.sha256:
+            discard_upload(upload)
+            db.session.commit()
+            return jsonify({'error': 'Checksum mismatch, upload discarded'}), 422
+
+        # Permissions may have changed while the upload was running
+        error = check_destination(current_user_id, upload.receiver_id, upload.group_id, upload.channel_id)
+        if error:
+            return error
+
+        try:
+            details = (upload.file_name, upload.message, upload.receiver_id, upload.group_id, upload.channel_id)
+            file_name, message_text, receiver_id, group_id, channel_id = details
+
+            with blob_lock:
+                file_type, file_path = store_blob(partial_path(upload.id), file_name, digest)
+                discard_upload(upload)
+                data = attachment_message(current_user_id, file_path, file_name, file_type,
+                                          message_text, receiver_id, group_id, channel_id)
+            data['sha256'] = digest
+            return jsonify(data)
+
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 500
+
+
 # Test route
 @files_bp.route('/test_uploads')
 def test_uploads():
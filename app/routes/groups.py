@@ -1,7 +1,13 @@
-from flask import Blueprint, render_template, request, redirect, url_for, jsonify
+from flask import Blueprint, render_template, request, redirect
 from app import db
 from app.models import Group, GroupMember, Message
 from app.utils.helpers import get_current_user, get_current_user_id, generate_invite_link
+from app.utils.conversations import add_conversation, remove_conversation
+from app.utils.blobs import attachment_paths, collect_garbage
+from app.utils.events import group_key
+from app.utils.feeds import messages_removed
+from app.utils.read_state import read_marks
+from app.utils.sessions import invalidate_user_context, is_group_member
 
 groups_bp = Blueprint('groups', __name__)
 
@@ -37,7 +43,9 @@ def create_group():
                 role='owner'
             )
             db.session.add(membership)
+            add_conversation(get_current_user_id(), 'group', new_group.id)
             db.session.commit()
+            invalidate_user_context(get_current_user_id())
 
             return redirect(f'/group/{new_group.id}')
         except Exception as e:
@@ -52,10 +60,10 @@ def group_chat(group_id):
         return redirect('/')
 
     group = Group.query.get_or_404(group_id)
-    membership = GroupMember.query.filter_by(user_id=get_current_user_id(), group_id=group_id).first()
-    if not membership:
+    if not is_group_member(group_id):
         return redirect('/join_group/' + group.invite_link)
 
+    read_marks.mark(get_current_user_id(), 'group', group_id)
     return render_template('group_chat.html', current_user=get_current_user(), group=group)
 
 @groups_bp.route('/join_group/<invite_link>')
@@ -65,8 +73,7 @@ def join_group(invite_link):
 
     group = Group.query.filter_by(invite_link=invite_link).first_or_404()
 
-    existing_member = GroupMember.query.filter_by(user_id=get_current_user_id(), group_id=group.id).first()
-    if existing_member:
+    if is_group_member(group.id):
         return redirect(f'/group/{group.id}')
 
     try:
@@ -76,10 +83,14 @@ def join_group(invite_link):
             role='member'
         )
         db.session.add(membership)
+        add_conversation(get_current_user_id(), 'group', group.id)
         db.session.commit()
+        invalidate_user_context(get_current_user_id())
         return redirect(f'/group/{group.id}')
     except:
         db.session.rollback()
+        # e.g. already a member through a write the cached context hasn't seen
+        invalidate_user_context(get_current_user_id())
         return redirect('/chat_list')
 
 @groups_bp.route('/group_info/<int:group_id>')
@@ -88,8 +99,7 @@ def group_info(group_id):
         return redirect('/')
 
     group = Group.query.get_or_404(group_id)
-    membership = GroupMember.query.filter_by(user_id=get_current_user_id(), group_id=group_id).first()
-    if not membership:
+    if not is_group_member(group_id):
         return redirect('/join_group/' + group.invite_link)
 
     members = GroupMember.query.filter_by(group_id=group_id).all()
@@ -102,13 +112,24 @@ def leave_group(group_id):
 
     membership = GroupMember.query.filter_by(user_id=get_current_user_id(), group_id=group_id).first()
     if membership:
+        file_paths, message_ids = [], []
         if membership.role == 'owner':
+            file_paths = attachment_paths(Message.query.filter_by(group_id=group_id))
+            message_ids = [message_id for (message_id,) in
+                           db.session.query(Message.id).filter_by(group_id=group_id)]
+            remove_conversation('group', group_id)
             Message.query.filter_by(group_id=group_id).delete()
             GroupMember.query.filter_by(group_id=group_id).delete()
             Group.query.filter_by(id=group_id).delete()
         else:
+            remove_conversation('group', group_id, user_id=get_current_user_id())
             db.session.delete(membership)
 
         db.session.commit()
+        if message_ids:
+            messages_removed(group_key(group_id), message_ids)
+        # Deleting the group changes every member's context
+        invalidate_user_context(None if membership.role == 'owner' else get_current_user_id())
+        collect_garbage(file_paths)
 
     return redirect('/chat_list')
\ No newline at end of file
@@ -1,10 +1,76 @@
-from flask import Blueprint, render_template, request, jsonify
+from flask import Blueprint, render_template, request, jsonify, redirect
 from app.models import User, Group, Channel, Message, GroupMember, ChannelSubscriber
 from app.utils.helpers import get_current_user, get_current_user_id
+from app.utils.serializers import load_usernames
+from app.utils.search_index import search_messages
+from sqlalchemy import or_, select, false, func
+from sqlalchemy.orm import aliased
+from app import db
 import re
 
 search_bp = Blueprint('search', __name__)
 
+
+def visible_messages(current_user_id, chat_type='all', chat_id=None):
+    """Condition selecting the messages a user may search in the given chat type(s)"""
+    conditions = []
+
+    if chat_type in ('all', 'personal'):
+        conditions.append(
+            Message.group_id.is_(None) &
+            Message.channel_id.is_(None) &
+            ((Message.sender_id == current_user_id) | (Message.receiver_id == current_user_id))
+        )
+
+    if chat_type in ('all', 'group'):
+        condition = Message.group_id.in_(
+            select(GroupMember.group_id).where(GroupMember.user_id == current_user_id))
+        if chat_id:
+            condition &= Message.group_id == chat_id
+        conditions.append(condition)
+
+    if chat_type in ('all', 'channel'):
+        condition = Message.channel_id.in_(
+            select(ChannelSubscriber.channel_id).where(ChannelSubscriber.user_id == current_user_id))
+        if chat_id:
+            condition &= Message.channel_id == chat_id
+        conditions.append(condition)
+
+    return or_(*conditions) if conditions else false()
+
+
+def visible_chats(model, membership_model, chat_column, query, current_user_id, limit=None):
+    """Search groups or channels by name in one query.
+
+    Returns (chat, is_member, member_count) rows for chats that are public or
+    that the user belongs to; limit applies after that filter.
+    """
+    membership = aliased(membership_model)
+    is_member = membership.id.isnot(None)
+    member_count = select(func.count(membership_model.id)).where(
+        getattr(membership_model, chat_column) == model.id
+    ).correlate(model).scalar_subquery()
+
+    results = db.session.query(model, is_member, member_count).outerjoin(
+        membership,
+        (getattr(membership, chat_column) == model.id) & (membership.user_id == current_user_id)
+    ).filter(
+        model.name.ilike(f'%{query}%'),
+        model.is_public | is_member
+    ).order_by(model.id)
+    if limit is not None:
+        results = results.limit(limit)
+    return results.all()
+
+
+def search_groups(query, current_user_id, limit=None):
+    return visible_chats(Group, GroupMember, 'group_id', query, current_user_id, limit)
+
+
+def search_channels(query, current_user_id, limit=None):
+    return visible_chats(Channel, ChannelSubscriber, 'channel_id', query, current_user_id, limit)
+
+
 @search_bp.route('/search')
 def search():
     if not get_current_user():
@@ -33,49 +99,26 @@ def search():
 
         # Search groups
         if search_type in ['all', 'groups']:
-            groups = Group.query.filter(Group.name.ilike(f'%{query}%')).all()
-            filtered_groups = []
-            for group in groups:
-                if group.is_public or GroupMember.query.filter_by(user_id=current_user_id, group_id=group.id).first():
-                    filtered_groups.append(group)
-            results['groups'] = filtered_groups
+            results['groups'] = [{
+                'id': group.id,
+                'name': group.name,
+                'description': group.description,
+                'members_count': members_count
+            } for group, is_member, members_count in search_groups(query, current_user_id)]
 
         # Search channels
         if search_type in ['all', 'channels']:
-            channels = Channel.query.filter(Channel.name.ilike(f'%{query}%')).all()
-            filtered_channels = []
-            for channel in channels:
-                if channel.is_public or ChannelSubscriber.query.filter_by(user_id=current_user_id,
-                                                                          channel_id=channel.id).first():
-                    filtered_channels.append(channel)
-            results['channels'] = filtered_channels
+            results['channels'] = [{
+                'id': channel.id,
+                'name': channel.name,
+                'description': channel.description,
+                'subscribers_count': subscribers_count
+            } for channel, is_subscribed, subscribers_count in search_channels(query, current_user_id)]
 
         # Search messages
         if search_type in ['all', 'messages']:
-            personal_messages = Message.query.filter(
-                Message.content.ilike(f'%{query}%'),
-                Message.group_id.is_(None),
-                Message.channel_id.is_(None),
-                (
-                        (Message.sender_id == current_user_id) |
-                        (Message.receiver_id == current_user_id)
-                )
-            ).order_by(Message.timestamp.desc()).limit(50).all()
-
-            user_group_ids = [gm.group_id for gm in GroupMember.query.filter_by(user_id=current_user_id).all()]
-            group_messages = Message.query.filter(
-                Message.content.ilike(f'%{query}%'),
-                Message.group_id.in_(user_group_ids)
-            ).order_by(Message.timestamp.desc()).limit(50).all()
-
-            user_channel_ids = [cs.channel_id for cs in
-                                ChannelSubscriber.query.filter_by(user_id=current_user_id).all()]
-            channel_messages = Message.query.filter(
-                Message.content.ilike(f'%{query}%'),
-                Message.channel_id.in_(user_channel_ids)
-            ).order_by(Message.timestamp.desc()).limit(50).all()
-
-            results['messages'] = personal_messages + group_messages + channel_messages
+            results['messages'] = [message for message, snippet in search_messages(
+                query, visible_messages(current_user_id), limit=150)]
 
     return render_template('search.html',
                            current_user=get_current_user(),
@@ -111,38 +154,25 @@ def api_search():
 
     # Search groups
     if search_type in ['all', 'groups']:
-        groups = Group.query.filter(Group.name.ilike(f'%{query}%')).limit(10).all()
-        filtered_groups = []
-        for group in groups:
-            if group.is_public or GroupMember.query.filter_by(user_id=current_user_id, group_id=group.id).first():
-                filtered_groups.append({
-                    'id': group.id,
-                    'name': group.name,
-                    'description': group.description,
-                    'members_count': len(group.members),
-                    'type': 'group',
-                    'is_member': GroupMember.query.filter_by(user_id=current_user_id,
-                                                             group_id=group.id).first() is not None
-                })
-        results['groups'] = filtered_groups
+        results['groups'] = [{
+            'id': group.id,
+            'name': group.name,
+            'description': group.description,
+            'members_count': members_count,
+            'type': 'group',
+            'is_member': is_member
+        } for group, is_member, members_count in search_groups(query, current_user_id, limit=10)]
 
     # Search channels
     if search_type in ['all', 'channels']:
-        channels = Channel.query.filter(Channel.name.ilike(f'%{query}%')).limit(10).all()
-        filtered_channels = []
-        for channel in channels:
-            if channel.is_public or ChannelSubscriber.query.filter_by(user_id=current_user_id,
-                                                                      channel_id=channel.id).first():
-                filtered_channels.append({
-                    'id': channel.id,
-                    'name': channel.name,
-                    'description': channel.description,
-                    'subscribers_count': len(channel.subscribers),
-                    'type': 'channel',
-                    'is_subscribed': ChannelSubscriber.query.filter_by(user_id=current_user_id,
-                                                                       channel_id=channel.id).first() is not None
-                })
-        results['channels'] = filtered_channels
+        results['channels'] = [{
+            'id': channel.id,
+            'name': channel.name,
+            'description': channel.description,
+            'subscribers_count': subscribers_count,
+            'type': 'channel',
+            'is_subscribed': is_subscribed
+        } for channel, is_subscribed, subscribers_count in search_channels(query, current_user_id, limit=10)]
 
     return jsonify({'results': results})
 
@@ -159,62 +189,15 @@ def api_search_messages():
         return jsonify({'messages': []})
 
     current_user_id = get_current_user_id()
-    messages = []
-
-    if chat_type == 'all' or chat_type == 'personal':
-        personal_messages = Message.query.filter(
-            Message.content.ilike(f'%{query}%'),
-            Message.group_id.is_(None),
-            Message.channel_id.is_(None),
-            (
-                    (Message.sender_id == current_user_id) |
-                    (Message.receiver_id == current_user_id)
-            )
-        ).order_by(Message.timestamp.desc()).limit(50).all()
-        messages.extend(personal_messages)
-
-    if chat_type == 'all' or chat_type == 'group':
-        if chat_id:
-            group_messages = Message.query.filter(
-                Message.content.ilike(f'%{query}%'),
-                Message.group_id == chat_id
-            ).order_by(Message.timestamp.desc()).limit(50).all()
-            messages.extend(group_messages)
-        else:
-            user_group_ids = [gm.group_id for gm in GroupMember.query.filter_by(user_id=current_user_id).all()]
-            group_messages = Message.query.filter(
-                Message.content.ilike(f'%{query}%'),
-                Message.group_id.in_(user_group_ids)
-            ).order_by(Message.timestamp.desc()).limit(50).all()
-            messages.extend(group_messages)
-
-    if chat_type == 'all' or chat_type == 'channel':
-        if chat_id:
-            channel_messages = Message.query.filter(
-                Message.content.ilike(f'%{query}%'),
-                Message.channel_id == chat_id
-            ).order_by(Message.timestamp.desc()).limit(50).all()
-            messages.extend(channel_messages)
-        else:
-            user_channel_ids = [cs.channel_id for cs in
-                                ChannelSubscriber.query.filter_by(user_id=current_user_id).all()]
-            channel_messages = Message.query.filter(
-                Message.content.ilike(f'%{query}%'),
-                Message.channel_id.in_(user_channel_ids)
-            ).order_by(Message.timestamp.desc()).limit(50).all()
-            messages.extend(channel_messages)
-
-    seen_ids = set()
-    unique_messages = []
-    for message in messages:
-        if message.id not in seen_ids:
-            seen_ids.add(message.id)
-            unique_messages.append(message)
-
-    unique_messages.sort(key=lambda x: x.timestamp, reverse=True)
+    found = search_messages(query, visible_messages(current_user_id, chat_type, chat_id), limit=50)
+
+    usernames = load_usernames(
+        message.receiver_id if message.sender_id == current_user_id else message.sender_id
+        for message, snippet in found if not message.group_id and not message.channel_id
+    )
 
     messages_data = []
-    for message in unique_messages[:50]:
+    for message, snippet in found:
         context = "Personal"
         chat_name = ""
 
@@ -226,14 +209,14 @@ def api_search_messages():
             chat_name = message.channel.name
         else:
             other_user_id = message.receiver_id if message.sender_id == current_user_id else message.sender_id
-            other_user = User.query.get(other_user_id)
-            chat_name = other_user.username if other_user else "Unknown"
+            chat_name = usernames.get(other_user_id, "Unknown")
 
         messages_data.append({
             'id': message.id,
             'content': message.content,
+            'snippet': snippet,
             'sender_name': message.sender.username,
-            'timestamp': message.timestamp.strftime('%Y-%m-d %H:%M'),
+            'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M'),
             'context': context,
             'chat_name': chat_name,
             'chat_id': message.group_id or message.channel_id or (
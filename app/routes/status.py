@@ -1,7 +1,9 @@
-from flask import Blueprint, jsonify
-from app import db
-from app.models import Message, User
-from app.utils import get_current_user, get_current_user_id
+from flask import Blueprint, current_app, jsonify, request
+from app.models import User
+from app.utils import get_current_user, get_current_user_id, is_json_id
+from app.utils.read_state import read_marks
+from app.utils.cache import cache_stats
+from app.utils.feeds import channel_feeds, message_cache
 
 status_bp = Blueprint('status', __name__)
 
@@ -29,15 +31,23 @@ def mark_read(user_id):
     if not get_current_user():
         return jsonify({'error': 'Not authenticated'}), 401
 
-    current_user_id = get_current_user_id()
+    data = request.get_json(silent=True) or {}
+    message_id = data.get('message_id') if isinstance(data, dict) else None
+    if message_id is not None and not is_json_id(message_id):
+        return jsonify({'error': 'message_id must be a message id'}), 400
+    read_marks.mark(get_current_user_id(), 'personal', user_id, message_id)
 
-    # Mark all messages from this user as read
-    Message.query.filter_by(
-        sender_id=user_id,
-        receiver_id=current_user_id,
-        is_read=False
-    ).update({'is_read': True})
+    return jsonify({'success': True})
 
-    db.session.commit()
 
-    return jsonify({'success': True})
\ No newline at end of file
+@status_bp.route('/api/cache_stats')
+def api_cache_stats():
+    """Size and hit rate of the in-process caches; in debug mode or for ADMIN_USERS only"""
+    if not get_current_user():
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    if not current_app.debug and get_current_user() not in current_app.config['ADMIN_USERS']:
+        return jsonify({'error': 'Not authorized'}), 403
+
+    return jsonify({'caches': cache_stats(), 'channel_feeds': channel_feeds.stats(),
+                    'message_cache': message_cache.stats()})
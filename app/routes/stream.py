@@ -0,0 +1,91 @@
+from flask import Blueprint, Response, jsonify, current_app
+import json
+import time
+from app.utils import get_current_user, get_current_user_id
+from app.utils.sessions import is_group_member, is_channel_subscriber
+from app.utils.read_state import read_marks
+from app.utils.events import message_bus, dm_key, group_key, channel_key
+
+stream_bp = Blueprint('stream', __name__)
+
+# Seconds between keep-alive comments; also bounds how long a dead client holds a thread
+KEEPALIVE_INTERVAL = 15
+
+
+def may_read(key, user_id):
+    """Whether user_id may still read a conversation; group and channel members can leave or be removed"""
+    if key[0] == 'group':
+        return is_group_member(key[1], user_id)
+    if key[0] == 'channel':
+        return is_channel_subscriber(key[1], user_id)
+    return True
+
+
+def event_stream(key, current_user_id, app):
+    """Yield Server-Sent Events for every message published on key.
+
+    Membership is checked again every KEEPALIVE_INTERVAL, and the stream ends
+    once the user has left the group or channel.
+    """
+    subscription = message_bus.subscribe(key)
+    try:
+        yield 'retry: 3000\n\n'
+        checked = time.monotonic()
+        while not subscription.overflowed:
+            event = subscription.get(timeout=KEEPALIVE_INTERVAL)
+            if time.monotonic() - checked >= KEEPALIVE_INTERVAL:
+                with app.app_context():
+                    if not may_read(key, current_user_id):
+                        return
+                checked = time.monotonic()
+
+            if event is None:
+                yield ': keepalive\n\n'
+                continue
+
+            message_data = dict(event, is_own=event['sender_id'] == current_user_id)
+            # The open group/channel page shows it as it arrives; chat pages post their own marks
+            if key[0] in ('group', 'channel'):
+                read_marks.mark(current_user_id, key[0], key[1], event['id'])
+            yield f"id: {event['id']}\ndata: {json.dumps(message_data)}\n\n"
+    finally:
+        message_bus.unsubscribe(subscription)
+
+
+def sse_response(key, current_user_id):
+    app = current_app._get_current_object()
+    return Response(event_stream(key, current_user_id, app), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@stream_bp.route('/api/stream/messages/<int:user_id>')
+def stream_messages(user_id):
+    if not get_current_user():
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    current_user_id = get_current_user_id()
+    return sse_response(dm_key(current_user_id, user_id), current_user_id)
+
+
+@stream_bp.route('/api/stream/group_messages/<int:group_id>')
+def stream_group_messages(group_id):
+    if not get_current_user():
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    if not is_group_member(group_id):
+        return jsonify({'error': 'Not a member'}), 403
+
+    return sse_response(group_key(group_id), get_current_user_id())
+
+
+@stream_bp.route('/api/stream/channel_messages/<int:channel_id>')
+def stream_channel_messages(channel_id):
+    if not get_current_user():
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    if not is_channel_subscriber(channel_id):
+        return jsonify({'error': 'Not subscribed'}), 403
+
+    return sse_response(channel_key(channel_id), get_current_user_id())
@@ -6,6 +6,8 @@ from .helpers import (
     hash_password,
     get_current_user,
     get_current_user_id,
+    is_json_int,
+    is_json_id,
     generate_invite_link,
     allowed_file,
     get_file_type,
@@ -14,17 +16,67 @@ from .helpers import (
     highlight_text
 )
 
+from .passwords import (
+    verify_password,
+    password_hasher,
+    PasswordHasherBusy
+)
+
 from .bot_utils import (
     setup_bots,
     simulate_bot_interaction
 )
 
+from .events import (
+    message_bus,
+    publish_message
+)
+
+from .conversations import (
+    record_message,
+    unrecord_message,
+    mark_conversation_read,
+    add_conversation,
+    remove_conversation,
+    load_chat_list,
+    rebuild_conversations,
+    sync_conversations
+)
+
+from .migrations import migrate_database
+
+from .serializers import (
+    with_senders,
+    serialize_message,
+    serialize_messages,
+    load_usernames
+)
+
+from .message_writer import (
+    store_message,
+    message_writer
+)
+
+from .media import media_worker
+
+from .bot_engine import bot_engine
+from .telegram_bridge import telegram_bridge
+
+from .blobs import collect_garbage
+
+from .search_index import (
+    search_messages,
+    rebuild_search_index
+)
+
 # You can also add any initialization code here
 __all__ = [
     # From helpers
     'hash_password',
     'get_current_user',
     'get_current_user_id',
+    'is_json_int',
+    'is_json_id',
     'generate_invite_link',
     'allowed_file',
     'get_file_type',
@@ -32,7 +84,55 @@ __all__ = [
     'format_file_size',
     'highlight_text',
 
+    # From passwords
+    'verify_password',
+    'password_hasher',
+    'PasswordHasherBusy',
+
     # From bot_utils
     'setup_bots',
-    'simulate_bot_interaction'
+    'simulate_bot_interaction',
+
+    # From events
+    'message_bus',
+    'publish_message',
+
+    # From conversations
+    'record_message',
+    'unrecord_message',
+    'mark_conversation_read',
+    'add_conversation',
+    'remove_conversation',
+    'load_chat_list',
+    'rebuild_conversations',
+    'sync_conversations',
+
+    # From migrations
+    'migrate_database',
+
+    # From serializers
+    'with_senders',
+    'serialize_message',
+    'serialize_messages',
+    'load_usernames',
+
+    # From bot_engine
+    'bot_engine',
+
+    # From telegram_bridge
+    'telegram_bridge',
+
+    # From message_writer
+    'store_message',
+    'message_writer',
+
+    # From media
+    'media_worker',
+
+    # From blobs
+    'collect_garbage',
+
+    # From search_index
+    'search_messages',
+    'rebuild_search_index'
 ]
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""
+Content-addressed storage for attachments.
+
+Files are stored once per content as uploads/<images|media|documents>/<sha256>.<ext>,
+so the same file posted to many chats shares one copy on disk and one set of
+thumbnails. A blob's reference count is the number of Message rows whose
+file_path points at it; collect_garbage() removes blobs that reached zero.
+"""
+
+import glob
+import hashlib
+import os
+import threading
+
+from .helpers import get_file_type
+from .media import thumbnail_base
+
+BLOCK_SIZE = 64 * 1024
+
+# Held from store_blob() until the referencing message is committed, and by
+# collect_garbage(), so a blob can't be collected between being reused and referenced
+blob_lock = threading.RLock()
+
+
+def upload_dir_for(file_type):
+    if file_type == 'image':
+        return 'images'
+    if file_type in ['audio', 'video']:
+        return 'media'
+    return 'documents'
+
+
+def save_stream(stream, path):
+    """Copy a file-like object to path in blocks, returning its sha256 hex digest"""
+    hasher = hashlib.sha256()
+    with open(path, 'wb') as f:
+        for block in iter(lambda: stream.read(BLOCK_SIZE), b''):
+            hasher.update(block)
+            f.write(block)
+    return hasher.hexdigest()
+
+
+def file_digest(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def store_blob(source_path, filename, digest=None):
+    """Move a finished file into the blob store (call while holding blob_lock).
+
+    Returns (file_type, file_path). If the same content is already stored the
+    source is discarded and the existing blob is reused.
+    """
+    file_type = get_file_type(filename)
+    ext = filename.rsplit('.', 1)[1].lower()
+    digest = digest or file_digest(source_path)
+
+    file_path = f"uploads/{upload_dir_for(file_type)}/{digest}.{ext}"
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    if os.path.exists(file_path):
+        os.remove(source_path)
+    else:
+        os.replace(source_path, file_path)
+    return file_type, file_path
+
+
+def blob_references(file_path):
+    from app.models import Message
+    return Message.query.filter_by(file_path=file_path).count()
+
+
+def shared_thumbnails(file_path):
+    """A finished thumbnail job of another message with the same blob, if any (a pending one
+    is shared by media_worker, which updates every message of the blob when it finishes)"""
+    from app.models import Message
+    from .media import STATUS_READY
+
+    return Message.query.filter_by(file_path=file_path, thumbnail_status=STATUS_READY).first()
+
+
+def attachment_paths(query):
+    """Distinct blob paths referenced by the messages of a query (collect before deleting them)"""
+    from app.models import Message
+
+    return {path for (path,) in query.filter(Message.file_path.isnot(None)).with_entities(
+        Message.file_path).distinct()}
+
+
+def collect_garbage(file_paths):
+    """Delete the blobs (and their thumbnails) no message refers to any more. Call after commit."""
+    removed = 0
+    with blob_lock:
+        for file_path in set(file_paths):
+            if not file_path or blob_references(file_path):
+                continue
+            for path in [file_path] + glob.glob(glob.escape(thumbnail_base(file_path)) + '[._]*'):
+                if os.path.exists(path):
+                    os.remove(path)
+                    removed += 1
+    return removed
@@ -0,0 +1,304 @@
+"""
+Event-driven bot replies.
+
+The engine listens on message_bus, so every committed personal message is
+seen the moment it is published. Each active bot has its own worker thread
+and queue, so a slow or failing handler only delays its own bot. A worker
+answers queued messages in batches: handlers run outside any transaction,
+then the batch is claimed and all replies are inserted in one commit.
+Per-bot rate limits and error budgets come from the handler classes in
+app.utils.bot_handlers. Idle bots cost nothing: there is no polling.
+"""
+
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import update
+
+from .bot_handlers import BotMessage, handler_for
+
+
+class RateLimiter:
+    """Token bucket: `rate` tokens per second, holding at most `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, count):
+        """Take up to `count` whole tokens and return how many were taken"""
+        self._refill()
+        taken = min(count, int(self.tokens))
+        self.tokens -= taken
+        return taken
+
+    def wait_time(self):
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class ErrorBudget:
+    """Suspends a bot for `cooldown` seconds once `budget` failures happen within `window` seconds"""
+
+    def __init__(self, budget, window, cooldown):
+        self.budget = budget
+        self.window = window
+        self.cooldown = cooldown
+        self.failures = deque()
+        self.suspended_until = 0.0
+
+    def record_failure(self):
+        now = time.monotonic()
+        self.failures.append(now)
+        while self.failures and self.failures[0] < now - self.window:
+            self.failures.popleft()
+        if len(self.failures) >= self.budget:
+            self.failures.clear()
+            self.suspended_until = now + self.cooldown
+
+    def suspended_for(self):
+        return max(0.0, self.suspended_until - time.monotonic())
+
+
+class BotWorker:
+    """Queue and thread answering the messages of one bot"""
+
+    def __init__(self, engine, bot_user_id, handler):
+        self.engine = engine
+        self.bot_user_id = bot_user_id
+        self.handler = handler
+        self.limiter = RateLimiter(handler.rate, handler.burst)
+        self.errors = ErrorBudget(handler.error_budget, handler.error_window, handler.cooldown)
+        self._queue = deque()
+        self._queued = set()
+        self._wake = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._loop, name=f'bot-{handler.username}', daemon=True)
+        self._thread.start()
+
+    def put(self, message_id):
+        with self._wake:
+            if message_id not in self._queued:
+                self._queued.add(message_id)
+                self._queue.append(message_id)
+                self._wake.notify()
+
+    def stop(self, wait=True):
+        with self._wake:
+            self._stopping = True
+            self._wake.notify()
+        if wait:
+            self._thread.join()
+
+    def _next_batch(self):
+        """Wait until queued messages may be answered; None once stopped"""
+        with self._wake:
+            while not self._stopping:
+                delay = None
+                if self._queue:
+                    delay = self.errors.suspended_for()
+                    if not delay:
+                        count = self.limiter.take(min(len(self._queue), self.engine.batch_size))
+                        if count:
+                            batch = [self._queue.popleft() for _ in range(count)]
+                            self._queued.difference_update(batch)
+                            return batch
+                        delay = self.limiter.wait_time()
+                self._wake.wait(delay)
+            return None
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self.engine.handle_batch(self, batch)
+            except Exception as e:
+                self.errors.record_failure()
+                print(f"Bot {self.handler.username} failed on messages {batch}: {e}")
+
+
+class BotEngine:
+    def __init__(self):
+        self.app = None
+        self.batch_size = 20
+        self._lock = threading.Lock()
+        self._bots = None  # bot user id -> bot username, loaded on first use
+        self._workers = {}
+        self._running = False
+        self._listening = False
+
+    def start(self, app):
+        """Start answering bot messages, including any left unanswered while stopped"""
+        self.app = app
+        self.batch_size = app.config.get('BOT_BATCH_SIZE', self.batch_size)
+
+        with self._lock:
+            self._running = True
+            listening, self._listening = self._listening, True
+
+        if not listening:
+            from app.utils.events import message_bus
+            message_bus.listen(self._on_publish)
+
+        self.catch_up()
+
+    def refresh(self):
+        """Forget the cached bot user ids (after bots are added or changed)"""
+        with self._lock:
+            self._bots = None
+
+    def bot_users(self):
+        """Map of active bot user id -> bot username"""
+        with self._lock:
+            bots = self._bots
+        if bots is not None:
+            return bots
+
+        from app import db
+        from app.models import TelegramBot, User
+
+        with self.app.app_context():
+            try:
+                bots = dict(db.session.query(User.id, TelegramBot.username).join(
+                    TelegramBot, TelegramBot.username == User.username
+                ).filter(TelegramBot.is_active.is_(True)).all())
+            finally:
+                db.session.remove()
+
+        with self._lock:
+            self._bots = bots
+        return bots
+
+    def catch_up(self):
+        """Queue unread messages to bots, e.g. ones sent while the server was down"""
+        from app import db
+        from app.models import Message
+
+        bots = self.bot_users()
+        if not bots:
+            return 0
+
+        with self.app.app_context():
+            try:
+                pending = db.session.query(Message.id, Message.receiver_id).filter(
+                    Message.receiver_id.in_(list(bots)),
+                    Message.sender_id.notin_(list(bots)),
+                    Message.is_read.is_(False),
+                    Message.group_id.is_(None),
+                    Message.channel_id.is_(None)
+                ).order_by(Message.id).all()
+            finally:
+                db.session.remove()
+
+        for message_id, bot_user_id in pending:
+            self.dispatch(bot_user_id, message_id)
+        return len(pending)
+
+    def _on_publish(self, key, event):
+        # Only personal chats; the key holds both participants
+        if key[0] != 'dm' or not self._running:
+            return
+
+        bots = self.bot_users()
+        sender_id = event['sender_id']
+        receiver_id = key[2] if key[1] == sender_id else key[1]
+        if receiver_id in bots and sender_id not in bots:
+            self.dispatch(receiver_id, event['id'])
+
+    def worker(self, bot_user_id):
+        """The bot's worker, started on its first message"""
+        bot_username = self.bot_users().get(bot_user_id)
+        if bot_username is None:
+            return None
+
+        with self._lock:
+            worker = self._workers.get(bot_user_id)
+            if worker is None and self._running:
+                worker = self._workers[bot_user_id] = BotWorker(self, bot_user_id, handler_for(bot_username))
+        return worker
+
+    def dispatch(self, bot_user_id, message_id):
+        """Queue a message for its bot's worker"""
+        worker = self.worker(bot_user_id)
+        if worker is not None:
+            worker.put(message_id)
+
+    def handle_batch(self, worker, message_ids):
+        """Answer a batch of messages to one bot and commit all replies at once"""
+        from app import db
+        from app.models import Message
+        from app.utils.conversations import record_message, mark_conversation_read
+        from app.utils.events import publish_message
+
+        handler = worker.handler
+        with self.app.app_context():
+            try:
+                messages = [BotMessage(*row) for row in db.session.query(
+                    Message.id, Message.sender_id, Message.content
+                ).filter(Message.id.in_(message_ids), Message.is_read.is_(False)).order_by(Message.id)]
+                # Don't hold the database while handlers run
+                db.session.rollback()
+
+                replies = {}
+                for message in messages:
+                    try:
+                        replies[message.id] = handler.reply(message)
+                    except Exception as e:
+                        print(f"Bot {handler.username} error on message {message.id}: {e}")
+                        worker.errors.record_failure()
+                        replies[message.id] = handler.failure_reply
+                if not replies:
+                    return
+
+                # Claim the messages; a concurrent catch-up or another process may have answered some
+                claimed = set(db.session.execute(
+                    update(Message).where(Message.id.in_(list(replies)), Message.is_read.is_(False))
+                    .values(is_read=True).returning(Message.id),
+                    execution_options={'synchronize_session': False}
+                ).scalars())
+
+                responses = [Message(
+                    content=replies[message.id],
+                    sender_id=worker.bot_user_id,
+                    receiver_id=message.sender_id,
+                    is_from_telegram=True
+                ) for message in messages if message.id in claimed]
+                if not responses:
+                    db.session.rollback()
+                    return
+
+                db.session.add_all(responses)
+                db.session.flush()
+                for sender_id in {message.sender_id for message in messages if message.id in claimed}:
+                    mark_conversation_read(worker.bot_user_id, sender_id)
+                for response in responses:
+                    record_message(response)
+                db.session.commit()
+
+                for response in responses:
+                    publish_message(response)
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._running = False
+            workers, self._workers = list(self._workers.values()), {}
+        for worker in workers:
+            worker.stop(wait=wait)
+
+
+bot_engine = BotEngine()
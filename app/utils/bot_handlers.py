@@ -0,0 +1,87 @@
+"""
+What each bot answers, one handler class per TelegramBot username.
+
+Handlers are registered with @bot_handler('username'); active bots without a
+registered class get the generic BotHandler. Besides reply(), a class sets
+the limits bot_engine enforces for its bot: how many replies per second it
+may send (rate, burst) and how many failures within error_window seconds
+suspend it for cooldown seconds.
+"""
+
+from collections import namedtuple
+
+# The part of a Message a handler gets; plain values, so handlers run outside any db session
+BotMessage = namedtuple('BotMessage', ['id', 'sender_id', 'content'])
+
+_handlers = {}
+
+
+def bot_handler(username):
+    """Register a handler class for the bot with this username"""
+    def register(cls):
+        _handlers[username] = cls
+        return cls
+    return register
+
+
+def handler_for(username):
+    return _handlers.get(username, BotHandler)(username)
+
+
+class BotHandler:
+    rate = 5.0  # replies per second
+    burst = 10
+    error_budget = 5
+    error_window = 60  # seconds
+    cooldown = 30  # seconds a bot is suspended after using up its error budget
+
+    failure_reply = "⚠️ Something went wrong, please try again later."
+
+    def __init__(self, username):
+        self.username = username
+
+    def reply(self, message):
+        """Text to answer a BotMessage with"""
+        return "🤖 I'm a bot. How can I help you?"
+
+
+@bot_handler('weather_bot')
+class WeatherBot(BotHandler):
+    def reply(self, message):
+        return "Will be soon! Ask Ilya for the weather!"
+
+
+@bot_handler('news_bot')
+class NewsBot(BotHandler):
+    def reply(self, message):
+        return "📰 Breaking: Kiselgram now supports media sending! Stay tuned for more updates and also subscribe to our telegram channel: t.me/KiseIgram"
+
+
+@bot_handler('calc_bot')
+class CalculatorBot(BotHandler):
+    usage = "Try something like '2+2' or '5*3'."
+
+    def reply(self, message):
+        """One result, or one line per expression for multi-line messages"""
+        from app.utils.calculator import evaluate_batch, CalculationError
+
+        try:
+            results = evaluate_batch(message.content or '')
+        except CalculationError as e:
+            return f"❌ {e}"
+
+        if not results:
+            return f"❌ I can only do simple math calculations. {self.usage}"
+        if len(results) == 1:
+            expression, result, error = results[0]
+            return f"🧮 Result: {result}" if error is None else f"❌ {error}. {self.usage}"
+
+        lines = [f"{expression} = {result}" if error is None else f"{expression}: ❌ {error}"
+                 for expression, result, error in results]
+        return "🧮 Results:\n" + "\n".join(lines)
+
+
+@bot_handler('kiselgram_bot')
+class HelpBot(BotHandler):
+    def reply(self, message):
+        return "🤖 Welcome to Kiselgram Help! I can assist you with using groups, channels, and other features. What do you need help with?"
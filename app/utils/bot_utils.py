@@ -1,12 +1,6 @@
-import time
-import threading
 import secrets
 
-
-def hash_password(password):
-    """Helper function for hashing passwords"""
-    import hashlib
-    return hashlib.sha256(password.encode()).hexdigest()
+from .passwords import hash_password
 
 
 def setup_bots():
@@ -36,58 +30,15 @@ def setup_bots():
 
     db.session.commit()
 
+    from app.utils.bot_engine import bot_engine
+    bot_engine.refresh()
 
-def simulate_bot_interaction(app):
-    """Simulate bot responses for demonstration - pass app instance"""
-    while True:
-        try:
-            # Use the provided app context
-            with app.app_context():
-                from app import db
-                from app.models import TelegramBot, User, Message
-
-                bots = TelegramBot.query.filter_by(is_active=True).all()
-
-                for bot in bots:
-                    bot_user = User.query.filter_by(username=bot.username).first()
-                    if not bot_user:
-                        continue
-
-                    unread_messages = Message.query.filter_by(
-                        receiver_id=bot_user.id,
-                        is_read=False
-                    ).all()
 
-                    for message in unread_messages:
-                        message.is_read = True
-
-                        if bot.username == 'weather_bot':
-                            response = "Will be soon! Ask Ilya for the weather!"
-                        elif bot.username == 'news_bot':
-                            response = "📰 Breaking: Kiselgram now supports media sending! Stay tuned for more updates and also subscribe to our telegram channel: t.me/KiseIgram"
-                        elif bot.username == 'calc_bot':
-                            try:
-                                result = eval(message.content)
-                                response = f"🧮 Result: {result}"
-                            except:
-                                response = "❌ I can only do simple math calculations. Try something like '2+2' or '5*3'."
-                        elif bot.username == 'kiselgram_bot':
-                            response = "🤖 Welcome to Kiselgram Help! I can assist you with using groups, channels, and other features. What do you need help with?"
-                        else:
-                            response = "🤖 I'm a bot. How can I help you?"
-
-                        bot_response = Message(
-                            content=response,
-                            sender_id=bot_user.id,
-                            receiver_id=message.sender_id,
-                            is_from_telegram=True
-                        )
-                        db.session.add(bot_response)
-
-                db.session.commit()
-
-            time.sleep(5)
+def simulate_bot_interaction(app):
+    """Start answering bot messages - pass app instance.
 
-        except Exception as e:
-            print(f"Bot simulation error: {e}")
-            time.sleep(10)
\ No newline at end of file
+    Kept under its old name for existing runners; bots are now driven by
+    new messages through app.utils.bot_engine instead of a polling loop.
+    """
+    from app.utils.bot_engine import bot_engine
+    bot_engine.start(app)
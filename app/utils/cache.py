@@ -0,0 +1,110 @@
+"""
+Small in-process caches with hit-rate metrics.
+
+LRUCache is a thread-safe LRU map with an optional TTL. get_or_load() fills
+it from a loader, and never stores a value loaded while an invalidation was
+running, so a slow loader can't put stale data back. Every cache registers
+itself by name, and cache_stats() reports hits, misses and evictions for all
+of them (served at /api/cache_stats).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+_caches = {}
+
+
+class LRUCache:
+    def __init__(self, name, maxsize=1024, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, stored at)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _caches[name] = self
+
+    def configure(self, maxsize=None, ttl=None):
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl or None
+            self._evict()
+
+    def _evict(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def _lookup(self, key):
+        entry = self._data.get(key)
+        if entry is not None and self.ttl and time.monotonic() - entry[1] > self.ttl:
+            del self._data[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return _MISSING
+        self.hits += 1
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            self._evict()
+
+    def get_or_load(self, key, loader):
+        """Cached value of key, calling loader(key) on a miss; None results are not cached"""
+        with self._lock:
+            value = self._lookup(key)
+            generation = self._generation
+        if value is not _MISSING:
+            return value
+
+        value = loader(key)
+        if value is not None:
+            with self._lock:
+                if generation == self._generation:
+                    self._data[key] = (value, time.monotonic())
+                    self._evict()
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in _caches.items()}
@@ -0,0 +1,186 @@
+"""
+Safe arithmetic for calc_bot.
+
+Expressions are parsed with ast and only whitelisted nodes are evaluated.
+Every operation is checked before it runs so no single step can produce a
+huge number (9**9**9 is rejected up front instead of computed), and the
+whole evaluation has a node budget and a CPU deadline checked between steps.
+"""
+
+import ast
+import math
+import operator
+import time
+
+MAX_EXPRESSION_LENGTH = 200
+MAX_NODES = 200
+MAX_EXPONENT = 10000
+MAX_RESULT_BITS = 4096
+TIME_LIMIT = 0.05  # seconds of CPU per expression
+MAX_BATCH = 10
+MAX_ROUND_DIGITS = 100
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+
+def _round(number, *ndigits):
+    """round() with a bounded ndigits: rounding an int to -n digits computes 10**n first"""
+    if ndigits and isinstance(ndigits[0], int) and abs(ndigits[0]) > MAX_ROUND_DIGITS:
+        raise CalculationError(f'round() takes at most {MAX_ROUND_DIGITS} digits')
+    return round(number, *ndigits)
+
+
+FUNCTIONS = {
+    'abs': abs,
+    'round': _round,
+    'min': min,
+    'max': max,
+    'sqrt': math.sqrt,
+    'sin': math.sin,
+    'cos': math.cos,
+    'tan': math.tan,
+    'log': math.log,
+    'log10': math.log10,
+    'exp': math.exp,
+}
+
+CONSTANTS = {
+    'pi': math.pi,
+    'e': math.e,
+}
+
+
+class CalculationError(ValueError):
+    pass
+
+
+def _bits(value):
+    """Size of a number in bits; floats are already bounded"""
+    return abs(value).bit_length() if isinstance(value, int) else 64
+
+
+def _check_size(value):
+    if isinstance(value, complex):
+        # A negative base to a fractional power, e.g. (-8)**0.5
+        raise CalculationError('Result is not a real number')
+    if isinstance(value, float) and not math.isfinite(value):
+        raise CalculationError('Result too large')
+    if isinstance(value, int) and value.bit_length() > MAX_RESULT_BITS:
+        raise CalculationError('Result too large')
+    return value
+
+
+class _Evaluator:
+    def __init__(self):
+        self.nodes = 0
+        self.deadline = time.thread_time() + TIME_LIMIT
+
+    def visit(self, node):
+        self.nodes += 1
+        if self.nodes > MAX_NODES:
+            raise CalculationError('Expression too long')
+        if time.thread_time() > self.deadline:
+            raise CalculationError('Calculation took too long')
+
+        if isinstance(node, ast.Expression):
+            return self.visit(node.body)
+
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                raise CalculationError('Only numbers are supported')
+            return _check_size(node.value)
+
+        if isinstance(node, ast.Name):
+            if node.id not in CONSTANTS:
+                raise CalculationError(f"Unknown name '{node.id}'")
+            return CONSTANTS[node.id]
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            return _check_size(UNARY_OPERATORS[type(node.op)](self.visit(node.operand)))
+
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            left = self.visit(node.left)
+            right = self.visit(node.right)
+            return _check_size(self.apply(type(node.op), left, right))
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS:
+            if node.keywords or len(node.args) > 5:
+                raise CalculationError('Unsupported function call')
+            args = [self.visit(arg) for arg in node.args]
+            if any(_bits(arg) > 1024 for arg in args):
+                raise CalculationError('Argument too large')
+            return _check_size(FUNCTIONS[node.func.id](*args))
+
+        raise CalculationError('Unsupported expression')
+
+    def apply(self, op, left, right):
+        if op is ast.Pow:
+            if abs(right) > MAX_EXPONENT:
+                raise CalculationError('Exponent too large')
+            # a**n has at least (bits(a) - 1) * n + 1 bits; refuse before computing it
+            if isinstance(left, int) and isinstance(right, int) and right > 0 and \
+                    (_bits(left) - 1) * right + 1 > MAX_RESULT_BITS:
+                raise CalculationError('Result too large')
+        elif op is ast.Mult and isinstance(left, int) and isinstance(right, int):
+            if _bits(left) + _bits(right) > MAX_RESULT_BITS:
+                raise CalculationError('Result too large')
+        return BINARY_OPERATORS[op](left, right)
+
+
+def evaluate(expression):
+    """Evaluate one arithmetic expression, raising CalculationError on anything unsafe or invalid"""
+    expression = expression.strip().replace('^', '**').replace('×', '*').replace('÷', '/')
+    if not expression:
+        raise CalculationError('Empty expression')
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise CalculationError('Expression too long')
+
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError:
+        raise CalculationError('Invalid expression')
+
+    try:
+        return _Evaluator().visit(tree)
+    except ZeroDivisionError:
+        raise CalculationError('Division by zero')
+    except (OverflowError, ValueError, TypeError) as e:
+        if isinstance(e, CalculationError):
+            raise
+        raise CalculationError('Math error')
+
+
+def format_result(value):
+    if isinstance(value, float):
+        if value.is_integer() and abs(value) < 1e15:
+            return str(int(value))
+        return f'{value:.12g}'
+    return str(value)
+
+
+def evaluate_batch(text):
+    """Evaluate one expression per line (or separated by ';'). Returns [(expression, result, error)]."""
+    expressions = [part.strip() for line in text.splitlines() for part in line.split(';') if part.strip()]
+    if len(expressions) > MAX_BATCH:
+        raise CalculationError(f'At most {MAX_BATCH} expressions per message')
+
+    results = []
+    for expression in expressions:
+        try:
+            results.append((expression, format_result(evaluate(expression)), None))
+        except CalculationError as e:
+            results.append((expression, None, str(e)))
+    return results
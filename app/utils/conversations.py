@@ -0,0 +1,242 @@
+"""
+Maintenance of the denormalized Conversation summaries behind the chat list.
+
+Every function here only stages changes on db.session; callers commit them
+together with the message or membership change that caused them.
+"""
+
+from sqlalchemy import func, select, insert, update, delete, literal, case, union_all
+
+
+def _latest_message(chat_type, peer_id, exclude_id=None):
+    from app.models import Message
+
+    column = Message.group_id if chat_type == 'group' else Message.channel_id
+    return Message.query.filter(column == peer_id, Message.id != exclude_id).order_by(Message.id.desc()).first()
+
+
+def _touch_personal(user_id, peer_id, message, unread):
+    from app import db
+    from app.models import Conversation
+
+    conversation = Conversation.query.filter_by(user_id=user_id, chat_type='personal', peer_id=peer_id).first()
+    if conversation is None:
+        db.session.add(Conversation(
+            user_id=user_id,
+            chat_type='personal',
+            peer_id=peer_id,
+            last_message_id=message.id,
+            last_timestamp=message.timestamp,
+            unread_count=1 if unread else 0
+        ))
+        return
+
+    conversation.last_message_id = message.id
+    conversation.last_timestamp = message.timestamp
+    if unread:
+        # Increment in SQL so concurrent senders don't lose counts
+        conversation.unread_count = Conversation.unread_count + 1
+
+
+def record_message(message):
+    """Point the affected conversations at a new message (call after flush)"""
+    from app.models import Conversation
+
+    if message.group_id or message.channel_id:
+        chat_type = 'group' if message.group_id else 'channel'
+        Conversation.query.filter_by(
+            chat_type=chat_type,
+            peer_id=message.group_id or message.channel_id
+        ).update({
+            'last_message_id': message.id,
+            'last_timestamp': message.timestamp,
+            'unread_count': Conversation.unread_count + case((Conversation.user_id != message.sender_id, 1), else_=0)
+        }, synchronize_session=False)
+    elif message.sender_id != message.receiver_id:
+        _touch_personal(message.sender_id, message.receiver_id, message, unread=False)
+        _touch_personal(message.receiver_id, message.sender_id, message, unread=True)
+
+
+def unrecord_message(message):
+    """Point conversations whose last message is being deleted at the previous one (call before deleting it)"""
+    from app.models import Conversation, Message
+
+    if message.group_id or message.channel_id:
+        chat_type = 'group' if message.group_id else 'channel'
+        peer_ids = [(None, message.group_id or message.channel_id)]
+        latest = _latest_message(chat_type, message.group_id or message.channel_id, exclude_id=message.id)
+    else:
+        chat_type = 'personal'
+        peer_ids = [(message.sender_id, message.receiver_id), (message.receiver_id, message.sender_id)]
+        latest = Message.query.filter(
+            Message.id != message.id,
+            Message.group_id.is_(None),
+            Message.channel_id.is_(None),
+            ((Message.sender_id == message.sender_id) & (Message.receiver_id == message.receiver_id)) |
+            ((Message.sender_id == message.receiver_id) & (Message.receiver_id == message.sender_id))
+        ).order_by(Message.id.desc()).first()
+
+    for user_id, peer_id in peer_ids:
+        query = Conversation.query.filter_by(chat_type=chat_type, peer_id=peer_id)
+        if user_id is not None:
+            query = query.filter_by(user_id=user_id)
+        query.filter_by(last_message_id=message.id).update({
+            'last_message_id': latest.id if latest else None,
+            'last_timestamp': latest.timestamp if latest else None
+        }, synchronize_session=False)
+
+    # Unread for whoever hadn't read up to it yet
+    unread = Conversation.query.filter(
+        Conversation.chat_type == chat_type,
+        Conversation.unread_count > 0,
+        func.coalesce(Conversation.last_read_message_id, 0) < message.id
+    )
+    if chat_type == 'personal':
+        unread = unread.filter_by(user_id=message.receiver_id, peer_id=message.sender_id)
+    else:
+        unread = unread.filter(Conversation.peer_id == (message.group_id or message.channel_id),
+                               Conversation.user_id != message.sender_id)
+    if chat_type != 'personal' or message.sender_id != message.receiver_id:
+        unread.update({'unread_count': Conversation.unread_count - 1}, synchronize_session=False)
+
+
+def mark_conversation_read(user_id, peer_id, chat_type='personal', message_id=None):
+    """Move a user's read mark up to message_id (default: the last message) right away.
+
+    Request handlers use read_state.read_marks instead, which batches the writes.
+    """
+    from app.utils.read_state import apply_read_marks
+    apply_read_marks([(user_id, chat_type, peer_id, message_id)])
+
+
+def add_conversation(user_id, chat_type, peer_id):
+    """Add a group or channel to a user's chat list after joining or creating it"""
+    from app import db
+    from app.models import Conversation
+
+    if Conversation.query.filter_by(user_id=user_id, chat_type=chat_type, peer_id=peer_id).first():
+        return
+
+    last_message = _latest_message(chat_type, peer_id)
+    db.session.add(Conversation(
+        user_id=user_id,
+        chat_type=chat_type,
+        peer_id=peer_id,
+        last_message_id=last_message.id if last_message else None,
+        last_timestamp=last_message.timestamp if last_message else None,
+        unread_count=0,
+        last_read_message_id=last_message.id if last_message else None
+    ))
+
+
+def remove_conversation(chat_type, peer_id, user_id=None):
+    """Drop one user's entry, or every entry when the group/channel itself is deleted"""
+    from app.models import Conversation
+
+    query = Conversation.query.filter_by(chat_type=chat_type, peer_id=peer_id)
+    if user_id is not None:
+        query = query.filter_by(user_id=user_id)
+    query.delete(synchronize_session=False)
+
+
+def load_chat_list(user_id, chat_type=None):
+    """Return (Conversation, name) pairs for a user's chat list, most recent activity first"""
+    from app import db
+    from app.models import Conversation, Message, User, Group, Channel
+
+    query = db.session.query(
+        Conversation,
+        func.coalesce(User.username, Group.name, Channel.name)
+    ).outerjoin(
+        User, (Conversation.chat_type == 'personal') & (User.id == Conversation.peer_id)
+    ).outerjoin(
+        Group, (Conversation.chat_type == 'group') & (Group.id == Conversation.peer_id)
+    ).outerjoin(
+        Channel, (Conversation.chat_type == 'channel') & (Channel.id == Conversation.peer_id)
+    ).options(
+        db.joinedload(Conversation.last_message).joinedload(Message.sender)
+    ).filter(
+        Conversation.user_id == user_id
+    )
+    if chat_type is not None:
+        query = query.filter(Conversation.chat_type == chat_type)
+
+    return query.order_by(Conversation.last_timestamp.desc().nullslast(), Conversation.id.desc()).all()
+
+
+def rebuild_conversations():
+    """Recompute every Conversation row from Message and the membership tables in SQL"""
+    from app import db
+    from app.models import Conversation, Message, GroupMember, ChannelSubscriber
+    from app.utils.read_state import apply_read_marks, backfill_read_marks
+
+    # Read marks can't be derived from messages; carry them over
+    read_marks = db.session.query(Conversation.user_id, Conversation.chat_type, Conversation.peer_id,
+                                  Conversation.last_read_message_id).filter(
+        Conversation.last_read_message_id.isnot(None)).all()
+    db.session.execute(delete(Conversation))
+
+    personal = (Message.group_id.is_(None), Message.channel_id.is_(None), Message.sender_id != Message.receiver_id)
+    sent = select(
+        Message.sender_id.label('user_id'),
+        Message.receiver_id.label('peer_id'),
+        func.max(Message.id).label('last_id'),
+        literal(0).label('unread')
+    ).where(*personal).group_by(Message.sender_id, Message.receiver_id)
+    received = select(
+        Message.receiver_id,
+        Message.sender_id,
+        func.max(Message.id),
+        func.sum(case((Message.is_read.is_(False), 1), else_=0))
+    ).where(*personal).group_by(Message.receiver_id, Message.sender_id)
+    pairs = union_all(sent, received).subquery()
+
+    columns = ['user_id', 'chat_type', 'peer_id', 'last_message_id', 'unread_count']
+    db.session.execute(insert(Conversation).from_select(columns, select(
+        pairs.c.user_id,
+        literal('personal'),
+        pairs.c.peer_id,
+        func.max(pairs.c.last_id),
+        func.sum(pairs.c.unread)
+    ).group_by(pairs.c.user_id, pairs.c.peer_id)))
+
+    for chat_type, membership, column in (('group', GroupMember, 'group_id'),
+                                          ('channel', ChannelSubscriber, 'channel_id')):
+        peer_id = getattr(membership, column)
+        last_id = select(func.max(Message.id)).where(getattr(Message, column) == peer_id).scalar_subquery()
+        db.session.execute(insert(Conversation).from_select(columns, select(
+            membership.user_id,
+            literal(chat_type),
+            peer_id,
+            last_id,
+            literal(0)
+        )))
+
+    db.session.execute(update(Conversation).where(Conversation.last_message_id.isnot(None)).values(
+        last_timestamp=select(Message.timestamp).where(
+            Message.id == Conversation.last_message_id).scalar_subquery()
+    ))
+    apply_read_marks([tuple(mark) for mark in read_marks])
+    backfill_read_marks()
+
+    db.session.commit()
+    return db.session.execute(select(func.count(Conversation.id))).scalar()
+
+
+def sync_conversations():
+    """Backfill the chat list summaries for databases created before they existed.
+
+    Runs as a migration, so it only selects id columns: whole rows would
+    name columns that later migrations add.
+    """
+    from app import db
+    from app.models import Conversation, Message, GroupMember, ChannelSubscriber
+
+    def any_rows(model):
+        return db.session.execute(select(model.id).limit(1)).first() is not None
+
+    if any_rows(Conversation):
+        return 0
+    if not (any_rows(Message) or any_rows(GroupMember) or any_rows(ChannelSubscriber)):
+        return 0
+    return rebuild_conversations()
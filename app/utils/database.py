@@ -0,0 +1,98 @@
+"""
+SQLite engine profiles.
+
+With SQLite's defaults every commit fsyncs the rollback journal, and a
+writer locks out readers for the length of its transaction. Request
+threads, bot workers and the Telegram bridge all write to the same file, so
+under load they fail with "database is locked". DB_PROFILE selects how
+connections are set up:
+
+- 'default' leaves SQLite and pysqlite as they are.
+- 'production' sets the profile's PRAGMAs on every new connection from the
+  engine's connect event, and gives the pool room for the background
+  threads. The PRAGMAs: WAL, so readers don't block the writer;
+  synchronous=NORMAL, so commits don't fsync (only checkpoints do);
+  memory-mapped reads; a busy timeout, so writers queue instead of failing;
+  and a larger page cache.
+
+Profiles only apply to SQLite URLs; other databases keep their defaults.
+"""
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+SQLITE_PROFILES = {
+    'default': {
+        'pragmas': {},
+        'pool': {},
+    },
+    'production': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'mmap_size': 256 * 1024 * 1024,
+            'busy_timeout': 5000,  # ms
+            'cache_size': -64 * 1024,  # negative: KiB, i.e. 64 MiB per connection
+            'temp_store': 'MEMORY',
+        },
+        'pool': {
+            'pool_size': 10,
+            'max_overflow': 20,
+        },
+    },
+}
+
+
+def _is_sqlite(uri):
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+
+def _is_memory(uri):
+    database = make_url(uri).database
+    return not database or database == ':memory:' or 'mode=memory' in str(uri)
+
+
+def get_profile(name):
+    try:
+        return SQLITE_PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Unknown DB_PROFILE {name!r}, expected one of {', '.join(SQLITE_PROFILES)}")
+
+
+def engine_options(uri, profile_name):
+    """SQLALCHEMY_ENGINE_OPTIONS for a profile (pool sizes only fit file databases)"""
+    profile = get_profile(profile_name)
+    if not _is_sqlite(uri) or _is_memory(uri):
+        return {}
+
+    options = dict(profile['pool'])
+    busy_timeout = profile['pragmas'].get('busy_timeout')
+    if busy_timeout is not None:
+        # pysqlite's own lock wait, in seconds; kept in line with the PRAGMA
+        options['connect_args'] = {'timeout': busy_timeout / 1000}
+    return options
+
+
+def apply_profile(engine, profile_name):
+    """Run the profile's PRAGMAs on every new DBAPI connection of engine"""
+    pragmas = get_profile(profile_name)['pragmas']
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name} = {value}')
+        finally:
+            cursor.close()
+
+
+def sqlite_settings(engine):
+    """Current values of the tuned PRAGMAs on one connection, for checking a deployment"""
+    if engine.dialect.name != 'sqlite':
+        return {}
+    names = SQLITE_PROFILES['production']['pragmas']
+    with engine.connect() as connection:
+        return {name: connection.exec_driver_sql(f'PRAGMA {name}').scalar() for name in names}
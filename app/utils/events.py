@@ -0,0 +1,182 @@
+import queue
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+# Seconds a conversation's newest id is kept once nobody waits on it; covers the
+# gap between a long-poll's fetch and the start of its wait
+LATEST_ID_TTL = 60
+
+
+def dm_key(user_a, user_b):
+    """Conversation key for a personal chat (order independent)"""
+    low, high = sorted((int(user_a), int(user_b)))
+    return ('dm', low, high)
+
+
+def group_key(group_id):
+    return ('group', int(group_id))
+
+
+def channel_key(channel_id):
+    return ('channel', int(channel_id))
+
+
+def conversation_key(message):
+    """Conversation key a stored Message belongs to"""
+    if message.group_id:
+        return group_key(message.group_id)
+    if message.channel_id:
+        return channel_key(message.channel_id)
+    return dm_key(message.sender_id, message.receiver_id)
+
+
+class Subscription:
+    """Queue of events for one connected client"""
+
+    def __init__(self, keys, maxsize):
+        self.keys = keys
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def get(self, timeout=None):
+        """Return the next event or None if nothing arrived within timeout"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class MessageBus:
+    """In-process publish/subscribe bus for newly committed messages.
+
+    Subscribers register for one or more conversation keys and receive the
+    serialized message of every publish on those keys. The bus lives in the
+    process memory, so every worker process only sees its own publishes.
+    """
+
+    def __init__(self, max_queue=256):
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        # Callbacks invoked with (key, event) for every publish, e.g. the bot engine
+        self._listeners = []
+        # Long-poll state: newest published id (and when) and a condition per conversation
+        self._latest_ids = OrderedDict()  # key -> (id, monotonic time), least recently published first
+        self._conditions = {}
+        self._waiting = defaultdict(int)
+
+    def subscribe(self, *keys):
+        subscription = Subscription(keys, self.max_queue)
+        with self._lock:
+            for key in keys:
+                self._subscribers[key].add(subscription)
+        return subscription
+
+    def listen(self, callback):
+        """Call callback(key, event) for every publish on any key. It must not block."""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for key in subscription.keys:
+                subscribers = self._subscribers.get(key)
+                if subscribers is None:
+                    continue
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[key]
+
+    def publish(self, key, event):
+        # Listeners first, so in-memory feeds hold the message before long-polls wake up
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(key, event)
+            except Exception as e:
+                print(f"Message listener error: {e}")
+
+        with self._lock:
+            subscribers = list(self._subscribers.get(key, ()))
+            now = time.monotonic()
+            latest_id, _ = self._latest_ids.pop(key, (0, None))
+            self._latest_ids[key] = (max(latest_id, event['id']), now)
+            self._prune_latest_ids(now)
+            condition = self._conditions.get(key)
+            if condition is not None:
+                condition.notify_all()
+
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                # Slow client - let it reconnect and catch up with ?after=
+                subscription.overflowed = True
+
+    def _prune_latest_ids(self, now):
+        """Forget newest ids of conversations without waiters and no recent publish (lock held)"""
+        stale = []
+        for key, (_, published) in self._latest_ids.items():
+            if now - published < LATEST_ID_TTL:
+                break
+            if key not in self._waiting:
+                stale.append(key)
+        for key in stale:
+            del self._latest_ids[key]
+
+    def wait_for_message(self, key, after_id, timeout):
+        """Block until a message newer than after_id is published on key.
+
+        Returns True as soon as one is, or False once timeout seconds pass.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            condition = self._conditions.get(key)
+            if condition is None:
+                condition = self._conditions[key] = threading.Condition(self._lock)
+            self._waiting[key] += 1
+            try:
+                while self._latest_ids.get(key, (0, None))[0] <= after_id:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    condition.wait(remaining)
+                return True
+            finally:
+                self._waiting[key] -= 1
+                if not self._waiting[key]:
+                    del self._waiting[key]
+                    del self._conditions[key]
+
+    def subscriber_count(self, key=None):
+        with self._lock:
+            if key is not None:
+                return len(self._subscribers.get(key, ()))
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+message_bus = MessageBus()
+
+
+def message_event(message):
+    """Serialize a committed Message for delivery to subscribers"""
+    from app.utils.serializers import message_fields
+
+    event = message_fields(message)
+    event['sender_id'] = message.sender_id
+    event['is_read'] = message.is_read
+    return event
+
+
+def publish_message(message):
+    """Publish a committed Message to everyone watching its conversation.
+
+    The message is already stored, so a failure is logged instead of failing
+    the request; clients pick the message up with their next fetch.
+    """
+    try:
+        message_bus.publish(conversation_key(message), message_event(message))
+    except Exception as e:
+        print(f"Publishing message {message.id} failed: {e}")
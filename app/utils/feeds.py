@@ -0,0 +1,378 @@
+"""
+In-memory feeds of the latest messages of busy conversations.
+
+Clients poll open chats every few seconds, so the same recent rows are read
+and serialized over and over. A feed is a ring buffer of a conversation's
+latest serialized messages. It is kept current from message_bus as
+messages are sent or uploaded, and fetch routes answer from it when it
+holds the requested page. Pages reaching further back than a feed holds
+still read the database. Two stores, each with its own policy, keep the
+feeds:
+
+- channel_feeds: channels read more than CHANNEL_HOT_READS times a minute
+  get a feed of CHANNEL_FEED_SIZE messages, for at most CHANNEL_FEEDS
+  channels. All subscribers of a popular channel share one buffer (fan-out
+  on write into memory), and cold channels stay on the database.
+- message_cache: every personal chat or group that is read gets a feed of
+  MESSAGE_CACHE_SIZE messages. Least recently read conversations are dropped
+  while the feeds take more than MESSAGE_CACHE_BYTES of serialized JSON.
+
+Feeds hold each message as its JSON fragment (see serializers), encoded
+once when the message is published or first loaded.
+
+Deleting a message removes it from its feed; deleting a whole group's
+messages, or any other change to a message (e.g. a finished thumbnail),
+drops the whole feed. Like message_bus,
+the feeds only see messages published in this process.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Seconds over which reads are counted to tell hot channels from cold ones
+HOT_WINDOW = 60
+
+
+def _entry(message_id, sender_id, fragment):
+    """Feed entry: (id, sender id, JSON fragment of the message's fields, size in bytes)"""
+    return message_id, sender_id, fragment, len(fragment)
+
+
+def _event_entry(event):
+    """Feed entry of a just published message, encoding its JSON once for every store"""
+    from .serializers import fields_fragment, message_fragments
+
+    fragment = message_fragments.get(event['id'])
+    if fragment is None:
+        fields = {key: value for key, value in event.items() if key not in ('sender_id', 'is_read')}
+        fragment = fields_fragment(fields)
+        message_fragments.set(event['id'], fragment)
+    return _entry(event['id'], event['sender_id'], fragment)
+
+
+class Feed:
+    """The latest messages of one conversation, in id order"""
+
+    def __init__(self, entries, size):
+        self.entries = deque(maxlen=size)
+        self.bytes = 0
+        for entry in entries[-size:]:
+            self._append(entry)
+        # True while the buffer holds every message of the conversation
+        self.complete = len(entries) < size
+
+    def _append(self, entry):
+        if len(self.entries) == self.entries.maxlen:
+            self.bytes -= self.entries.popleft()[3]
+            self.complete = False
+        self.entries.append(entry)
+        self.bytes += entry[3]
+
+    def add(self, entry):
+        entries = self.entries
+        if not entries or entry[0] > entries[-1][0]:
+            self._append(entry)
+            return
+
+        # Published out of order by concurrent commits
+        if any(existing[0] == entry[0] for existing in entries):
+            return
+        if entry[0] < entries[0][0] and (not self.complete or len(entries) == entries.maxlen):
+            self.complete = False
+            return  # older than the buffer reaches; the database has it
+        if len(entries) == entries.maxlen:
+            self.bytes -= entries.popleft()[3]
+            self.complete = False
+        position = next(i for i, existing in enumerate(entries) if existing[0] > entry[0])
+        entries.insert(position, entry)
+        self.bytes += entry[3]
+
+    def remove(self, message_id):
+        for entry in self.entries:
+            if entry[0] == message_id:
+                self.entries.remove(entry)
+                self.bytes -= entry[3]
+                return
+
+    def page(self, after_id, before_id, limit):
+        """Entries of a page as page_messages() would return it, or None if the buffer can't tell"""
+        entries = self.entries
+        if before_id is None and after_id > 0:
+            if not self.complete and (not entries or after_id < entries[0][0]):
+                return None
+            return [entry for entry in entries if entry[0] > after_id][:limit], None
+
+        candidates = [entry for entry in entries if before_id is None or entry[0] < before_id]
+        if len(candidates) <= limit and not self.complete:
+            return None
+        return candidates[-limit:], len(candidates) > limit
+
+
+def conversation_messages(key):
+    """Message query of a conversation key, as the fetch routes and feeds read it"""
+    from app.models import Message
+
+    if key[0] == 'channel':
+        return Message.query.filter_by(channel_id=key[1])
+    if key[0] == 'group':
+        return Message.query.filter_by(group_id=key[1])
+    _, user_a, user_b = key
+    return Message.query.filter(
+        ((Message.sender_id == user_a) & (Message.receiver_id == user_b)) |
+        ((Message.sender_id == user_b) & (Message.receiver_id == user_a))
+    )
+
+
+class FeedStore:
+    """Feeds of some kinds of conversation, kept current from message_bus.
+
+    Subclasses decide which conversations get a feed (_wants_feed) and how
+    many are kept (_trim); both run under the store's lock.
+    """
+
+    kinds = ()
+
+    def __init__(self, size):
+        self.size = size
+        self._feeds = OrderedDict()  # conversation key -> Feed, least recently read first
+        self._loading = {}  # key -> entries published while loading, or None once invalidated
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._listening = False
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return True
+
+    def _listen(self):
+        with self._lock:
+            self._feeds.clear()
+            self._loading.clear()
+            self._bytes = 0
+            if not self._listening:
+                from .events import message_bus
+                message_bus.listen(self._on_publish)
+                self._listening = True
+
+    def _wants_feed(self, key):
+        return True
+
+    def _trim(self):
+        pass
+
+    def _drop_oldest(self):
+        self._bytes -= self._feeds.popitem(last=False)[1].bytes
+
+    def _on_publish(self, key, event):
+        if key[0] not in self.kinds:
+            return
+        with self._lock:
+            feed = self._feeds.get(key)
+            if feed is not None:
+                before = feed.bytes
+                feed.add(_event_entry(event))
+                self._bytes += feed.bytes - before
+                self._trim()
+            elif self._loading.get(key) is not None:
+                self._loading[key].append(_event_entry(event))
+
+    def page(self, key, after_id, before_id, limit):
+        """A page of feed entries and has_more, or None to read the database"""
+        if not self.enabled:
+            return None
+
+        load = False
+        with self._lock:
+            feed = self._feeds.get(key)
+            if feed is not None:
+                self._feeds.move_to_end(key)
+                result = feed.page(after_id, before_id, limit)
+            elif self._wants_feed(key) and key not in self._loading:
+                self._loading[key] = []
+                load = True
+            else:
+                result = None
+
+        if load:
+            feed = self._load(key)
+
+        with self._lock:
+            if load:
+                result = feed.page(after_id, before_id, limit) if feed is not None else None
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def _load(self, key):
+        from app.models import Message
+        from .serializers import with_senders, message_fragment
+
+        try:
+            messages = with_senders(conversation_messages(key)).order_by(Message.id.desc()).limit(self.size).all()
+            entries = [_entry(message.id, message.sender_id, message_fragment(message))
+                       for message in reversed(messages)]
+        except Exception:
+            with self._lock:
+                self._loading.pop(key, None)
+            raise
+
+        with self._lock:
+            published = self._loading.pop(key, None)
+            if published is None:
+                return None  # invalidated while loading
+            feed = Feed(entries, self.size)
+            for entry in published:
+                feed.add(entry)
+            self._feeds[key] = feed
+            self._bytes += feed.bytes
+            self._trim()
+        return feed
+
+    def remove_message(self, key, message_id):
+        """Drop a deleted message from its conversation's feed"""
+        with self._lock:
+            feed = self._feeds.get(key)
+            if feed is not None:
+                before = feed.bytes
+                feed.remove(message_id)
+                self._bytes += feed.bytes - before
+            if key in self._loading:
+                self._loading[key] = None
+
+    def invalidate(self, key):
+        """Forget a conversation's feed after one of its messages changed"""
+        with self._lock:
+            feed = self._feeds.pop(key, None)
+            if feed is not None:
+                self._bytes -= feed.bytes
+            if key in self._loading:
+                self._loading[key] = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'feeds': len(self._feeds),
+                'size': self.size,
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+class ChannelFeeds(FeedStore):
+    """Feeds of the most read channels"""
+
+    kinds = ('channel',)
+
+    def __init__(self):
+        super().__init__(size=200)
+        self.max_feeds = 100
+        self.hot_reads = 30
+        self._reads = {}
+        self._window_start = time.monotonic()
+
+    def init_app(self, app):
+        self.max_feeds = app.config.get('CHANNEL_FEEDS', self.max_feeds)
+        self.size = app.config.get('CHANNEL_FEED_SIZE', self.size)
+        self.hot_reads = app.config.get('CHANNEL_HOT_READS', self.hot_reads)
+        self._listen()
+
+    @property
+    def enabled(self):
+        return self.max_feeds > 0
+
+    def _wants_feed(self, key):
+        now = time.monotonic()
+        if now - self._window_start > HOT_WINDOW:
+            self._reads.clear()
+            self._window_start = now
+        self._reads[key] = self._reads.get(key, 0) + 1
+        return self._reads[key] >= self.hot_reads
+
+    def _trim(self):
+        while len(self._feeds) > self.max_feeds:
+            self._drop_oldest()
+
+    def stats(self):
+        return dict(super().stats(), max_feeds=self.max_feeds)
+
+
+class MessageCache(FeedStore):
+    """LRU feeds of personal chats and groups within a byte budget"""
+
+    kinds = ('dm', 'group')
+
+    def __init__(self):
+        super().__init__(size=100)
+        self.max_bytes = 32 * 1024 * 1024
+
+    def init_app(self, app):
+        self.max_bytes = app.config.get('MESSAGE_CACHE_BYTES', self.max_bytes)
+        self.size = app.config.get('MESSAGE_CACHE_SIZE', self.size)
+        self._listen()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _wants_feed(self, key):
+        # A chat with oneself would also match one's group posts (receiver_id is the sender)
+        return key[0] != 'dm' or key[1] != key[2]
+
+    def _trim(self):
+        while self._bytes > self.max_bytes and self._feeds:
+            self._drop_oldest()
+
+    def stats(self):
+        return dict(super().stats(), max_bytes=self.max_bytes)
+
+
+def entries_json(entries, current_user_id, read_up_to=None):
+    """Feed entries as serializers.messages_json() would return them for a viewer"""
+    from .serializers import viewer_json
+
+    return [viewer_json(fragment, message_id, sender_id, current_user_id, read_up_to)
+            for message_id, sender_id, fragment, _ in entries]
+
+
+channel_feeds = ChannelFeeds()
+message_cache = MessageCache()
+
+
+def message_removed(message):
+    """Take a deleted message out of its feed"""
+    from .events import conversation_key
+    from .serializers import message_fragments
+
+    message_fragments.invalidate(message.id)
+    key = conversation_key(message)
+    for store in (channel_feeds, message_cache):
+        store.remove_message(key, message.id)
+
+
+def messages_removed(key, message_ids):
+    """Forget the cached JSON and the feed of a conversation whose messages were bulk-deleted"""
+    from .serializers import message_fragments
+
+    for message_id in message_ids:
+        message_fragments.invalidate(message_id)
+    for store in (channel_feeds, message_cache):
+        store.invalidate(key)
+
+
+def message_changed(message):
+    """Drop the cached JSON of a message whose stored fields changed, and the feed holding it"""
+    from .events import conversation_key
+    from .serializers import message_fragments
+
+    message_fragments.invalidate(message.id)
+    key = conversation_key(message)
+    for store in (channel_feeds, message_cache):
+        store.invalidate(key)
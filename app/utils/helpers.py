@@ -1,12 +1,11 @@
-import hashlib
 import secrets
 import os
 import re
 from PIL import Image
 
+from .passwords import hash_password
 
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+MAX_ROW_ID = 2 ** 63 - 1
 
 
 def get_current_user():
@@ -19,6 +18,16 @@ def get_current_user_id():
     return session.get('user_id')
 
 
+def is_json_int(value):
+    """True for an integer from a JSON body (JSON true/false parse as bool, a subclass of int)"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_json_id(value):
+    """True for a JSON integer usable as a row id: SQLite can't bind ints outside 64 bits"""
+    return is_json_int(value) and 0 <= value <= MAX_ROW_ID
+
+
 def generate_invite_link():
     return secrets.token_urlsafe(16)
 
@@ -45,19 +54,19 @@ def allowed_file(filename, file_type='all'):
 
 def get_file_type(filename):
     """Determine file type from extension"""
-    from app import app
+    from flask import current_app
 
     ext = filename.rsplit('.', 1)[1].lower()
 
-    if ext in app.config['ALLOWED_EXTENSIONS']['images']:
+    if ext in current_app.config['ALLOWED_EXTENSIONS']['images']:
         return 'image'
-    elif ext in app.config['ALLOWED_EXTENSIONS']['media']:
+    elif ext in current_app.config['ALLOWED_EXTENSIONS']['media']:
         if ext in {'mp4', 'avi', 'mov', 'mkv'}:
             return 'video'
         return 'audio'
-    elif ext in app.config['ALLOWED_EXTENSIONS']['documents']:
+    elif ext in current_app.config['ALLOWED_EXTENSIONS']['documents']:
         return 'document'
-    elif ext in app.config['ALLOWED_EXTENSIONS']['archives']:
+    elif ext in current_app.config['ALLOWED_EXTENSIONS']['archives']:
         return 'archive'
     else:
         return 'unknown'
@@ -0,0 +1,190 @@
+"""
+Background image processing for uploaded attachments.
+
+Uploads only mark an image message as pending and hand its id to
+media_worker. The Pillow work (thumbnails in several sizes, each as JPEG/PNG
+and WebP) runs in a small process pool so it never blocks a request thread.
+The job state lives on the Message row (thumbnail_status), which also makes
+the database the overflow queue: when the pool is full, jobs stay pending
+and are picked up as soon as a slot frees or on the next start. A job renders
+one blob: messages sharing it while it runs wait for it instead of queuing
+their own, and all of them are updated when it finishes.
+"""
+
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+from sqlalchemy import func
+
+from .feeds import message_changed
+
+# Longest edge in pixels of each generated variant; the first one is the chat thumbnail
+THUMBNAIL_SIZES = {'small': 200, 'medium': 800}
+
+STATUS_PENDING = 'pending'
+STATUS_READY = 'ready'
+STATUS_FAILED = 'failed'
+
+
+def thumbnail_base(file_path):
+    """uploads/images/<name>.png -> uploads/images/thumb_<name>"""
+    directory, filename = os.path.split(file_path)
+    return os.path.join(directory, 'thumb_' + os.path.splitext(filename)[0])
+
+
+def render_thumbnails(source_path, output_base, sizes=THUMBNAIL_SIZES):
+    """Write every thumbnail variant of an image and return {name: path}.
+
+    Runs inside the worker processes, so it takes and returns plain values only.
+    """
+    variants = {}
+    with Image.open(source_path) as img:
+        img.load()
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        base = img.convert('RGBA' if has_alpha else 'RGB')
+
+        for name, size in sizes.items():
+            thumbnail = base.copy()
+            thumbnail.thumbnail((size, size))
+
+            if has_alpha:
+                path = f'{output_base}_{name}.png'
+                thumbnail.save(path, 'PNG', optimize=True)
+            else:
+                path = f'{output_base}_{name}.jpg'
+                thumbnail.save(path, 'JPEG', quality=85, optimize=True, progressive=True)
+            variants[name] = path
+
+            webp_path = f'{output_base}_{name}.webp'
+            thumbnail.save(webp_path, 'WEBP', quality=80, method=4)
+            variants[f'{name}_webp'] = webp_path
+
+    return variants
+
+
+class MediaWorker:
+    """Bounded process pool processing pending image messages"""
+
+    def __init__(self):
+        self.app = None
+        self.max_workers = 2
+        self.max_pending = 32
+        self._executor = None
+        # Results are written back on this thread, not the pool's manager thread
+        self._completions = ThreadPoolExecutor(max_workers=1, thread_name_prefix='media-results')
+        self._in_flight = set()  # blob paths being rendered
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.max_workers = app.config.get('MEDIA_WORKERS', self.max_workers)
+        self.max_pending = app.config.get('MEDIA_QUEUE_SIZE', self.max_pending)
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn: forking a threaded server process can deadlock the children
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def submit(self, message_id, file_path):
+        """Queue a message's thumbnails, or let it share the running job of its blob.
+        Returns False if the pool is full (the job stays pending)."""
+        with self._lock:
+            if file_path in self._in_flight:
+                return True
+            if len(self._in_flight) >= self.max_pending:
+                return False
+            self._in_flight.add(file_path)
+
+        try:
+            future = self._get_executor().submit(render_thumbnails, file_path, thumbnail_base(file_path))
+        except Exception:
+            with self._lock:
+                self._in_flight.discard(file_path)
+            raise
+        future.add_done_callback(lambda done: self._completions.submit(self._finish, message_id, file_path, done))
+        return True
+
+    def _finish(self, message_id, file_path, future):
+        from app import db
+        from app.models import Message
+
+        try:
+            variants = future.result()
+        except BrokenProcessPool as e:
+            # A worker died (e.g. OOM on a huge image); start a fresh pool for the next jobs
+            print(f"Thumbnail worker crashed on message {message_id}: {e}")
+            self.shutdown(wait=False)
+            variants = None
+        except Exception as e:
+            print(f"Thumbnail creation failed for message {message_id}: {e}")
+            variants = None
+
+        try:
+            with self.app.app_context():
+                try:
+                    # Every message of the blob that waited for this job
+                    messages = Message.query.filter_by(file_path=file_path,
+                                                       thumbnail_status=STATUS_PENDING).all()
+                    for message in messages:
+                        if variants:
+                            message.thumbnail_path = variants[next(iter(THUMBNAIL_SIZES))]
+                            message.thumbnail_variants = json.dumps(variants)
+                            message.thumbnail_status = STATUS_READY
+                        else:
+                            message.thumbnail_status = STATUS_FAILED
+                    db.session.commit()
+                    # Feeds hold the messages with their old thumbnail status
+                    for message in messages:
+                        message_changed(message)
+                finally:
+                    db.session.remove()
+        finally:
+            # Free the slot even if the result couldn't be stored; the jobs stay pending then
+            with self._lock:
+                self._in_flight.discard(file_path)
+            self.resume()
+
+    def resume(self):
+        """Queue pending jobs from the database until the pool is full"""
+        from app import db
+        from app.models import Message
+
+        with self._lock:
+            free = self.max_pending - len(self._in_flight)
+            exclude = list(self._in_flight)
+        if free <= 0:
+            return 0
+
+        # One job per blob, for its oldest pending message
+        with self.app.app_context():
+            try:
+                pending = db.session.query(func.min(Message.id), Message.file_path).filter(
+                    Message.thumbnail_status == STATUS_PENDING,
+                    Message.file_path.notin_(exclude)
+                ).group_by(Message.file_path).order_by(func.min(Message.id)).limit(free).all()
+            finally:
+                db.session.remove()
+
+        return sum(1 for message_id, file_path in pending if self.submit(message_id, file_path))
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+media_worker = MediaWorker()
+
+
+def thumbnail_urls(message):
+    """URLs of the generated thumbnail variants of a message, if ready"""
+    if not message.thumbnail_variants:
+        return {}
+    return {name: f'/{path}' for name, path in json.loads(message.thumbnail_variants).items()}
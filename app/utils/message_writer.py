@@ -0,0 +1,185 @@
+"""
+Storing sent messages, optionally with group commit.
+
+store_message() inserts a message, points the conversations at it, commits
+and publishes it. By default that happens in the calling request, one
+commit, and so one journal sync, per message. With MESSAGE_WRITER enabled,
+sends are handed to message_writer instead. Its thread collects them for
+MESSAGE_WRITER_INTERVAL milliseconds (or until MESSAGE_WRITER_BATCH are
+waiting) and commits the whole batch in one transaction. Each caller waits
+on a future for its stored message. Under a burst, the number of syncs
+follows the number of batches, not the number of messages. If a batch
+fails, its messages are retried one by one, so a bad message only fails
+its own request.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+# Longest a request waits for the writer before giving up
+WRITE_TIMEOUT = 30
+
+
+def _insert_messages(columns_list):
+    """Add and record messages in the current session without committing.
+
+    Returns the sender's view of each message and its (key, event) to publish
+    once committed; both are built before the commit expires the rows.
+    """
+    from app import db
+    from app.models import Message, User
+    from app.utils.conversations import record_message
+    from app.utils.events import conversation_key, message_event
+    from app.utils.serializers import serialize_message
+
+    messages = [Message(**columns) for columns in columns_list]
+    db.session.add_all(messages)
+    db.session.flush()
+    # Senders into the identity map, so serializing doesn't load them one by one
+    User.query.filter(User.id.in_({message.sender_id for message in messages})).all()
+    for message in messages:
+        record_message(message)
+
+    results = [serialize_message(message, message.sender_id) for message in messages]
+    events = [(conversation_key(message), message_event(message)) for message in messages]
+    return results, events
+
+
+def _publish(events):
+    """Publish committed messages; a failure is logged, the messages are stored either way"""
+    from app.utils.events import message_bus
+
+    for key, event in events:
+        try:
+            message_bus.publish(key, event)
+        except Exception as e:
+            print(f"Publishing message {event['id']} failed: {e}")
+
+
+def store_message(**columns):
+    """Store and publish a new message; returns it serialized for its sender"""
+    from app import db
+
+    if message_writer.enabled:
+        # Don't hold a pooled connection while waiting for the writer
+        db.session.rollback()
+        return message_writer.submit(columns).result(WRITE_TIMEOUT)
+
+    try:
+        results, events = _insert_messages([columns])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    _publish(events)
+    return results[0]
+
+
+class MessageWriter:
+    """Writer thread committing queued messages in micro-batches"""
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.interval = 0.005
+        self.max_batch = 200
+        self._queue = deque()  # (columns, future)
+        self._wake = threading.Condition()
+        self._running = False
+        self._thread = None
+        self.batches = 0
+        self.written = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('MESSAGE_WRITER', self.enabled)
+        self.interval = app.config.get('MESSAGE_WRITER_INTERVAL', self.interval * 1000) / 1000
+        self.max_batch = app.config.get('MESSAGE_WRITER_BATCH', self.max_batch)
+
+    def submit(self, columns):
+        """Queue a message for the next batch; the future resolves to its serialized form"""
+        future = Future()
+        with self._wake:
+            if self._thread is None:
+                self._running = True
+                self._thread = threading.Thread(target=self._loop, name='message-writer', daemon=True)
+                self._thread.start()
+            self._queue.append((columns, future))
+            self._wake.notify()
+        return future
+
+    def _next_batch(self):
+        with self._wake:
+            while self._running and not self._queue:
+                self._wake.wait()
+            if not self._queue:
+                return []
+            # Give concurrent senders one interval to join the batch
+            deadline = time.monotonic() + self.interval
+            while self._running and len(self._queue) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._wake.wait(remaining)
+            count = min(len(self._queue), self.max_batch)
+            return [self._queue.popleft() for _ in range(count)]
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        """Commit a batch of (columns, future) in one transaction"""
+        from app import db
+
+        with self.app.app_context():
+            try:
+                try:
+                    results, events = _insert_messages([columns for columns, _ in batch])
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    if len(batch) == 1:
+                        batch[0][1].set_exception(e)
+                        return
+                    print(f"Message batch of {len(batch)} failed, writing one by one: {e}")
+                    for item in batch:
+                        self.write_batch([item])
+                    return
+
+                self.batches += 1
+                self.written += len(batch)
+                _publish(events)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            finally:
+                db.session.remove()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'written': self.written,
+            'average_batch': round(self.written / self.batches, 2) if self.batches else None,
+        }
+
+    def shutdown(self):
+        """Write what is queued and stop the thread"""
+        with self._wake:
+            self._running = False
+            self._wake.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        with self._wake:
+            self._thread = None
+            batch, self._queue = list(self._queue), deque()
+        if batch:
+            self.write_batch(batch)
+
+
+message_writer = MessageWriter()
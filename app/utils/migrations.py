@@ -0,0 +1,164 @@
+"""
+Schema migrations applied on top of db.create_all().
+
+create_all() only creates missing tables, so changes to tables that already
+exist in a deployed database (new columns, new indexes, backfills) are
+registered here and applied once each, in version order.
+"""
+
+from datetime import datetime
+from sqlalchemy import inspect, text
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """Register a migration function under a unique, increasing version"""
+    def register(func):
+        if any(existing[0] == version for existing in MIGRATIONS):
+            raise ValueError(f"Duplicate migration version {version}")
+        MIGRATIONS.append((version, name, func))
+        return func
+    return register
+
+
+def create_indexes(model):
+    """Create any of the model's declared indexes missing from the database"""
+    from app import db
+
+    for index in model.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+def add_column(model, column_name, default_sql=None):
+    """ALTER TABLE ... ADD COLUMN for a column declared on the model but missing in the database"""
+    from app import db
+
+    table = model.__table__
+    existing = [column['name'] for column in inspect(db.engine).get_columns(table.name)]
+    if column_name in existing:
+        return
+
+    column = table.c[column_name]
+    sql = f'ALTER TABLE "{table.name}" ADD COLUMN "{column_name}" {column.type.compile(dialect=db.engine.dialect)}'
+    if default_sql is not None:
+        sql += f' DEFAULT {default_sql}'
+
+    with db.engine.begin() as connection:
+        connection.execute(text(sql))
+
+
+@migration(1, 'message_indexes')
+def _message_indexes():
+    from app.models import Message
+    create_indexes(Message)
+
+
+@migration(2, 'conversation_backfill')
+def _conversation_backfill():
+    from app.utils.conversations import sync_conversations
+    sync_conversations()
+
+
+@migration(3, 'message_search_index')
+def _message_search_index():
+    from app.utils.search_index import rebuild_search_index
+    rebuild_search_index()
+
+
+@migration(4, 'message_thumbnail_jobs')
+def _message_thumbnail_jobs():
+    from app.models import Message
+    add_column(Message, 'thumbnail_status')
+    add_column(Message, 'thumbnail_variants')
+
+
+@migration(5, 'message_file_path_index')
+def _message_file_path_index():
+    from app.models import Message
+    create_indexes(Message)
+
+
+@migration(6, 'conversation_read_marks')
+def _conversation_read_marks():
+    from app.models import Conversation
+    from app.utils.read_state import backfill_read_marks
+    add_column(Conversation, 'last_read_message_id')
+    backfill_read_marks()
+
+
+@migration(7, 'message_autoincrement')
+def _message_autoincrement():
+    """Rebuild the message table with AUTOINCREMENT so deleted ids are never handed out again.
+
+    SQLite can't alter a primary key in place: copy the rows into a new table,
+    swap it in, then restore the indexes and the search triggers that were
+    dropped with the old table. Row ids don't change, so the FTS index stays valid.
+    """
+    from sqlalchemy import MetaData
+    from sqlalchemy.schema import CreateTable
+    from app import db
+    from app.models import Message
+    from app.utils.search_index import create_search_index, fts_enabled
+
+    if db.engine.dialect.name != 'sqlite':
+        return
+
+    search_index = fts_enabled()
+    with db.engine.begin() as connection:
+        schema = connection.execute(text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'message'")).scalar()
+        if 'AUTOINCREMENT' in schema.upper():
+            return
+
+        # The copy's foreign keys need the tables they refer to in its metadata
+        metadata = MetaData()
+        for foreign_key in Message.__table__.foreign_keys:
+            if foreign_key.column.table.name not in metadata.tables:
+                foreign_key.column.table.to_metadata(metadata)
+        rebuilt = Message.__table__.to_metadata(metadata, name='message_rebuild')
+        columns = ', '.join(f'"{column.name}"' for column in Message.__table__.columns)
+        connection.execute(CreateTable(rebuilt))
+        connection.execute(text(f'INSERT INTO message_rebuild ({columns}) SELECT {columns} FROM message'))
+        connection.execute(text('DROP TABLE message'))
+        connection.execute(text('ALTER TABLE message_rebuild RENAME TO message'))
+
+    create_indexes(Message)
+    if search_index:
+        create_search_index()
+
+
+def applied_migrations():
+    from app import db
+
+    with db.engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_migrations '
+            '(version INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, applied_at DATETIME NOT NULL)'
+        ))
+        return set(row[0] for row in connection.execute(text('SELECT version FROM schema_migrations')))
+
+
+def migrate_database():
+    """Create missing tables, then apply pending migrations. Returns how many ran."""
+    from app import db
+
+    db.create_all()
+    applied = applied_migrations()
+
+    count = 0
+    for version, name, func in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if version in applied:
+            continue
+
+        func()
+        db.session.commit()
+        with db.engine.begin() as connection:
+            connection.execute(
+                text('INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :applied_at)'),
+                {'version': version, 'name': name, 'applied_at': datetime.utcnow()}
+            )
+        print(f"✓ Applied migration {version:03d} {name}")
+        count += 1
+
+    return count
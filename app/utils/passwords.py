@@ -0,0 +1,184 @@
+"""
+Password hashing.
+
+Passwords are stored as salted scrypt hashes:
+"scrypt$<n>$<r>$<p>$<salt>$<hash>" (base64 salt and hash). Older accounts
+still hold an unsalted SHA-256 hex digest. Those are accepted once and
+rehashed with scrypt in the background after a successful login.
+
+scrypt is deliberately slow, so password_hasher runs it on a small thread
+pool. A client IP may only have PASSWORD_PER_IP hashes in flight, and the
+pool only holds PASSWORD_QUEUE_SIZE jobs. A burst of login attempts gets
+PasswordHasherBusy (429) instead of tying up the threads that serve
+messages. Successful verifications are remembered for a few minutes under
+a keyed digest, so a user logging in again skips the KDF.
+"""
+
+import base64
+import hashlib
+import hmac
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+LEGACY_HASH = re.compile(r'[0-9a-f]{64}')
+
+VERIFIED_CACHE_SIZE = 1024
+VERIFIED_CACHE_SECONDS = 600
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are already running for this client or overall"""
+
+
+def _b64(data):
+    return base64.b64encode(data).decode()
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r, dklen=HASH_BYTES)
+
+
+def hash_password(password):
+    """Salted scrypt hash of a password, in the format stored in User.password_hash"""
+    salt = secrets.token_bytes(SALT_BYTES)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f'scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}'
+
+
+def verify_password(password, password_hash):
+    """Check a password against a stored hash of either format"""
+    if LEGACY_HASH.fullmatch(password_hash):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), password_hash)
+
+    try:
+        scheme, n, r, p, salt, digest = password_hash.split('$')
+        if scheme != 'scrypt':
+            return False
+        expected = base64.b64decode(digest)
+        actual = _scrypt(password, base64.b64decode(salt), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return hmac.compare_digest(actual, expected)
+
+
+def needs_rehash(password_hash):
+    """Whether a stored hash is legacy SHA-256 or uses older scrypt parameters"""
+    return not password_hash.startswith(f'scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$')
+
+
+class PasswordHasher:
+    """Bounded thread pool for password hashing, with a per-client limit"""
+
+    def __init__(self):
+        self.app = None
+        self.max_workers = 2
+        self.max_pending = 16
+        self.per_client = 2
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._per_client = defaultdict(int)
+        # keyed digest of (stored hash, password) -> time verified; the key never leaves the process
+        self._verified = OrderedDict()
+        self._cache_key = secrets.token_bytes(32)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_workers = app.config.get('PASSWORD_WORKERS', self.max_workers)
+        self.max_pending = app.config.get('PASSWORD_QUEUE_SIZE', self.max_pending)
+        self.per_client = app.config.get('PASSWORD_PER_IP', self.per_client)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='password')
+            return self._executor
+
+    def _submit(self, client, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending or self._per_client[client] >= self.per_client:
+                raise PasswordHasherBusy()
+            self._pending += 1
+            self._per_client[client] += 1
+
+        def release(_):
+            with self._lock:
+                self._pending -= 1
+                self._per_client[client] -= 1
+                if not self._per_client[client]:
+                    del self._per_client[client]
+
+        future = self._get_executor().submit(fn, *args)
+        future.add_done_callback(release)
+        return future
+
+    def hash(self, password, client):
+        """hash_password() on the pool; raises PasswordHasherBusy when over the limits"""
+        return self._submit(client, hash_password, password).result()
+
+    def _cache_token(self, password, password_hash):
+        return hmac.new(self._cache_key, f'{password_hash}\0{password}'.encode(), hashlib.sha256).digest()
+
+    def verify(self, password, password_hash, client):
+        """verify_password() on the pool, answering recently verified logins from memory"""
+        token = self._cache_token(password, password_hash)
+        now = time.monotonic()
+        with self._lock:
+            verified_at = self._verified.get(token)
+            if verified_at is not None and now - verified_at < VERIFIED_CACHE_SECONDS:
+                self._verified.move_to_end(token)
+                return True
+
+        if not self._submit(client, verify_password, password, password_hash).result():
+            return False
+
+        with self._lock:
+            self._verified[token] = now
+            self._verified.move_to_end(token)
+            while len(self._verified) > VERIFIED_CACHE_SIZE:
+                self._verified.popitem(last=False)
+        return True
+
+    def upgrade(self, user_id, password, old_hash):
+        """Replace an outdated hash in the background after a successful login"""
+        try:
+            self._submit(('upgrade', user_id), self._upgrade, user_id, password, old_hash)
+        except PasswordHasherBusy:
+            pass  # the next login tries again
+
+    def _upgrade(self, user_id, password, old_hash):
+        from app import db
+        from app.models import User
+
+        new_hash = hash_password(password)
+        with self.app.app_context():
+            try:
+                # Only if the hash wasn't changed meanwhile
+                User.query.filter_by(id=user_id, password_hash=old_hash).update(
+                    {'password_hash': new_hash}, synchronize_session=False)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Password rehash failed for user {user_id}: {e}")
+            finally:
+                db.session.remove()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,229 @@
+"""
+Read state as a per-conversation high-water mark.
+
+Each Conversation row stores last_read_message_id, the newest message of the
+chat its user has read. Everything after it from somebody else is unread.
+Marking a chat read moves the mark forward, never back, and recounts
+unread_count from the mark. That count is an index range scan
+(ix_message_sender_receiver / ix_message_group / ix_message_channel)
+instead of flipping is_read on every row. The same mark answers read
+receipts: my message was read if its id is at or below the peer's mark.
+
+Clients mark chats read very often (every poll while a chat is open), so
+read_marks coalesces the calls in memory, keeping only the highest mark per
+conversation. It writes them in one batch every READ_FLUSH_INTERVAL
+seconds. A user's pending marks are flushed before their chat list is
+rendered, so counts never look stale to the person who read the chat.
+"""
+
+import threading
+
+from sqlalchemy import Integer, bindparam, case, func, select, update
+
+LATEST = None  # mark value meaning "up to the conversation's last message"
+
+
+def unread_conditions(chat_type, user_id, peer_id, after):
+    """Conditions on Message selecting what user_id hasn't read of a conversation"""
+    from app.models import Message
+
+    if chat_type == 'personal':
+        conditions = [Message.sender_id == peer_id, Message.receiver_id == user_id,
+                      Message.group_id.is_(None), Message.channel_id.is_(None)]
+    else:
+        column = Message.group_id if chat_type == 'group' else Message.channel_id
+        conditions = [column == peer_id, Message.sender_id != user_id]
+    return conditions + [Message.id > func.coalesce(after, 0)]
+
+
+def unread_count(chat_type, user_id, peer_id, after):
+    from app.models import Message
+    return select(func.count(Message.id)).where(
+        *unread_conditions(chat_type, user_id, peer_id, after)).scalar_subquery()
+
+
+def apply_read_marks(marks):
+    """Stage mark-read updates: marks is a list of (user_id, chat_type, peer_id, message_id or LATEST)"""
+    from app import db
+    from app.models import Conversation
+
+    table = Conversation.__table__
+    for chat_type in ('personal', 'group', 'channel'):
+        params = [{'b_user_id': user_id, 'b_peer_id': peer_id, 'b_message_id': message_id}
+                  for user_id, kind, peer_id, message_id in marks if kind == chat_type]
+        if not params:
+            continue
+
+        # Never past the conversation's last message, or later messages would count as read
+        last_id = func.coalesce(table.c.last_message_id, 0)
+        requested = bindparam('b_message_id', type_=Integer)
+        target = case((requested.is_(None) | (requested > last_id), last_id), else_=requested)
+        new_mark = case((func.coalesce(table.c.last_read_message_id, 0) >= target, table.c.last_read_message_id),
+                        else_=target)
+        # SET expressions see the old row, so the count uses the new mark expression directly
+        db.session.execute(
+            update(table).where(
+                table.c.user_id == bindparam('b_user_id'),
+                table.c.chat_type == chat_type,
+                table.c.peer_id == bindparam('b_peer_id')
+            ).values(
+                last_read_message_id=new_mark,
+                unread_count=unread_count(chat_type, table.c.user_id, table.c.peer_id, new_mark)
+            ),
+            params
+        )
+
+
+def recount_unread():
+    """Recompute every unread_count from the read marks (after a rebuild or backfill)"""
+    from app import db
+    from app.models import Conversation
+
+    for chat_type in ('personal', 'group', 'channel'):
+        db.session.execute(update(Conversation).where(Conversation.chat_type == chat_type).values(
+            unread_count=unread_count(chat_type, Conversation.user_id, Conversation.peer_id,
+                                      Conversation.last_read_message_id)
+        ).execution_options(synchronize_session=False))
+
+
+def backfill_read_marks():
+    """Give conversations without a mark one: personal chats from the old is_read flags,
+    groups and channels (which had no read state) as read up to their last message"""
+    from app import db
+    from app.models import Conversation, Message
+
+    without_mark = Conversation.last_read_message_id.is_(None)
+    db.session.execute(update(Conversation).where(
+        without_mark, (Conversation.chat_type != 'personal') | (Conversation.unread_count == 0)
+    ).values(last_read_message_id=Conversation.last_message_id).execution_options(synchronize_session=False))
+
+    db.session.execute(update(Conversation).where(
+        without_mark, Conversation.chat_type == 'personal'
+    ).values(last_read_message_id=select(func.max(Message.id)).where(
+        Message.sender_id == Conversation.peer_id,
+        Message.receiver_id == Conversation.user_id,
+        Message.group_id.is_(None),
+        Message.channel_id.is_(None),
+        Message.is_read.is_(True)
+    ).scalar_subquery()).execution_options(synchronize_session=False))
+
+    recount_unread()
+
+
+def personal_read_marks(user_id, peer_id):
+    """How far each side of a personal chat has read, including unflushed marks: {reader id: message id}"""
+    from app import db
+    from app.models import Conversation
+
+    rows = db.session.query(Conversation.user_id, Conversation.last_message_id, Conversation.last_read_message_id).filter(
+        Conversation.chat_type == 'personal',
+        ((Conversation.user_id == user_id) & (Conversation.peer_id == peer_id)) |
+        ((Conversation.user_id == peer_id) & (Conversation.peer_id == user_id))
+    )
+
+    marks = {user_id: 0, peer_id: 0}
+    for reader_id, last_message_id, last_read in rows:
+        pending = read_marks.pending_mark(reader_id, 'personal', peer_id if reader_id == user_id else user_id, default=0)
+        if pending is LATEST or (pending or 0) > (last_message_id or 0):
+            pending = last_message_id
+        marks[reader_id] = max(last_read or 0, pending or 0)
+    return marks
+
+
+_NOT_PENDING = object()
+
+
+class ReadMarks:
+    """Coalesces mark-read calls in memory and writes them in batches"""
+
+    def __init__(self):
+        self.app = None
+        self.interval = 1.0
+        self._pending = {}  # (user_id, chat_type, peer_id) -> message id or LATEST
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('READ_FLUSH_INTERVAL', self.interval)
+
+    def mark(self, user_id, chat_type, peer_id, message_id=LATEST):
+        """Record that a user read a conversation up to message_id (default: everything)"""
+        key = (user_id, chat_type, peer_id)
+        with self._lock:
+            current = self._pending.get(key, _NOT_PENDING)
+            if current is _NOT_PENDING:
+                self._pending[key] = message_id
+            elif current is not LATEST:
+                self._pending[key] = LATEST if message_id is LATEST else max(current, message_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='read-marks', daemon=True)
+                self._thread.start()
+
+    def pending_mark(self, user_id, chat_type, peer_id, default=0):
+        """An unflushed mark (a message id or LATEST), or default when there is none"""
+        with self._lock:
+            return self._pending.get((user_id, chat_type, peer_id), default)
+
+    def _take(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                taken, self._pending = self._pending, {}
+            else:
+                taken = {key: value for key, value in self._pending.items() if key[0] == user_id}
+                for key in taken:
+                    del self._pending[key]
+        return [key + (value,) for key, value in taken.items()]
+
+    def _write(self, marks):
+        """Commit marks in the current session; returns how many were written.
+
+        If the batch fails, each mark is retried on its own and one that still
+        fails is dropped, so a single bad mark can't hold back everyone's.
+        """
+        from app import db
+
+        try:
+            apply_read_marks(marks)
+            db.session.commit()
+            return len(marks)
+        except Exception as e:
+            db.session.rollback()
+            if len(marks) == 1:
+                print(f"Dropping read mark {marks[0]}: {e}")
+                return 0
+        return sum(self._write([mark]) for mark in marks)
+
+    def flush_user(self, user_id):
+        """Write one user's pending marks in the current request's session (commits)"""
+        marks = self._take(user_id)
+        return self._write(marks) if marks else 0
+
+    def flush(self):
+        """Write every pending mark in one transaction"""
+        from app import db
+
+        marks = self._take()
+        if not marks:
+            return 0
+        with self.app.app_context():
+            try:
+                return self._write(marks)
+            finally:
+                db.session.remove()
+
+    def _loop(self):
+        while not self._wake.wait(self.interval):
+            self.flush()
+
+    def shutdown(self):
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.app is not None:
+            self.flush()
+
+
+read_marks = ReadMarks()
@@ -0,0 +1,144 @@
+"""
+Full-text message search backed by an SQLite FTS5 index.
+
+message_fts is an external-content FTS5 table over message.content, kept in
+sync by triggers so that every writer (routes, bots, raw SQL) is covered.
+Databases without FTS5 (other DATABASE_URLs, old SQLite builds, or before
+the migration ran) fall back to a LIKE scan ordered by time.
+"""
+
+import re
+from html import escape
+
+from sqlalchemy import text, func, literal_column, table, column
+
+FTS_TABLE = 'message_fts'
+
+# Control characters can't appear in tokens, so they're safe snippet markers
+_MARK_START, _MARK_END = '\x02', '\x03'
+_SNIPPET_TOKENS = 12
+
+_SCHEMA = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    f"content, content='message', content_rowid='id', tokenize='unicode61')",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON message BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF content ON message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+]
+
+_fts_engines = set()
+
+
+def fts_supported():
+    """True if the database is SQLite and was built with FTS5"""
+    from app import db
+
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    with db.engine.connect() as connection:
+        return bool(connection.execute(text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar())
+
+
+def fts_enabled():
+    """True once the FTS table exists in the current database"""
+    from app import db
+
+    if db.engine.url in _fts_engines:
+        return True
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    with db.engine.connect() as connection:
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': FTS_TABLE}
+        ).first() is not None
+    if exists:
+        _fts_engines.add(db.engine.url)
+    return exists
+
+
+def create_search_index():
+    """Create the FTS table and its triggers. Returns False where FTS5 is unavailable."""
+    from app import db
+
+    if not fts_supported():
+        return False
+    with db.engine.begin() as connection:
+        for statement in _SCHEMA:
+            connection.execute(text(statement))
+    return True
+
+
+def rebuild_search_index():
+    """Re-index every message from scratch. Returns the message count, or None without FTS5."""
+    from app import db
+    from app.models import Message
+
+    if not create_search_index():
+        return None
+    with db.engine.begin() as connection:
+        connection.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+    # Runs as a migration: count ids only, whole rows name columns added later
+    return db.session.query(func.count(Message.id)).scalar()
+
+
+def search_terms(query_text):
+    return re.findall(r'\w+', query_text or '')
+
+
+def fts_query(query_text):
+    """Turn free text into an FTS5 query: every word must match as a prefix"""
+    terms = search_terms(query_text)
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def _render_snippet(snippet):
+    """HTML-escape a snippet and turn the match markers into highlight spans"""
+    return escape(snippet).replace(_MARK_START, '<span class="highlight">').replace(_MARK_END, '</span>')
+
+
+def _fallback_snippet(content, terms):
+    if not content:
+        return ''
+    pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+    return _render_snippet(pattern.sub(lambda m: f'{_MARK_START}{m.group()}{_MARK_END}', content))
+
+
+def search_messages(query_text, *conditions, limit=50):
+    """Return (Message, snippet HTML) pairs matching query_text, best match first.
+
+    conditions restrict which messages the caller may see; they are applied in
+    the same query as the match so limit counts visible results only.
+    """
+    from app import db
+    from app.models import Message
+    from app.utils.serializers import with_chats
+
+    terms = search_terms(query_text)
+    if not terms:
+        return []
+
+    if fts_enabled():
+        fts = table(FTS_TABLE, column('rowid'), column('rank'))
+        snippet = func.snippet(literal_column(FTS_TABLE), 0, _MARK_START, _MARK_END, '…', _SNIPPET_TOKENS)
+        rows = with_chats(db.session.query(Message, snippet).join(
+            fts, fts.c.rowid == Message.id
+        ).filter(
+            literal_column(FTS_TABLE).op('MATCH')(fts_query(query_text)),
+            *conditions
+        )).order_by(fts.c.rank, Message.id.desc()).limit(limit).all()
+        return [(message, _render_snippet(snippet)) for message, snippet in rows]
+
+    messages = with_chats(Message.query.filter(
+        *[Message.content.ilike(f'%{term}%') for term in terms],
+        *conditions
+    )).order_by(Message.timestamp.desc()).limit(limit).all()
+    return [(message, _fallback_snippet(message.content, terms)) for message in messages]
@@ -0,0 +1,137 @@
+"""
+JSON serialization of Message rows shared by the fetch, send, stream and search routes.
+
+Queries feeding these functions should go through with_senders() so that a
+whole page of messages costs one SELECT instead of one extra User load per row.
+
+The fetch routes skip dicts altogether. Each message is encoded to JSON
+once, as a fragment holding its viewer-independent fields with the closing
+brace left off, and kept in message_fragments (by id, see
+MESSAGE_JSON_CACHE_SIZE) and in the in-memory feeds. A response appends
+is_own/is_read to each fragment and joins them into the body. orjson is used
+for encoding when it is installed.
+"""
+
+import json
+
+from flask import Response
+from sqlalchemy.orm import joinedload
+
+from .cache import LRUCache
+from .helpers import format_file_size
+from .media import thumbnail_urls
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def with_senders(query):
+    """Eager-load Message.sender for every row of a Message query"""
+    from app.models import Message
+    return query.options(joinedload(Message.sender))
+
+
+def with_chats(query):
+    """Eager-load sender, group and channel, as search results display all three"""
+    from app.models import Message
+    return query.options(joinedload(Message.sender), joinedload(Message.group), joinedload(Message.channel))
+
+
+def message_fields(message):
+    """Viewer-independent fields of a message"""
+    message_data = {
+        'id': message.id,
+        'content': message.content,
+        'sender_name': message.sender.username,
+        'timestamp': message.timestamp.strftime('%H:%M'),
+        'has_attachment': message.has_attachment,
+    }
+
+    if message.has_attachment:
+        message_data.update({
+            'file_type': message.file_type,
+            'file_name': message.file_name,
+            'file_size': format_file_size(message.file_size),
+            'file_url': f"/{message.file_path}",
+            'thumbnail_url': f"/{message.thumbnail_path}" if message.thumbnail_path else None,
+            'thumbnail_status': message.thumbnail_status,
+            'thumbnails': thumbnail_urls(message)
+        })
+
+    return message_data
+
+
+def serialize_message(message, current_user_id, read_up_to=None):
+    """Message dict as returned by the fetch and send routes.
+
+    read_up_to maps a sender id to the newest of their messages the other side
+    has read (see read_state.personal_read_marks); when given, is_read is added.
+    """
+    message_data = message_fields(message)
+    message_data['is_own'] = message.sender_id == current_user_id
+    if read_up_to is not None:
+        message_data['is_read'] = message.id <= read_up_to.get(message.sender_id, 0)
+    return message_data
+
+
+def serialize_messages(messages, current_user_id, read_up_to=None):
+    return [serialize_message(message, current_user_id, read_up_to) for message in messages]
+
+
+def load_usernames(user_ids):
+    """Map user id -> username for a set of ids with a single query"""
+    from app import db
+    from app.models import User
+
+    user_ids = set(user_ids)
+    if not user_ids:
+        return {}
+    return dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids)))
+
+
+def dumps(value):
+    """JSON bytes of a value, compact and UTF-8"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+# Message id -> JSON fragment of message_fields(); dropped when the message changes
+message_fragments = LRUCache('message_fragments', maxsize=50000)
+
+
+def fields_fragment(fields):
+    """JSON of a message_fields() dict without its closing brace"""
+    return dumps(fields)[:-1]
+
+
+def message_fragment(message):
+    """Cached JSON fragment of a message's viewer-independent fields"""
+    return message_fragments.get_or_load(message.id, lambda _: fields_fragment(message_fields(message)))
+
+
+def viewer_json(fragment, message_id, sender_id, current_user_id, read_up_to=None):
+    """Complete the JSON of a message for a viewer, as serialize_message() would return it"""
+    parts = [fragment, b',"is_own":true' if sender_id == current_user_id else b',"is_own":false']
+    if read_up_to is not None:
+        parts.append(b',"is_read":true' if message_id <= read_up_to.get(sender_id, 0) else b',"is_read":false')
+    parts.append(b'}')
+    return b''.join(parts)
+
+
+def messages_json(messages, current_user_id, read_up_to=None):
+    """serialize_messages() as a list of JSON byte strings"""
+    return [viewer_json(message_fragment(message), message.id, message.sender_id, current_user_id, read_up_to)
+            for message in messages]
+
+
+def messages_json_response(messages_json, has_more=None):
+    """{"messages": [...], "has_more": ...} response joined from per-message JSON"""
+    body = [b'{"messages":[', b','.join(messages_json), b']']
+    if has_more is not None:
+        body.append(b',"has_more":true}' if has_more else b',"has_more":false}')
+    else:
+        body.append(b'}')
+    return Response(b''.join(body), mimetype='application/json')
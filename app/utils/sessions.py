@@ -0,0 +1,231 @@
+"""
+Server-side sessions and the cached context of the logged-in user.
+
+The session cookie only holds a random token. The session data lives in the
+ServerSession table, keyed by the token's sha256, and is kept in memory
+for SESSION_CACHE_TTL seconds after a read, so most requests don't touch
+the table. The TTL bounds how long a session deleted by another process
+(a logout there) stays valid here. Expired rows are deleted every
+SESSION_EXPIRE_INTERVAL seconds by whichever request comes next.
+
+user_context() caches what authorization checks need about a user: id,
+username, and the ids of their groups and channels. Routes that change
+memberships call invalidate_user_context(), so checks like is_group_member()
+are set lookups instead of GroupMember queries.
+"""
+
+import hashlib
+import json
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import g
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from .cache import LRUCache
+
+# Expiry is only written back once it is this far behind the full lifetime
+RENEW_AFTER = timedelta(days=1)
+# Sessions kept in memory; older ones are read from the table again when used
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 30  # seconds
+SESSION_EXPIRE_INTERVAL = 3600  # seconds
+
+
+def _session_key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, token=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.token = token
+        self.expires_at = expires_at
+        self.previous_token = None
+        self.modified = False
+
+    def regenerate(self):
+        """Move the session to a new token, e.g. on login (against session fixation)"""
+        if self.token:
+            self.previous_token = self.token
+        self.token = None
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, cache_ttl=SESSION_CACHE_TTL, expire_interval=SESSION_EXPIRE_INTERVAL):
+        # session key -> (data, expires_at)
+        self._cache = LRUCache('sessions', maxsize=SESSION_CACHE_SIZE, ttl=cache_ttl or None)
+        self.expire_interval = expire_interval
+        self._next_expiry = time.monotonic() + expire_interval
+        self._expiry_lock = threading.Lock()
+
+    def open_session(self, app, request):
+        token = request.cookies.get(self.get_cookie_name(app))
+        if not token:
+            return ServerSideSession()
+
+        key = _session_key(token)
+        cached = self._cache.get_or_load(key, self._load)
+        if cached is None or cached[1] < datetime.utcnow():
+            return ServerSideSession()
+
+        data, expires_at = cached
+        return ServerSideSession(dict(data), token=token, expires_at=expires_at)
+
+    def _load(self, key):
+        from app import db
+        from app.models import ServerSession
+
+        row = db.session.get(ServerSession, key)
+        if row is None:
+            return None
+        return json.loads(row.data), row.expires_at
+
+    def save_session(self, app, session, response):
+        from app import db
+        from app.models import ServerSession
+
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        self._expire_if_due()
+
+        if session.previous_token:
+            self._delete(_session_key(session.previous_token))
+
+        if not session:
+            if session.token:
+                self._delete(_session_key(session.token))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        expires_at = datetime.utcnow() + app.permanent_session_lifetime
+        renew = session.expires_at is None or expires_at - session.expires_at > RENEW_AFTER
+        if session.modified or renew:
+            session.token = session.token or secrets.token_urlsafe(32)
+            key = _session_key(session.token)
+            data = dict(session)
+            try:
+                db.session.merge(ServerSession(id=key, data=json.dumps(data), expires_at=expires_at))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            self._cache.set(key, (data, expires_at))
+
+        if session.modified or renew or session.previous_token:
+            response.set_cookie(
+                name, session.token,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app)
+            )
+
+    def _delete(self, key):
+        from app import db
+        from app.models import ServerSession
+
+        self._cache.invalidate(key)
+        try:
+            ServerSession.query.filter_by(id=key).delete()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def _expire_if_due(self):
+        """Run expire_sessions() once every expire_interval seconds, in one request at a time"""
+        from app import db
+
+        with self._expiry_lock:
+            now = time.monotonic()
+            if now < self._next_expiry:
+                return
+            self._next_expiry = now + self.expire_interval
+        try:
+            self.expire_sessions()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Expiring sessions failed: {e}")
+
+    def expire_sessions(self):
+        """Delete expired sessions; returns how many"""
+        from app import db
+        from app.models import ServerSession
+
+        count = ServerSession.query.filter(ServerSession.expires_at < datetime.utcnow()).delete()
+        db.session.commit()
+        return count
+
+
+# Membership/ACL cache: user id -> context. The TTL bounds staleness from writes
+# that don't go through invalidate_user_context() (other processes, scripts).
+user_contexts = LRUCache('user_contexts', maxsize=10000, ttl=300)
+
+
+def load_user_context(user_id):
+    from app import db
+    from app.models import User, GroupMember, ChannelSubscriber
+
+    username = db.session.query(User.username).filter_by(id=user_id).scalar()
+    if username is None:
+        return None
+    return {
+        'id': user_id,
+        'username': username,
+        'group_ids': frozenset(group_id for (group_id,) in db.session.query(
+            GroupMember.group_id).filter_by(user_id=user_id)),
+        'channel_ids': frozenset(channel_id for (channel_id,) in db.session.query(
+            ChannelSubscriber.channel_id).filter_by(user_id=user_id)),
+    }
+
+
+def user_context(user_id):
+    """Cached {id, username, group_ids, channel_ids} of a user, or None if there is no such user"""
+    return user_contexts.get_or_load(user_id, load_user_context)
+
+
+def invalidate_user_context(user_id=None):
+    """Drop one user's cached context after their memberships changed, or everyone's"""
+    if user_id is None:
+        user_contexts.clear()
+    else:
+        user_contexts.invalidate(user_id)
+
+
+def current_user_context():
+    """Context of the logged-in user, looked up once per request"""
+    from .helpers import get_current_user_id
+
+    if 'user_context' not in g:
+        user_id = get_current_user_id()
+        g.user_context = user_context(user_id) if user_id else None
+    return g.user_context
+
+
+def _as_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_group_member(group_id, user_id=None):
+    """Whether the logged-in user (or user_id) is in a group, from the cached context"""
+    context = user_context(user_id) if user_id else current_user_context()
+    return context is not None and _as_id(group_id) in context['group_ids']
+
+
+def is_channel_subscriber(channel_id, user_id=None):
+    """Whether the logged-in user (or user_id) is subscribed to a channel, from the cached context"""
+    context = user_context(user_id) if user_id else current_user_context()
+    return context is not None and _as_id(channel_id) in context['channel_ids']
@@ -0,0 +1,410 @@
+"""
+Mirror personal messages to and from Telegram.
+
+A user links their account by sending the bot "/start <code>", using a code
+from /api/telegram_link. After that, personal messages to them are forwarded
+to their Telegram chat. Anything they send the bot comes back as a Kiselgram
+message. A reply to a forwarded message answers its sender; any other
+message goes to whoever was last forwarded to them.
+
+Outgoing messages wait in a bounded queue. The sender thread coalesces
+everything pending for one chat into a single sendMessage, and keeps to
+Telegram's limits: about one message per second per chat and 30 per second
+overall. A chat the API answers 429 for waits the retry_after it was given,
+and its later sends stay spaced that far apart until they go through again.
+Message.telegram_message_id
+holds "<chat id>:<message id>" of a message's Telegram copy. That is how
+repeated updates are deduplicated and how replies find their original.
+
+TELEGRAM_API_URL points the bridge at a different Bot API server, e.g. a
+local one or the stub in benchmarks/bench_telegram_bridge.py.
+"""
+
+import secrets
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+
+import telebot
+from telebot import apihelper
+
+from .bot_engine import RateLimiter
+
+MAX_TEXT_LENGTH = 4096
+CHAT_INTERVAL = 1.0  # seconds between messages to one chat
+GLOBAL_RATE = 30  # messages per second to all chats
+RETRY_DELAY = 5  # seconds, after network errors
+LINK_CODE_MINUTES = 10
+
+LINK_HELP = "👋 To receive your Kiselgram messages here, send /start with the code from your Kiselgram profile."
+NO_PEER_HELP = "💬 Reply to a forwarded message to answer it."
+
+
+def telegram_key(chat_id, message_id):
+    return f"{chat_id}:{message_id}"
+
+
+def forward_text(event):
+    """How a published message looks in Telegram"""
+    text = event['content'] or ''
+    if event.get('has_attachment'):
+        text = f"📎 {event['file_name']}\n{text}".rstrip()
+    return f"{event['sender_name']}: {text}"
+
+
+class TelegramBridge:
+    def __init__(self):
+        self.app = None
+        self.bot = None
+        self.max_queue = 1000
+        self.poll_timeout = 20
+        self.dropped = 0
+        self._links = {}  # user id -> telegram chat id
+        self._chats = {}  # telegram chat id -> user id
+        self._link_codes = {}  # code -> (user id, expiry)
+        self._pending = defaultdict(deque)  # chat id -> deque of (message id or None, text)
+        self._pending_count = 0
+        self._next_send = {}  # chat id -> monotonic time it may be sent to again
+        self._intervals = {}  # chat id -> seconds between its sends, when raised above CHAT_INTERVAL
+        self._limiter = RateLimiter(GLOBAL_RATE, GLOBAL_RATE)
+        self._wake = threading.Condition()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._listening = False
+
+    @property
+    def enabled(self):
+        return self.bot is not None
+
+    def start(self, app):
+        """Connect to the Bot API if TELEGRAM_BOT_TOKEN is set. Returns whether the bridge runs."""
+        token = app.config.get('TELEGRAM_BOT_TOKEN')
+        if not token or self.bot is not None:
+            return self.bot is not None
+
+        self.app = app
+        self.max_queue = app.config.get('TELEGRAM_QUEUE_SIZE', self.max_queue)
+        self.poll_timeout = app.config.get('TELEGRAM_POLL_TIMEOUT', self.poll_timeout)
+        if app.config.get('TELEGRAM_API_URL'):
+            apihelper.API_URL = app.config['TELEGRAM_API_URL'].rstrip('/') + '/bot{0}/{1}'
+
+        self.bot = telebot.TeleBot(token, threaded=False)
+        self.load_links()
+
+        if not self._listening:
+            from app.utils.events import message_bus
+            message_bus.listen(self._on_publish)
+            self._listening = True
+
+        self._stopping.clear()
+        self._threads = [
+            threading.Thread(target=self._send_loop, name='telegram-send', daemon=True),
+            threading.Thread(target=self._poll_loop, name='telegram-poll', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return True
+
+    def load_links(self):
+        from app import db
+        from app.models import User
+
+        with self.app.app_context():
+            try:
+                rows = db.session.query(User.id, User.telegram_chat_id).filter(
+                    User.telegram_chat_id.isnot(None)).all()
+            finally:
+                db.session.remove()
+
+        with self._wake:
+            self._links = {user_id: chat_id for user_id, chat_id in rows}
+            self._chats = {chat_id: user_id for user_id, chat_id in rows}
+
+    def link_code(self, user_id):
+        """One-time code a user sends the bot to link their Telegram chat"""
+        code = secrets.token_urlsafe(8)
+        now = datetime.utcnow()
+        with self._wake:
+            self._link_codes = {c: v for c, v in self._link_codes.items() if v[1] > now}
+            self._link_codes[code] = (user_id, now + timedelta(minutes=LINK_CODE_MINUTES))
+        return code
+
+    def unlink(self, user_id):
+        """Forget a user's chat (the caller clears User.telegram_chat_id)"""
+        with self._wake:
+            chat_id = self._links.pop(user_id, None)
+            self._chats.pop(chat_id, None)
+
+    # Outgoing
+
+    def _on_publish(self, key, event):
+        # Only personal chats; the key holds both participants
+        if key[0] != 'dm' or not self.enabled:
+            return
+
+        receiver_id = key[2] if key[1] == event['sender_id'] else key[1]
+        chat_id = self._links.get(receiver_id)
+        if chat_id is not None:
+            self.enqueue(chat_id, forward_text(event), event['id'])
+
+    def enqueue(self, chat_id, text, message_id=None):
+        """Queue a text for a chat; False if the queue is full and it was dropped"""
+        with self._wake:
+            if self._pending_count >= self.max_queue:
+                self.dropped += 1
+                print(f"Telegram queue full, dropped message {message_id} to chat {chat_id}")
+                return False
+            self._pending[chat_id].append((message_id, text))
+            self._pending_count += 1
+            self._wake.notify()
+        return True
+
+    def _take_batch(self, chat_id):
+        """Pop as many pending texts of a chat as fit in one Telegram message"""
+        pending = self._pending[chat_id]
+        batch = [pending.popleft()]
+        length = len(batch[0][1])
+        while pending and length + 1 + len(pending[0][1]) <= MAX_TEXT_LENGTH:
+            batch.append(pending.popleft())
+            length += 1 + len(batch[-1][1])
+        if not pending:
+            del self._pending[chat_id]
+        self._pending_count -= len(batch)
+        return batch
+
+    def _requeue(self, chat_id, batch):
+        with self._wake:
+            self._pending[chat_id].extendleft(reversed(batch))
+            self._pending_count += len(batch)
+
+    def _space(self, chat_id, backoff=None):
+        """Hold back the next send to a chat after one finished. A backoff (a 429's retry_after)
+        becomes the chat's interval, which halves back to CHAT_INTERVAL with each later send"""
+        with self._wake:
+            interval = self._intervals.pop(chat_id, CHAT_INTERVAL)
+            interval = max(backoff if backoff is not None else interval / 2, CHAT_INTERVAL)
+            if interval > CHAT_INTERVAL:
+                self._intervals[chat_id] = interval
+            now = time.monotonic()
+            self._next_send[chat_id] = now + interval
+
+            if len(self._next_send) > self.max_queue:
+                self._next_send = {c: t for c, t in self._next_send.items() if t > now or c in self._pending}
+                self._intervals = {c: i for c, i in self._intervals.items() if c in self._next_send}
+
+    def _next_batch(self):
+        """Wait for a chat that has pending texts and may be sent to; None once stopped"""
+        with self._wake:
+            while not self._stopping.is_set():
+                delay = None
+                now = time.monotonic()
+                ready = [chat_id for chat_id in self._pending if self._next_send.get(chat_id, 0) <= now]
+                if ready:
+                    if self._limiter.take(1):
+                        # _send_loop spaces the chat once the send is done
+                        chat_id = min(ready, key=lambda c: self._next_send.get(c, 0))
+                        return chat_id, self._take_batch(chat_id)
+                    delay = self._limiter.wait_time()
+                elif self._pending:
+                    delay = min(self._next_send.get(chat_id, 0) for chat_id in self._pending) - now
+                self._wake.wait(delay)
+            return None
+
+    def _send_loop(self):
+        while True:
+            item = self._next_batch()
+            if item is None:
+                return
+            chat_id, batch = item
+            try:
+                sent = self.bot.send_message(chat_id, '\n'.join(text for _, text in batch)[:MAX_TEXT_LENGTH])
+            except apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after')
+                    self._requeue(chat_id, batch)
+                    self._space(chat_id, retry_after if isinstance(retry_after, (int, float)) else RETRY_DELAY)
+                else:
+                    # Blocked by the user, chat gone, ...: the messages stay in Kiselgram only
+                    print(f"Telegram rejected message to chat {chat_id}: {e}")
+                    self._space(chat_id)
+                continue
+            except Exception as e:
+                print(f"Telegram send to chat {chat_id} failed: {e}")
+                self._requeue(chat_id, batch)
+                self._space(chat_id, RETRY_DELAY)
+                continue
+
+            self._space(chat_id)
+            self._mark_sent(chat_id, sent.message_id, [message_id for message_id, _ in batch if message_id])
+
+    def _mark_sent(self, chat_id, telegram_message_id, message_ids):
+        from app import db
+        from app.models import Message
+
+        if not message_ids:
+            return
+        with self.app.app_context():
+            try:
+                Message.query.filter(
+                    Message.id.in_(message_ids), Message.telegram_message_id.is_(None)
+                ).update({'telegram_message_id': telegram_key(chat_id, telegram_message_id)},
+                         synchronize_session=False)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Could not record Telegram ids of messages {message_ids}: {e}")
+            finally:
+                db.session.remove()
+
+    # Incoming
+
+    def _poll_loop(self):
+        offset = None
+        while not self._stopping.is_set():
+            try:
+                updates = self.bot.get_updates(offset=offset, timeout=self.poll_timeout + 5,
+                                               long_polling_timeout=self.poll_timeout,
+                                               allowed_updates=['message'])
+            except Exception as e:
+                print(f"Telegram polling failed: {e}")
+                self._stopping.wait(RETRY_DELAY)
+                continue
+
+            if updates:
+                try:
+                    self.handle_updates(updates)
+                except Exception as e:
+                    # Keep the offset so Telegram redelivers them; stored ones are skipped by key
+                    print(f"Telegram updates failed, retrying: {e}")
+                    self._stopping.wait(RETRY_DELAY)
+                    continue
+                offset = updates[-1].update_id + 1
+
+    def handle_updates(self, updates):
+        """Turn a batch of Telegram updates into Kiselgram messages, skipping ones already stored"""
+        from app import db
+        from app.models import Message
+        from app.utils.conversations import record_message
+        from app.utils.events import publish_message
+
+        incoming = [update.message for update in updates if update.message and update.message.text]
+        if not incoming:
+            return []
+
+        with self.app.app_context():
+            try:
+                keys = [telegram_key(m.chat.id, m.message_id) for m in incoming]
+                seen = {key for (key,) in db.session.query(Message.telegram_message_id).filter(
+                    Message.telegram_message_id.in_(keys))}
+
+                # Applied only once the transaction commits, so a retried batch starts over
+                messages, links, replies = [], [], []
+                for tg_message, key in zip(incoming, keys):
+                    if key in seen:
+                        continue
+                    seen.add(key)
+
+                    chat_id = str(tg_message.chat.id)
+                    text = tg_message.text.strip()
+                    if text.startswith(('/start', '/link')):
+                        replies.append((chat_id, self._link(chat_id, text.split()[1:], tg_message.from_user, links)))
+                        continue
+
+                    linked = [user_id for _, user_id, linked_chat in links if linked_chat == chat_id]
+                    user_id = linked[-1] if linked else self._chats.get(chat_id)
+                    if user_id is None:
+                        replies.append((chat_id, LINK_HELP))
+                        continue
+
+                    receiver_id = self._reply_target(user_id, chat_id, tg_message.reply_to_message)
+                    if receiver_id is None:
+                        replies.append((chat_id, NO_PEER_HELP))
+                        continue
+
+                    messages.append(Message(
+                        content=tg_message.text,
+                        sender_id=user_id,
+                        receiver_id=receiver_id,
+                        is_from_telegram=True,
+                        telegram_message_id=key
+                    ))
+
+                if messages:
+                    db.session.add_all(messages)
+                    db.session.flush()
+                    for message in messages:
+                        record_message(message)
+                db.session.commit()
+
+                self._apply_links(links)
+                for chat_id, text in replies:
+                    self.enqueue(chat_id, text)
+                for message in messages:
+                    publish_message(message)
+                return messages
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+    def _reply_target(self, user_id, chat_id, reply_to):
+        """Who a Telegram message answers: the sender of the replied-to copy, else the latest one"""
+        from app.models import Message
+
+        query = Message.query.filter(
+            Message.receiver_id == user_id,
+            Message.telegram_message_id.isnot(None),
+            Message.sender_id != user_id
+        )
+        if reply_to is not None:
+            original = query.filter(
+                Message.telegram_message_id == telegram_key(chat_id, reply_to.message_id)).first()
+            if original is not None:
+                return original.sender_id
+
+        latest = query.order_by(Message.id.desc()).first()
+        return latest.sender_id if latest else None
+
+    def _link(self, chat_id, args, from_user, links):
+        """Link a chat to the account of the code in args, in the current transaction; returns
+        the reply. The code and the in-memory maps are updated by _apply_links after the commit"""
+        from app import db
+        from app.models import User
+
+        code = args[0] if args else None
+        with self._wake:
+            user_id, expires = self._link_codes.get(code, (None, None))
+        if user_id is None or expires < datetime.utcnow() or any(c == code for c, _, _ in links):
+            return LINK_HELP
+
+        # A chat belongs to one account at a time
+        User.query.filter(User.telegram_chat_id == chat_id, User.id != user_id).update(
+            {'telegram_chat_id': None}, synchronize_session=False)
+        user = db.session.get(User, user_id)
+        user.telegram_chat_id = chat_id
+        user.telegram_username = from_user.username if from_user else None
+
+        links.append((code, user_id, chat_id))
+        return f"✅ Linked to Kiselgram as {user.username}."
+
+    def _apply_links(self, links):
+        """Use up the codes of committed links and route their chats"""
+        with self._wake:
+            for code, user_id, chat_id in links:
+                self._link_codes.pop(code, None)
+                self._chats.pop(self._links.get(user_id), None)
+                self._links.pop(self._chats.get(chat_id), None)
+                self._links[user_id] = chat_id
+                self._chats[chat_id] = user_id
+
+    def shutdown(self):
+        self._stopping.set()
+        with self._wake:
+            self._wake.notify_all()
+        self._threads = []
+        self.bot = None
+
+
+telegram_bridge = TelegramBridge()
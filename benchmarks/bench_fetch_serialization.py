@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Time building a fetch response from ORM rows against joining cached JSON fragments.
+
+Loads a page of messages (some with attachments) once, then measures, per
+response: serialize_messages() + jsonify as the fetch routes used to,
+messages_json() with a cold fragment cache (every row encoded), and
+messages_json() with warm fragments, the state the in-memory feeds keep.
+
+    python benchmarks/bench_fetch_serialization.py --messages 200 --repeat 200
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Fetch response serialization benchmark')
+    parser.add_argument('--messages', type=int, default=200, help='Messages per response')
+    parser.add_argument('--repeat', type=int, default=200, help='Timed responses per variant')
+    return parser.parse_args()
+
+
+def timed(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000
+
+
+def main():
+    args = parse_args()
+    path = tempfile.mktemp(suffix='.db', prefix='kiselgram_bench_')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path
+
+    from flask import jsonify
+    from app import create_app, db
+    from app.models import User, Message
+    from app.utils import migrate_database, with_senders, serialize_messages
+    from app.utils import serializers
+
+    app = create_app()
+    with app.test_request_context():
+        migrate_database()
+        users = [User(username=f'user{i}', password_hash='x') for i in range(2)]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add_all([Message(
+            content=f'message {i} ' + 'lorem ipsum ' * 5,
+            sender_id=users[i % 2].id, receiver_id=users[(i + 1) % 2].id,
+            **({'has_attachment': True, 'file_type': 'document', 'file_name': f'file{i}.pdf',
+                'file_path': f'uploads/documents/{i}.pdf', 'file_size': 123456 * i} if i % 5 == 0 else {})
+        ) for i in range(args.messages)])
+        db.session.commit()
+
+        viewer_id = users[0].id
+        read_up_to = {users[0].id: 0, users[1].id: args.messages // 2}
+        messages = with_senders(Message.query).order_by(Message.id).all()
+
+        def from_dicts():
+            return jsonify({'messages': serialize_messages(messages, viewer_id, read_up_to), 'has_more': False}).data
+
+        def cold_fragments():
+            serializers.message_fragments.clear()
+            return serializers.messages_json_response(
+                serializers.messages_json(messages, viewer_id, read_up_to), False).data
+
+        def warm_fragments():
+            return serializers.messages_json_response(
+                serializers.messages_json(messages, viewer_id, read_up_to), False).data
+
+        assert from_dicts() and cold_fragments() and warm_fragments()
+        rows = [
+            ('dicts + jsonify', timed(from_dicts, args.repeat)),
+            ('fragments, cold', timed(cold_fragments, args.repeat)),
+            ('fragments, warm', timed(warm_fragments, args.repeat)),
+        ]
+        db.engine.dispose()
+    os.remove(path)
+
+    encoder = 'orjson' if serializers.orjson is not None else 'json'
+    print(f"{args.messages} messages per response, encoder {encoder}")
+    for name, elapsed in rows:
+        print(f"{name:<20}{elapsed:>10.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Benchmark the Message hot queries before and after the index migration.
+
+Builds a synthetic SQLite database (10M messages by default) without the
+Message indexes, prints the query plan and median latency of each hot query,
+applies the migrations and measures again.
+
+    python benchmarks/bench_message_indexes.py --rows 10000000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Message index benchmark')
+    parser.add_argument('--rows', type=int, default=10_000_000, help='Number of messages to generate')
+    parser.add_argument('--users', type=int, default=5000, help='Number of users')
+    parser.add_argument('--groups', type=int, default=500, help='Number of groups')
+    parser.add_argument('--channels', type=int, default=100, help='Number of channels')
+    parser.add_argument('--repeat', type=int, default=20, help='Timed runs per query')
+    parser.add_argument('--db', default=None, help='Database file (default: temporary file)')
+    return parser.parse_args()
+
+
+def fill_database(db, args):
+    """Insert users, groups, channels and messages with raw executemany batches"""
+    rng = random.Random(42)
+    connection = db.engine.raw_connection()
+    cursor = connection.cursor()
+    now = datetime.utcnow()
+
+    cursor.executemany('INSERT INTO user (id, username, password_hash, created_at) VALUES (?, ?, ?, ?)',
+                       [(i, f'user{i}', 'x', now) for i in range(1, args.users + 1)])
+    cursor.executemany('INSERT INTO "group" (id, name, owner_id, created_at, is_public) VALUES (?, ?, ?, ?, 1)',
+                       [(i, f'group{i}', 1, now) for i in range(1, args.groups + 1)])
+    cursor.executemany('INSERT INTO channel (id, name, owner_id, created_at, is_public) VALUES (?, ?, ?, ?, 1)',
+                       [(i, f'channel{i}', 1, now) for i in range(1, args.channels + 1)])
+
+    def rows(start, count):
+        for message_id in range(start, start + count):
+            sender = rng.randint(1, args.users)
+            kind = rng.random()
+            group_id = channel_id = None
+            receiver = sender
+            if kind < 0.6:
+                receiver = rng.randint(1, args.users)
+            elif kind < 0.9:
+                group_id = rng.randint(1, args.groups)
+            else:
+                channel_id = rng.randint(1, args.channels)
+            timestamp = now - timedelta(seconds=args.rows - message_id)
+            yield (message_id, f'message {message_id}', sender, receiver, timestamp, rng.random() < 0.5,
+                   group_id, channel_id)
+
+    batch = 100_000
+    started = time.perf_counter()
+    for start in range(1, args.rows + 1, batch):
+        cursor.executemany(
+            'INSERT INTO message (id, content, sender_id, receiver_id, timestamp, is_read, '
+            'is_from_telegram, has_attachment, group_id, channel_id) VALUES (?, ?, ?, ?, ?, ?, 0, 0, ?, ?)',
+            rows(start, min(batch, args.rows - start + 1))
+        )
+        connection.commit()
+    print(f"Inserted {args.rows:,} messages in {time.perf_counter() - started:.1f}s")
+    connection.close()
+
+
+def hot_queries(args):
+    """The query shapes used by the fetch, unread and bot routes"""
+    from app.models import Message
+
+    me, peer = 17, 42
+    after_id = args.rows - 1000
+    dm = ((Message.sender_id == me) & (Message.receiver_id == peer)) | \
+         ((Message.sender_id == peer) & (Message.receiver_id == me))
+    return {
+        'dm history (api_messages, after=0)': Message.query.filter(dm).order_by(Message.id.asc()),
+        'dm poll (api_messages)': Message.query.filter(dm).filter(Message.id > after_id).order_by(Message.id.asc()),
+        'unread count (chat list)': Message.query.filter_by(
+            sender_id=peer, receiver_id=me, is_read=False).with_entities(Message.id),
+        'bot unread (bot loop)': Message.query.filter_by(receiver_id=me, is_read=False),
+        'group history (api_group_messages, after=0)': Message.query.filter_by(group_id=7).order_by(
+            Message.id.asc()),
+        'group poll (api_group_messages)': Message.query.filter_by(group_id=7).filter(
+            Message.id > after_id).order_by(Message.id.asc()),
+        'channel poll (api_channel_messages)': Message.query.filter_by(channel_id=3).filter(
+            Message.id > after_id).order_by(Message.id.asc()),
+    }
+
+
+def measure(db, args):
+    from sqlalchemy import text
+
+    results = {}
+    for name, query in hot_queries(args).items():
+        sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        with db.engine.connect() as connection:
+            plan = [row[-1] for row in connection.execute(text('EXPLAIN QUERY PLAN ' + sql))]
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                connection.execute(text(sql)).fetchall()
+                timings.append((time.perf_counter() - started) * 1000)
+        results[name] = (plan, statistics.median(timings))
+    return results
+
+
+def main():
+    args = parse_args()
+    path = args.db or tempfile.mktemp(suffix='.db', prefix='kiselgram_bench_')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(path)
+
+    from app import create_app, db
+    from app.models import Message
+    from app.utils.migrations import migrate_database
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        for index in Message.__table__.indexes:
+            index.drop(db.engine, checkfirst=True)
+
+        fill_database(db, args)
+        before = measure(db, args)
+
+        started = time.perf_counter()
+        migrate_database()
+        print(f"Migrations applied in {time.perf_counter() - started:.1f}s")
+        after = measure(db, args)
+
+    print()
+    for name in before:
+        print(f"== {name}")
+        print(f"   before: {before[name][1]:10.3f} ms  {' | '.join(before[name][0])}")
+        print(f"   after:  {after[name][1]:10.3f} ms  {' | '.join(after[name][0])}")
+
+    if not args.db:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
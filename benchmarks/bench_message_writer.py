@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Send throughput with and without the group-commit message writer.
+
+Sender threads post personal messages through /api/send_message for a fixed
+time, first committing per request, then with MESSAGE_WRITER on. The writer
+run also reports how many messages shared each commit. Use --profile default
+to keep a full journal sync per commit, where batching matters most.
+
+    python benchmarks/bench_message_writer.py --senders 16 --seconds 10 --profile default
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Group-commit message writer benchmark')
+    parser.add_argument('--users', type=int, default=50, help='Number of users')
+    parser.add_argument('--senders', type=int, default=16, help='Threads sending messages')
+    parser.add_argument('--seconds', type=float, default=10, help='Duration of each run')
+    parser.add_argument('--profile', default='production', help='DB_PROFILE to run with')
+    parser.add_argument('--interval', type=float, default=5, help='MESSAGE_WRITER_INTERVAL in ms')
+    return parser.parse_args()
+
+
+def run(writer, args):
+    path = tempfile.mktemp(suffix='.db', prefix='kiselgram_bench_')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path
+    os.environ['DB_PROFILE'] = args.profile
+    os.environ['MESSAGE_WRITER'] = '1' if writer else '0'
+    os.environ['MESSAGE_WRITER_INTERVAL'] = str(args.interval)
+
+    from app import create_app, db
+    from app.models import User, Message
+    from app.utils import migrate_database, message_writer
+
+    app = create_app()
+    app.logger.disabled = True  # failed requests are counted, not printed
+    with app.app_context():
+        migrate_database()
+        users = [User(username=f'user{i}', password_hash='x') for i in range(args.users)]
+        db.session.add_all(users)
+        db.session.commit()
+        user_ids = [user.id for user in users]
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    latencies, failures = [], []
+
+    def sender(seed):
+        rng = random.Random(seed)
+        index = rng.randrange(len(user_ids))
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['username'] = f'user{index}'
+            session['user_id'] = user_ids[index]
+        own, failed = [], 0
+        while not stop.is_set():
+            started = time.perf_counter()
+            response = client.post('/api/send_message',
+                                   json={'receiver_id': rng.choice(user_ids), 'content': f'hello {rng.random()}'})
+            if response.status_code == 200:
+                own.append(time.perf_counter() - started)
+            else:
+                failed += 1
+        with lock:
+            latencies.extend(own)
+            failures.append(failed)
+
+    threads = [threading.Thread(target=sender, args=(i,)) for i in range(args.senders)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    stats = message_writer.stats()
+    message_writer.shutdown()
+    with app.app_context():
+        stored = Message.query.count()
+        db.engine.dispose()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    print(f"message writer {'on' if writer else 'off'} ({args.profile} profile)")
+    print(f"  sends/s                       {len(latencies) / args.seconds:>8.1f}")
+    print(f"  median send (ms)              {statistics.median(latencies) * 1000:>8.2f}")
+    print(f"  failed requests               {sum(failures):>8}")
+    print(f"  stored / acknowledged         {stored:>5} / {len(latencies)}")
+    if writer:
+        print(f"  commits                       {stats['batches']:>8}")
+        print(f"  messages per commit           {stats['average_batch']:>8}")
+
+
+def main():
+    args = parse_args()
+    run(False, args)
+    run(True, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Count the SQL statements issued by the message fetch and search routes.
+
+Fills a group, a channel and a personal chat with messages from a growing
+number of distinct senders and records how many statements each request
+executes. With eager-loaded senders the count must not grow with the page.
+
+    python benchmarks/bench_serialization_queries.py --sizes 10 50 200
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Query count per serialized page')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 200],
+                        help='Distinct senders (and messages) per conversation')
+    return parser.parse_args()
+
+
+class QueryCounter:
+    """Count statements executed on the engine while active"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _before_execute(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._before_execute)
+        return self
+
+    def __exit__(self, *exc):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute', self._before_execute)
+
+
+def fill_database(db, size):
+    """One reader plus `size` senders, each posting once to every conversation"""
+    from app.models import User, Group, GroupMember, Channel, ChannelSubscriber, Message
+
+    reader = User(username='reader', password_hash='x')
+    db.session.add(reader)
+    db.session.flush()
+    group = Group(name='bench group', owner_id=reader.id)
+    channel = Channel(name='bench channel', owner_id=reader.id)
+    db.session.add_all([group, channel])
+    db.session.flush()
+    db.session.add_all([GroupMember(user_id=reader.id, group_id=group.id, role='admin'),
+                        ChannelSubscriber(user_id=reader.id, channel_id=channel.id)])
+
+    for i in range(size):
+        sender = User(username=f'sender{i}', password_hash='x')
+        db.session.add(sender)
+        db.session.flush()
+        db.session.add_all([
+            Message(content=f'needle dm {i}', sender_id=sender.id, receiver_id=reader.id),
+            Message(content=f'needle dm reply {i}', sender_id=reader.id, receiver_id=sender.id),
+            Message(content=f'needle group {i}', sender_id=sender.id, receiver_id=sender.id, group_id=group.id),
+            Message(content=f'needle channel {i}', sender_id=sender.id, receiver_id=sender.id,
+                    channel_id=channel.id),
+        ])
+    db.session.commit()
+    return reader.id, group.id, channel.id, sender.id
+
+
+def main():
+    args = parse_args()
+
+    rows = []
+    for size in args.sizes:
+        path = tempfile.mktemp(suffix='.db', prefix='kiselgram_bench_')
+        os.environ['DATABASE_URL'] = 'sqlite:///' + path
+
+        from app import create_app, db
+        app = create_app()
+        with app.app_context():
+            db.create_all()
+            reader_id, group_id, channel_id, peer_id = fill_database(db, size)
+            engine = db.engine
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['username'] = 'reader'
+            session['user_id'] = reader_id
+
+        urls = {
+            'dm fetch': f'/api/messages/{peer_id}?limit=200',
+            'group fetch': f'/api/group_messages/{group_id}?limit=200',
+            'channel fetch': f'/api/channel_messages/{channel_id}?limit=200',
+            'search_messages': '/api/search_messages?q=needle',
+            'search page': '/search?q=needle&type=messages',
+        }
+        for name, url in urls.items():
+            with app.app_context(), QueryCounter(engine) as counter:
+                started = time.perf_counter()
+                response = client.get(url)
+                elapsed = (time.perf_counter() - started) * 1000
+            assert response.status_code == 200, (url, response.status_code)
+            rows.append((name, size, counter.count, elapsed))
+
+        with app.app_context():
+            db.engine.dispose()
+        os.remove(path)
+
+    print(f"{'request':<18}{'messages':>10}{'queries':>10}{'ms':>10}")
+    for name, size, count, elapsed in sorted(rows, key=lambda row: (row[0], row[1])):
+        print(f"{name:<18}{size:>10}{count:>10}{elapsed:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
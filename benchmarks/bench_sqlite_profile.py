@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Compare the SQLite engine profiles under concurrent send and poll traffic.
+
+For each DB_PROFILE a fresh database is created, then sender threads post
+personal messages through /api/send_message while poller threads fetch
+/api/messages and /api/chat_list, all for a fixed time. Prints requests per
+second and how many requests failed (e.g. "database is locked").
+
+    python benchmarks/bench_sqlite_profile.py --senders 4 --pollers 8 --seconds 10
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='SQLite engine profile benchmark')
+    parser.add_argument('--profiles', default='default,production', help='Comma-separated DB_PROFILE values')
+    parser.add_argument('--users', type=int, default=50, help='Number of users')
+    parser.add_argument('--senders', type=int, default=4, help='Threads sending messages')
+    parser.add_argument('--pollers', type=int, default=8, help='Threads polling messages and the chat list')
+    parser.add_argument('--seconds', type=float, default=10, help='Duration of each run')
+    return parser.parse_args()
+
+
+def logged_in_client(app, user_id, username):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['username'] = username
+        session['user_id'] = user_id
+    return client
+
+
+def run_profile(profile, args):
+    path = tempfile.mktemp(suffix='.db', prefix='kiselgram_bench_')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path
+    os.environ['DB_PROFILE'] = profile
+
+    from app import create_app, db
+    from app.models import User
+    from app.utils import migrate_database
+    from app.utils.database import sqlite_settings
+    from app.utils.read_state import read_marks
+
+    app = create_app()
+    app.logger.disabled = True  # failed requests are counted, not printed
+    with app.app_context():
+        migrate_database()
+        users = [User(username=f'user{i}', password_hash='x') for i in range(args.users)]
+        db.session.add_all(users)
+        db.session.commit()
+        user_ids = [user.id for user in users]
+        settings = sqlite_settings(db.engine)
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    results = {'send': [], 'poll': [], 'failed': 0}
+
+    def worker(kind, seed):
+        rng = random.Random(seed)
+        user_id = rng.choice(user_ids)
+        client = logged_in_client(app, user_id, f'user{user_ids.index(user_id)}')
+        latencies, failed = [], 0
+        while not stop.is_set():
+            peer_id = rng.choice(user_ids)
+            started = time.perf_counter()
+            try:
+                if kind == 'send':
+                    response = client.post('/api/send_message',
+                                           json={'receiver_id': peer_id, 'content': f'hello {rng.random()}'})
+                elif rng.random() < 0.5:
+                    response = client.get(f'/api/messages/{peer_id}')
+                else:
+                    response = client.get('/api/chat_list')
+                ok = response.status_code == 200
+            except Exception:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                failed += 1
+        with lock:
+            results[kind].extend(latencies)
+            results['failed'] += failed
+
+    threads = [threading.Thread(target=worker, args=('send', i)) for i in range(args.senders)]
+    threads += [threading.Thread(target=worker, args=('poll', 1000 + i)) for i in range(args.pollers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    read_marks.shutdown()
+    with app.app_context():
+        db.engine.dispose()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    return settings, results
+
+
+def median_ms(values):
+    return statistics.median(values) * 1000 if values else float('nan')
+
+
+def main():
+    args = parse_args()
+    for profile in args.profiles.split(','):
+        settings, results = run_profile(profile, args)
+        print(f"profile {profile}: " + ', '.join(f'{name}={value}' for name, value in settings.items()))
+        print(f"  sends/s                       {len(results['send']) / args.seconds:>8.1f}")
+        print(f"  polls/s                       {len(results['poll']) / args.seconds:>8.1f}")
+        print(f"  median send (ms)              {median_ms(results['send']):>8.2f}")
+        print(f"  median poll (ms)              {median_ms(results['poll']):>8.2f}")
+        print(f"  failed requests               {results['failed']:>8}")
+
+
+if __name__ == '__main__':
+    main()
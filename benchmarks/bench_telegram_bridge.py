@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Run the Telegram bridge against a local stub Bot API server (no network).
+
+The stub answers sendMessage and getUpdates like api.telegram.org, including
+429 responses when a chat gets more than one message per second. One user
+bursts messages at a linked user; the bridge has to coalesce them into few
+sends without tripping the limit. Then the stub delivers replies from
+Telegram, each twice, which must turn into exactly one Kiselgram message each.
+
+    python benchmarks/bench_telegram_bridge.py --messages 200
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CHAT_ID = 1001
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Telegram bridge against a stub Bot API')
+    parser.add_argument('--messages', type=int, default=200, help='Messages sent to the linked user')
+    return parser.parse_args()
+
+
+class StubBotAPI(ThreadingHTTPServer):
+    """Minimal Bot API: records sendMessage calls and serves queued updates to getUpdates"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Condition()
+        self.sent = []  # (chat id, text, message id)
+        self.rate_limited = 0
+        self.last_send = {}
+        self.updates = []
+        self.next_message_id = 1
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def push_update(self, text, reply_to=None, copies=1):
+        """Queue an incoming message; copies > 1 redelivers it under new update ids"""
+        with self.lock:
+            message = {'message_id': self.next_message_id, 'date': int(time.time()), 'text': text,
+                       'chat': {'id': CHAT_ID, 'type': 'private'},
+                       'from': {'id': CHAT_ID, 'is_bot': False, 'first_name': 'Alice', 'username': 'alice_tg'}}
+            if reply_to:
+                message['reply_to_message'] = {'message_id': reply_to, 'date': message['date'],
+                                               'chat': message['chat']}
+            self.next_message_id += 1
+            for _ in range(copies):
+                self.updates.append({'update_id': len(self.updates) + 1, 'message': message})
+            self.lock.notify_all()
+
+    def send_message(self, params):
+        chat_id = params['chat_id']
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_send.get(chat_id, -10) < 1:
+                self.rate_limited += 1
+                return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                             'parameters': {'retry_after': 1}}
+            self.last_send[chat_id] = now
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            self.sent.append((chat_id, params['text'], message_id))
+        return 200, {'ok': True, 'result': {'message_id': message_id, 'date': int(time.time()),
+                                            'chat': {'id': int(chat_id), 'type': 'private'},
+                                            'text': params['text']}}
+
+    def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + min(float(params.get('timeout') or 0), 1)
+        with self.lock:
+            while True:
+                pending = [u for u in self.updates if u['update_id'] >= offset]
+                remaining = deadline - time.monotonic()
+                if pending or remaining <= 0:
+                    return 200, {'ok': True, 'result': pending}
+                self.lock.wait(remaining)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def _handle(self):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params.update(parse_qsl(self.rfile.read(length).decode()))
+
+        method = url.path.rsplit('/', 1)[-1]
+        if method == 'sendMessage':
+            status, body = self.server.send_message(params)
+        elif method == 'getUpdates':
+            status, body = self.server.get_updates(params)
+        else:
+            status, body = 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    args = parse_args()
+    stub = StubBotAPI()
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    path = tempfile.mktemp(suffix='.db', prefix='kiselgram_bench_')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path
+    os.environ['TELEGRAM_BOT_TOKEN'] = '123:stub'
+    os.environ['TELEGRAM_API_URL'] = stub.url
+    os.environ['TELEGRAM_POLL_TIMEOUT'] = '1'
+
+    from app import create_app, db
+    from app.models import User, Message
+    from app.utils import migrate_database, telegram_bridge
+
+    app = create_app()
+    with app.app_context():
+        migrate_database()
+        alice = User(username='alice', password_hash='x', telegram_chat_id=str(CHAT_ID))
+        bob = User(username='bob', password_hash='x')
+        db.session.add_all([alice, bob])
+        db.session.commit()
+        alice_id, bob_id = alice.id, bob.id
+    telegram_bridge.start(app)
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['username'] = 'bob'
+        session['user_id'] = bob_id
+
+    started = time.perf_counter()
+    for i in range(args.messages):
+        client.post('/api/send_message', json={'receiver_id': alice_id, 'content': f'message {i}'})
+    sent_at = time.perf_counter()
+
+    def forwarded():
+        with app.app_context():
+            return Message.query.filter(Message.receiver_id == alice_id,
+                                        Message.telegram_message_id.isnot(None)).count()
+
+    while forwarded() < args.messages:
+        time.sleep(0.05)
+    delivered_at = time.perf_counter()
+
+    # Replies from Telegram, each delivered twice
+    replied_to = stub.sent[-1][2]
+    for text in ['reply one', 'reply two']:
+        stub.push_update(text, reply_to=replied_to, copies=2)
+
+    def inbound():
+        with app.app_context():
+            return Message.query.filter_by(sender_id=alice_id, receiver_id=bob_id, is_from_telegram=True).count()
+
+    deadline = time.monotonic() + 10
+    while inbound() < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.5)
+    telegram_bridge.shutdown()
+
+    print(f"messages sent in kiselgram      {args.messages:>8}")
+    print(f"sendMessage calls               {len(stub.sent):>8}")
+    print(f"429 responses                   {stub.rate_limited:>8}")
+    print(f"send requests (ms)              {(sent_at - started) * 1000:>8.1f}")
+    print(f"all forwarded after (ms)        {(delivered_at - started) * 1000:>8.1f}")
+    print(f"inbound updates / stored        {len(stub.updates):>5} / {inbound()}")
+    print(f"dropped (queue full)            {telegram_bridge.dropped:>8}")
+
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -147,25 +147,22 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from app import create_app, db
-from app.utils import setup_bots
-import threading
-
-app = create_app()
+from app.utils import setup_bots, migrate_database, media_worker, bot_engine, telegram_bridge
 
-def init_database():
+def init_database(app):
     with app.app_context():
-        db.create_all()
+        migrate_database()
         setup_bots()
+        app.session_interface.expire_sessions()
         print("✓ Database initialized")
+    media_worker.resume()
 
-def start_bot_simulation(app):
-    from app.utils import simulate_bot_interaction
-    bot_thread = threading.Thread(target=simulate_bot_interaction, args=(app,), daemon=True)
-    bot_thread.start()
-
+# Only here: thumbnail worker processes are spawned and import this module again
 if __name__ == '__main__':
-    init_database()
-    start_bot_simulation(app)
+    app = create_app()
+    init_database(app)
+    bot_engine.start(app)
+    telegram_bridge.start(app)
     app.run(host='{host}', port={port}, debug={debug})
 '''
 
@@ -415,6 +412,8 @@ def show_help():
     print("\nUtility Commands:")
     print("  python manage.py clean       Clean temporary files")
     print("  python manage.py reset-db    Reset database (⚠️ deletes data)")
+    print("  python manage.py migrate     Apply database migrations")
+    print("  python manage.py reindex     Rebuild message search index")
     print("  python manage.py test        Run basic tests")
 
     print("\nExamples:")
@@ -511,6 +510,50 @@ def reset_database():
     return True
 
 
+def run_migrations():
+    """Create missing tables and apply pending schema migrations"""
+    print("\n🗄️  Migrating database...")
+
+    try:
+        from app import create_app
+        from app.utils import setup_bots, migrate_database
+    except ImportError as e:
+        print(f"❌ Could not import application: {e}")
+        return False
+
+    app = create_app()
+    with app.app_context():
+        count = migrate_database()
+        setup_bots()
+
+    print(f"✅ Database up to date ({count} migration(s) applied)")
+    return True
+
+
+def rebuild_search():
+    """Rebuild the full-text message search index"""
+    print("\n🔎 Rebuilding message search index...")
+
+    try:
+        from app import create_app
+        from app.utils import migrate_database, rebuild_search_index
+    except ImportError as e:
+        print(f"❌ Could not import application: {e}")
+        return False
+
+    app = create_app()
+    with app.app_context():
+        migrate_database()
+        count = rebuild_search_index()
+
+    if count is None:
+        print("⚠️  Full-text search unavailable for this database, using LIKE search")
+        return False
+
+    print(f"✅ Indexed {count} message(s)")
+    return True
+
+
 def run_tests():
     """Run basic tests"""
     print("\n🧪 Running basic tests...")
@@ -610,6 +653,12 @@ def main():
     # Reset DB command
     subparsers.add_parser('reset-db', help='Reset database (⚠️ deletes data)')
 
+    # Migrate command
+    subparsers.add_parser('migrate', help='Apply database migrations')
+
+    # Reindex command
+    subparsers.add_parser('reindex', help='Rebuild message search index')
+
     # Test command
     subparsers.add_parser('test', help='Run basic tests')
 
@@ -742,6 +791,14 @@ def main():
         print_header()
         reset_database()
 
+    elif args.command == 'migrate':
+        print_header()
+        run_migrations()
+
+    elif args.command == 'reindex':
+        print_header()
+        rebuild_search()
+
     elif args.command == 'test':
         print_header()
         run_tests()
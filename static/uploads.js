@@ -0,0 +1,106 @@
+// Attachment uploads shared by the chat, group and channel pages.
+// Small files go through /upload_file in one request; larger ones use the
+// chunked /api/uploads protocol, which survives dropped connections and
+// resumes from the last stored chunk (even after a page reload).
+
+const SINGLE_UPLOAD_LIMIT = 8 * 1024 * 1024;
+const MAX_UPLOAD_SIZE = 2 * 1024 * 1024 * 1024;
+const CHUNK_RETRIES = 5;
+
+function uploadResumeKey(file, destination) {
+    return 'kiselgram-upload:' + JSON.stringify([file.name, file.size, file.lastModified, destination]);
+}
+
+async function chunkDigest(blob) {
+    // crypto.subtle only exists on secure origins; the header is optional
+    if (!window.crypto || !crypto.subtle) return null;
+    const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+async function startChunkedUpload(file, destination, messageText, resumeKey) {
+    const saved = localStorage.getItem(resumeKey);
+    if (saved) {
+        const response = await fetch(`/api/uploads/${saved}`);
+        if (response.ok) return response.json();
+        localStorage.removeItem(resumeKey);
+    }
+
+    const response = await fetch('/api/uploads', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({
+            file_name: file.name,
+            file_size: file.size,
+            message: messageText,
+            ...destination
+        })
+    });
+    const data = await response.json();
+    if (!response.ok) throw new Error(data.error || 'Upload failed');
+
+    localStorage.setItem(resumeKey, data.upload_id);
+    return data;
+}
+
+async function sendChunk(uploadId, file, offset, chunkSize) {
+    const chunk = file.slice(offset, offset + chunkSize);
+    const headers = {'Content-Type': 'application/octet-stream'};
+    const digest = await chunkDigest(chunk);
+    if (digest) headers['X-Chunk-SHA256'] = digest;
+
+    for (let attempt = 0; ; attempt++) {
+        try {
+            const response = await fetch(`/api/uploads/${uploadId}?offset=${offset}`, {
+                method: 'PUT',
+                headers: headers,
+                body: chunk
+            });
+            const data = await response.json();
+            // 409: the server already has a different offset (e.g. our last response was lost)
+            if (response.ok || response.status === 409) return data.offset;
+            throw new Error(data.error || 'Upload failed');
+        } catch (error) {
+            if (attempt >= CHUNK_RETRIES) throw error;
+            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** attempt));
+        }
+    }
+}
+
+async function chunkedUpload(file, destination, messageText, onProgress) {
+    const resumeKey = uploadResumeKey(file, destination);
+    const upload = await startChunkedUpload(file, destination, messageText, resumeKey);
+
+    let offset = upload.offset;
+    while (offset < file.size) {
+        if (onProgress) onProgress(offset / file.size);
+        offset = await sendChunk(upload.upload_id, file, offset, upload.chunk_size);
+    }
+    if (onProgress) onProgress(1);
+
+    const response = await fetch(`/api/uploads/${upload.upload_id}/finalize`, {method: 'POST'});
+    const data = await response.json();
+    if (response.status !== 409) localStorage.removeItem(resumeKey);
+    return data;
+}
+
+async function uploadAttachment(file, destination, messageText, onProgress) {
+    if (file.size > SINGLE_UPLOAD_LIMIT) {
+        return chunkedUpload(file, destination, messageText, onProgress);
+    }
+
+    const formData = new FormData();
+    formData.append('file', file);
+    for (const [key, value] of Object.entries(destination)) {
+        formData.append(key, value);
+    }
+    if (messageText) {
+        formData.append('message', messageText);
+    }
+
+    const response = await fetch('/upload_file', {
+        method: 'POST',
+        body: formData
+    });
+    return response.json();
+}
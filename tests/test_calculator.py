@@ -0,0 +1,95 @@
+"""
+calc_bot's evaluator on hostile input: every expression below must return
+or fail with CalculationError quickly, never hang or leak a non-real value.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.calculator import (
+    CalculationError, MAX_BATCH, MAX_EXPRESSION_LENGTH, MAX_RESULT_BITS, MAX_ROUND_DIGITS,
+    evaluate, evaluate_batch, format_result
+)
+
+
+class EvaluateTest(unittest.TestCase):
+
+    def assertRejected(self, expression, message=None):
+        started = time.perf_counter()
+        with self.assertRaises(CalculationError) as raised:
+            evaluate(expression)
+        self.assertLess(time.perf_counter() - started, 1)
+        if message is not None:
+            self.assertEqual(str(raised.exception), message)
+
+    def test_arithmetic(self):
+        self.assertEqual(evaluate('2 + 3 * 4'), 14)
+        self.assertEqual(evaluate('2^10'), 1024)
+        self.assertEqual(evaluate('7 ÷ 2'), 3.5)
+        self.assertEqual(evaluate('sqrt(16) + abs(-2)'), 6)
+        self.assertEqual(format_result(evaluate('0.1 + 0.2')), '0.3')
+
+    def test_pathological_powers(self):
+        self.assertRejected('9**9**9', 'Exponent too large')
+        self.assertRejected('10**10**10', 'Exponent too large')
+        self.assertRejected('2**(MAX)'.replace('MAX', str(MAX_RESULT_BITS)), 'Result too large')
+        self.assertRejected('3**4095', 'Result too large')
+        self.assertRejected('(2**4000)**2', 'Result too large')
+        self.assertRejected('2**4000 * 2**4000', 'Result too large')
+
+    def test_powers_within_limit(self):
+        self.assertEqual(evaluate('2**2049'), 2 ** 2049)
+        self.assertEqual(evaluate(f'2**{MAX_RESULT_BITS - 1}'), 2 ** (MAX_RESULT_BITS - 1))
+        self.assertEqual(evaluate('(-1)**10000'), 1)
+        self.assertEqual(evaluate('0**10000'), 0)
+
+    def test_round_digits(self):
+        self.assertEqual(evaluate('round(3.14159, 2)'), 3.14)
+        self.assertEqual(evaluate('round(1234, -2)'), 1200)
+        self.assertEqual(evaluate(f'round(5, -{MAX_ROUND_DIGITS})'), 0)
+        self.assertRejected('round(5, -10**300)')
+        self.assertRejected(f'round(5, {MAX_ROUND_DIGITS + 1})')
+        self.assertRejected('round(5, 2.5)', 'Math error')
+
+    def test_non_real_results(self):
+        self.assertRejected('(-8)**0.5', 'Result is not a real number')
+        self.assertRejected('(-1)**(1/3)', 'Result is not a real number')
+
+    def test_non_finite_results(self):
+        self.assertRejected('1e308*10', 'Result too large')
+        self.assertRejected('-1e308*10', 'Result too large')
+        self.assertRejected('1e309', 'Result too large')
+        self.assertRejected('1e308*10 - 1e308*10')
+        self.assertRejected('exp(1000)', 'Math error')
+
+    def test_unsupported(self):
+        self.assertRejected('__import__("os")')
+        self.assertRejected('x + 1', "Unknown name 'x'")
+        self.assertRejected('True + 1', 'Only numbers are supported')
+        self.assertRejected('1/0', 'Division by zero')
+        self.assertRejected('1' + '+1' * MAX_EXPRESSION_LENGTH, 'Expression too long')
+
+
+class EvaluateBatchTest(unittest.TestCase):
+
+    def test_errors_are_per_expression(self):
+        self.assertEqual(evaluate_batch('1+1; 1/0\n2*3'), [
+            ('1+1', '2', None),
+            ('1/0', None, 'Division by zero'),
+            ('2*3', '6', None),
+        ])
+
+    def test_batch_limit(self):
+        self.assertEqual(len(evaluate_batch(';'.join(['1'] * MAX_BATCH))), MAX_BATCH)
+        with self.assertRaises(CalculationError):
+            evaluate_batch(';'.join(['1'] * (MAX_BATCH + 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
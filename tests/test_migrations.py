@@ -0,0 +1,153 @@
+"""
+Upgrading a database created by the first release of the schema.
+
+Migrations run before the columns added by later migrations exist, so
+they must only name columns the table already has. These tests build the
+original tables, fill them, and run migrate_database() against them.
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BASELINE_SCHEMA = [
+    """CREATE TABLE user (
+        id INTEGER NOT NULL, username VARCHAR(80) NOT NULL, password_hash VARCHAR(120) NOT NULL,
+        telegram_chat_id VARCHAR(50), telegram_username VARCHAR(80), created_at DATETIME,
+        PRIMARY KEY (id), UNIQUE (username), UNIQUE (telegram_chat_id))""",
+    """CREATE TABLE telegram_bot (
+        id INTEGER NOT NULL, name VARCHAR(80) NOT NULL, username VARCHAR(80) NOT NULL,
+        description TEXT, created_at DATETIME, is_active BOOLEAN,
+        PRIMARY KEY (id), UNIQUE (username))""",
+    """CREATE TABLE "group" (
+        id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, description TEXT, owner_id INTEGER NOT NULL,
+        created_at DATETIME, is_public BOOLEAN, invite_link VARCHAR(100),
+        PRIMARY KEY (id), FOREIGN KEY(owner_id) REFERENCES user (id), UNIQUE (invite_link))""",
+    """CREATE TABLE channel (
+        id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, description TEXT, owner_id INTEGER NOT NULL,
+        created_at DATETIME, is_public BOOLEAN, invite_link VARCHAR(100),
+        PRIMARY KEY (id), FOREIGN KEY(owner_id) REFERENCES user (id), UNIQUE (invite_link))""",
+    """CREATE TABLE message (
+        id INTEGER NOT NULL, content TEXT, sender_id INTEGER NOT NULL, receiver_id INTEGER NOT NULL,
+        timestamp DATETIME, is_read BOOLEAN, telegram_message_id VARCHAR(50), is_from_telegram BOOLEAN,
+        group_id INTEGER, channel_id INTEGER, has_attachment BOOLEAN, file_type VARCHAR(20),
+        file_name VARCHAR(255), file_path VARCHAR(500), file_size INTEGER, thumbnail_path VARCHAR(500),
+        PRIMARY KEY (id), FOREIGN KEY(sender_id) REFERENCES user (id),
+        FOREIGN KEY(receiver_id) REFERENCES user (id), FOREIGN KEY(group_id) REFERENCES "group" (id),
+        FOREIGN KEY(channel_id) REFERENCES channel (id))""",
+    """CREATE TABLE group_member (
+        id INTEGER NOT NULL, user_id INTEGER NOT NULL, group_id INTEGER NOT NULL, joined_at DATETIME,
+        role VARCHAR(20), PRIMARY KEY (id), CONSTRAINT unique_group_member UNIQUE (user_id, group_id),
+        FOREIGN KEY(user_id) REFERENCES user (id), FOREIGN KEY(group_id) REFERENCES "group" (id))""",
+    """CREATE TABLE channel_subscriber (
+        id INTEGER NOT NULL, user_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, subscribed_at DATETIME,
+        PRIMARY KEY (id), CONSTRAINT unique_channel_subscriber UNIQUE (user_id, channel_id),
+        FOREIGN KEY(user_id) REFERENCES user (id), FOREIGN KEY(channel_id) REFERENCES channel (id))""",
+]
+
+BASELINE_ROWS = [
+    """INSERT INTO user (id, username, password_hash, created_at) VALUES
+        (1, 'alice', 'x', '2024-01-01 00:00:00'), (2, 'bob', 'x', '2024-01-01 00:00:00')""",
+    """INSERT INTO "group" (id, name, owner_id, is_public, invite_link) VALUES (1, 'friends', 1, 1, 'g1')""",
+    """INSERT INTO group_member (user_id, group_id, role) VALUES (1, 1, 'owner'), (2, 1, 'member')""",
+    """INSERT INTO message (id, content, sender_id, receiver_id, timestamp, is_read, has_attachment) VALUES
+        (1, 'hello bob', 1, 2, '2024-01-02 10:00:00', 1, 0),
+        (2, 'unread reply', 2, 1, '2024-01-02 10:01:00', 0, 0),
+        (3, 'group announcement', 1, 1, '2024-01-02 10:02:00', 0, 0)""",
+    """UPDATE message SET group_id = 1 WHERE id = 3""",
+]
+
+
+class BaselineUpgradeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='kiselgram_test_')
+        self.path = os.path.join(self.directory, 'baseline.db')
+        connection = sqlite3.connect(self.path)
+        for statement in BASELINE_SCHEMA + BASELINE_ROWS:
+            connection.execute(statement)
+        connection.commit()
+        connection.close()
+
+        self.previous_url = os.environ.get('DATABASE_URL')
+        os.environ['DATABASE_URL'] = 'sqlite:///' + self.path
+
+        from app import create_app
+        self.app = create_app()
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        from app import db
+
+        db.session.remove()
+        db.engine.dispose()
+        self.context.pop()
+        if self.previous_url is None:
+            os.environ.pop('DATABASE_URL', None)
+        else:
+            os.environ['DATABASE_URL'] = self.previous_url
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_all_migrations_apply(self):
+        from app.utils.migrations import MIGRATIONS, applied_migrations, migrate_database
+
+        self.assertEqual(migrate_database(), len(MIGRATIONS))
+        self.assertEqual(applied_migrations(), {version for version, _, _ in MIGRATIONS})
+        self.assertEqual(migrate_database(), 0)
+
+    def test_columns_added(self):
+        from sqlalchemy import inspect
+        from app import db
+        from app.utils.migrations import migrate_database
+
+        migrate_database()
+        columns = {column['name'] for column in inspect(db.engine).get_columns('message')}
+        self.assertTrue({'thumbnail_status', 'thumbnail_variants'} <= columns)
+        columns = {column['name'] for column in inspect(db.engine).get_columns('conversation')}
+        self.assertIn('last_read_message_id', columns)
+
+    def test_conversations_backfilled(self):
+        from app.models import Conversation
+        from app.utils.migrations import migrate_database
+
+        migrate_database()
+        chats = {(c.user_id, c.chat_type, c.peer_id): c for c in Conversation.query.all()}
+        self.assertEqual(set(chats), {(1, 'personal', 2), (2, 'personal', 1), (1, 'group', 1), (2, 'group', 1)})
+        self.assertEqual(chats[(1, 'personal', 2)].last_message_id, 2)
+        self.assertEqual(chats[(1, 'personal', 2)].unread_count, 1)
+        self.assertEqual(chats[(2, 'personal', 1)].unread_count, 0)
+        self.assertEqual(chats[(2, 'group', 1)].last_message_id, 3)
+
+    def test_message_ids_not_reused(self):
+        from app import db
+        from app.models import Message
+        from app.utils.migrations import migrate_database
+
+        migrate_database()
+        db.session.delete(db.session.get(Message, 3))
+        db.session.commit()
+        message = Message(content='after delete', sender_id=1, receiver_id=2)
+        db.session.add(message)
+        db.session.commit()
+        self.assertEqual(message.id, 4)
+
+    def test_existing_messages_searchable(self):
+        from app.utils.migrations import migrate_database
+        from app.utils.search_index import fts_supported, search_messages
+
+        migrate_database()
+        if not fts_supported():
+            self.skipTest('SQLite built without FTS5')
+        self.assertEqual([message.id for message, _ in search_messages('announce')], [3])
+
+
+if __name__ == '__main__':
+    unittest.main()